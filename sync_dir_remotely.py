@@ -13,20 +13,50 @@
 # Imports
 #########################################################
 import argparse
+import array
 import base64
+import binascii
+import bisect
+import bz2
+import collections
+import contextlib
 import copy # copy.deepcopy(x)
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
 import getpass
 import hashlib
 import json
+import marshal
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
+import Queue
 import re
+import select
 import socket
+import stat
 import struct
 import sys
 import threading
 import time
+import zlib
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 
 
@@ -40,8 +70,9 @@ def parse_args():
       '--mode',
       required=True,
       type=str,
-      choices=('remote', 'local'),
-      help='Mode to run this script in.',
+      choices=('remote', 'local', 'stats'),
+      help=('Mode to run this script in. stats prints the metrics of a '
+          'running remote as JSON.'),
   )
 
   parser.add_argument(
@@ -73,7 +104,6 @@ def parse_args():
   parser.add_argument(
       '-d',
       '--dirs',
-      required=True,
       type=str,
       nargs='+',
       help='Directories to keep in sync.',
@@ -104,7 +134,198 @@ def parse_args():
       help='What IP version to use.',
   )
 
+  parser.add_argument(
+      '-w',
+      '--wire_format',
+      type=str,
+      default=WIRE_FORMAT_BINARY,
+      choices=WIRE_FORMATS,
+      help='Preferred wire format offered to the remote during the handshake.',
+  )
+
+  parser.add_argument(
+      '-c',
+      '--compression',
+      type=str,
+      default=COMPRESSION_DEFAULT,
+      choices=Compressor.available(),
+      help=('Compression offered to the remote during the handshake and '
+          'applied to the contents of compressible files.'),
+  )
+
+  parser.add_argument(
+      '--window',
+      type=int,
+      default=REQUEST_WINDOW,
+      help=('Number of requests sent ahead of their responses, so uploads '
+          'do not wait a round trip each.'),
+  )
+
+  parser.add_argument(
+      '--writer_workers',
+      type=int,
+      default=WRITER_WORKERS,
+      help='Number of remote threads writing the files of an upload.',
+  )
+
+  parser.add_argument(
+      '--durability',
+      type=str,
+      default=DURABILITY_NONE,
+      choices=DURABILITY_MODES,
+      help=('What the remote fsyncs before acknowledging an upload: '
+          'nothing, every batch of files or every single file.'),
+  )
+
+  parser.add_argument(
+      '--workers',
+      type=int,
+      default=SERVER_WORKERS,
+      help='Number of remote threads handling requests of all clients.',
+  )
+
+  parser.add_argument(
+      '--debounce_ms',
+      type=int,
+      default=DEBOUNCE_MS,
+      help=('Quiet time waited after a change so bursts of changes are '
+          'uploaded together.'),
+  )
+
+  parser.add_argument(
+      '--streams',
+      type=int,
+      default=DATA_STREAMS,
+      help=('Number of data connections uploads are striped across. With 0 '
+          'uploads share the control connection.'),
+  )
+
+  parser.add_argument(
+      '--inotify',
+      action='store_true',
+      help=('Keep the file index updated from Linux inotify events instead '
+          'of re-crawling every few seconds.'),
+  )
+
+  parser.add_argument(
+      '--hash_workers',
+      type=int,
+      default=HASH_WORKERS,
+      help='Number of files hashed concurrently while crawling.',
+  )
+
+  parser.add_argument(
+      '--crawl_workers',
+      type=int,
+      default=CRAWL_WORKERS,
+      help=('Number of dirs listed concurrently while crawling, which hides '
+          'the latency of network filesystems.'),
+  )
+
+  parser.add_argument(
+      '--hash_processes',
+      action='store_true',
+      help='Hash files in worker processes instead of threads.',
+  )
+
+  parser.add_argument(
+      '-f',
+      '--fingerprint',
+      type=str,
+      default=Fingerprint.MD5,
+      choices=Fingerprint.available(),
+      help=('How file contents are fingerprinted to detect changes. The '
+          'remote\'s choice wins during the handshake.'),
+  )
+
+  parser.add_argument(
+      '--index_cache_dir',
+      type=str,
+      default=INDEX_CACHE_DIR,
+      help=('Directory where the file index of each dir is persisted across '
+          'restarts. Empty disables the cache.'),
+  )
+
+  parser.add_argument(
+      '-e',
+      '--exclude',
+      type=str,
+      nargs='+',
+      default=[],
+      help=('gitignore style patterns of files and dirs the local side '
+          'leaves out, relative to each synced dir. Excluded dirs are not '
+          'even crawled.'),
+  )
+
+  parser.add_argument(
+      '--ignore_files',
+      type=str,
+      nargs='*',
+      default=list(IGNORE_FILES),
+      help=('Names of the files holding more exclude patterns for the local '
+          'side, which apply to the dir they are in like .gitignore files '
+          'do.'),
+  )
+
+  parser.add_argument(
+      '--large_file_bytes',
+      type=int,
+      default=UPLOAD_LARGE_FILE_BYTES,
+      help=('Files of at least this many bytes are uploaded after all '
+          'smaller ones, letting small files changed meanwhile cut in.'),
+  )
+
+  parser.add_argument(
+      '--max_kb_per_sec',
+      type=int,
+      default=0,
+      help=('Cap in KB/sec on the bytes uploaded over all connections, or '
+          'received from all clients on the remote. 0 means no cap.'),
+  )
+
+  parser.add_argument(
+      '--max_session_kb_per_sec',
+      type=int,
+      default=0,
+      help=('Cap in KB/sec on the bytes uploaded over each single connection. '
+          '0 means no cap.'),
+  )
+
+  parser.add_argument(
+      '--delta_min_bytes',
+      type=int,
+      default=DELTA_MIN_FILE_BYTES,
+      help=('Modified files of at least this many bytes are uploaded as '
+          'block deltas against the remote copy.'),
+  )
+
+  parser.add_argument(
+      '--max_upload_bytes',
+      type=int,
+      default=MAX_UPLOAD_BYTES,
+      help=('Upper bound of file content held in memory and sent in a '
+          'single upload message. Messages that could not fit in one are '
+          'refused, so the remote needs at least the value of its clients.'),
+  )
+
+  parser.add_argument(
+      '--metrics_file',
+      type=str,
+      default='',
+      help=('File a JSON line with all metrics is appended to every '
+          '[metrics_secs] and on exit. Empty disables it.'),
+  )
+
+  parser.add_argument(
+      '--metrics_secs',
+      type=float,
+      default=METRICS_DUMP_SECS,
+      help='Seconds between two lines of the metrics file.',
+  )
+
   args = parser.parse_args()
+  if args.mode != 'stats' and not args.dirs:
+    parser.error('argument -d/--dirs is required')
   return args
 
 
@@ -115,6 +336,50 @@ def md5(*args):
   return md5_hash.hexdigest()
 
 
+def hash_fp(content_hash, fp, count=None):
+  '''Updates [content_hash] with the next [count] bytes of [fp], or all the
+  rest, and returns how many bytes were hashed.
+
+  The bytes go through a single buffer so no string is allocated per read.
+  '''
+  if count == None:
+    count = sys.maxint
+    buffer_bytes = os.fstat(fp.fileno()).st_size
+  else:
+    buffer_bytes = count
+  data = bytearray(max(1, min(buffer_bytes, BUFFER_SIZE_BYTES)))
+  view = memoryview(data)
+  hashed = 0
+  while hashed < count:
+    read = fp.readinto(view[:min(len(data), count - hashed)])
+    if not read:
+      break
+    content_hash.update(view[:read])
+    hashed += read
+  return hashed
+
+
+def stat_mtime_ns(stat):
+  '''Returns the modification time in [stat] as integer nanoseconds.'''
+  mtime_ns = getattr(stat, 'st_mtime_ns', None)
+  if mtime_ns == None:
+    mtime_ns = int(stat.st_mtime * 1000000000)
+  return mtime_ns
+
+
+def hash_file(task):
+  '''Returns (file_path, fingerprint) or (file_path, None) if unreadable.
+
+  Takes a tuple (file_path, fingerprint_name) and is module level so it can
+  be shipped to HashPool worker processes.
+  '''
+  file_path, fingerprint_name = task
+  try:
+    return (file_path, Fingerprint.hash_file(file_path, fingerprint_name))
+  except (IOError, OSError):
+    return (file_path, None)
+
+
 def read_token(args_token):
   prompt_msg = 'Please type the token for the communication: '
   if args_token:
@@ -205,41 +470,156 @@ class AutoShutdown(object):
     self._timer = None
 
 
+class Metrics(object):
+  """ Registry of the counters, gauges and latency histograms of all phases.
+
+  Counters add up, gauges hold the last value set and histograms count
+  durations in LATENCY_BUCKETS_MS. Names are prefixed by the phase they
+  measure, eg, 'crawl.files_hashed'. The process wide registry is METRICS.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._start = time.time()
+    self._counters = {}
+    self._gauges = {}
+    self._histograms = {}
+
+  def increment(self, name, value=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def set_gauge(self, name, value):
+    with self._lock:
+      self._gauges[name] = value
+
+  def record(self, name, secs):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram == None:
+        histogram = LatencyHistogram(name)
+        self._histograms[name] = histogram
+    histogram.record(secs)
+
+  @contextlib.contextmanager
+  def timed(self, name):
+    '''Records how long the with block took in the histogram [name].'''
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.record(name, time.time() - start)
+
+  def snapshot(self):
+    '''Returns all metrics as a dict of JSON types.'''
+    with self._lock:
+      counters = dict(self._counters)
+      gauges = dict(self._gauges)
+      histograms = self._histograms.values()
+    now = time.time()
+    return {
+        'ts': now,
+        'uptime_secs': now - self._start,
+        'counters': counters,
+        'gauges': gauges,
+        'histograms': dict([(histogram.name, histogram.to_dict()) \
+            for histogram in histograms]),
+    }
+
+
+class MetricsDumper(object):
+  """ Appends a JSON line with the snapshot of [metrics] to [path] every
+  [secs] and once more on exit, so they can be charted.
+  """
+  def __init__(self, metrics, path, secs):
+    self.log = Logger(type(self).__name__)
+    self._metrics = metrics
+    self._path = os.path.expanduser(path) if path else None
+    self._secs = secs
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def __enter__(self):
+    if self._path:
+      self.log.info('Dumping metrics to [{}] every [{}] secs.'.format(
+          self._path, self._secs))
+      self._thread = threading.Thread(target=self._run, name='MetricsDumper')
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self._thread:
+      self._stopped.set()
+      self._thread.join()
+      self._thread = None
+      self.dump()
+
+  def _run(self):
+    while not self._stopped.wait(self._secs):
+      self.dump()
+
+  def dump(self):
+    try:
+      with open(self._path, 'a') as fp:
+        fp.write(json.dumps(self._metrics.snapshot(), sort_keys=True) + '\n')
+    except (IOError, OSError) as exception:
+      self.log.warn('Failed to dump metrics to [{}]: [{}].'.format(
+          self._path, exception))
+
+
 class StreamHandler(object):
-  def __init__(self, token, socket):
+  def __init__(self, token, socket, buckets=(), max_body_bytes=None):
     self.log = Logger(type(self).__name__)
     self._socket = socket
-    self._buffer = ''
-    self._serde = MessageSerde(token)
+    self._serde = MessageSerde(token, max_body_bytes)
+    # TokenBuckets capping the rate messages are sent at.
+    self._buckets = [bucket for bucket in buckets if bucket]
 
   def __enter__(self):
     self.log.debug('Entering...')
     return self
 
   def recvMessage(self):
+    """ Reads the header once and then the body straight into its buffer """
     self.log.debug('Receiving message...')
-    while True:
-      data = self._socket.recv(BUFFER_SIZE_BYTES)
-      datal = len(data)
+    header = self._recv_exactly(MessageSerde.HEADER_BYTES)
+    start = time.time()
+    msg_type, request_id, body_md5, body_bytes = \
+        self._serde.parse_header(str(header))
+    body = self._recv_exactly(body_bytes)
+    frames = []
+    message = self._serde.deserialise_body(
+        msg_type, request_id, body_md5, body, frames)
+    for blob, frame_md5 in frames:
+      self._recv_into(blob.data)
+      body_bytes += len(blob)
+      MessageSerde.check_frame(blob, frame_md5)
+    METRICS.record('network.recv_secs', time.time() - start)
+    METRICS.increment('network.bytes_received',
+        MessageSerde.HEADER_BYTES + body_bytes)
+    self.log.debug('Received message_type=[{}] request_id=[{}] '
+        'body_bytes=[{}].'.format(message.type_str(), request_id, body_bytes))
+    return message
+
+  def _recv_exactly(self, total_bytes):
+    """ Returns a bytearray with exactly total_bytes read from the socket """
+    data = bytearray(total_bytes)
+    self._recv_into(data)
+    return data
+
+  def _recv_into(self, data):
+    """ Fills the bytearray data with bytes read from the socket """
+    total_bytes = len(data)
+    view = memoryview(data)
+    received = 0
+    while received < total_bytes:
+      datal = self._socket.recv_into(view[received:])
       if datal == 0:
         msg = 'Remote client disconnected.'
         self.log.debug(msg)
         raise socket.error(msg)
-      elif datal > 0:
-        self.log.debug('Received [{}] bytes.'.format(datal))
-        self._buffer += data
-        message, unused = self._serde.deserialise(self._buffer)
-        unused_bytes = len(unused)
-        used_bytes = len(self._buffer) - unused_bytes
-        self._buffer = unused
-        if message == None:
-          continue
-        self.log.debug(
-            'Received message_type=[{}] used_bytes=[{}] unused_bytes=[{}].'\
-                .format(message.type_str(), used_bytes, unused_bytes))
-        return message
-      else:
-        assert False, 'Should never get here!!! recv_bytes=[{}]'.format(datal)
+      self.log.debug('Received [{}] bytes.'.format(datal))
+      received += datal
 
   def __exit__(self, exc_type, exc_value, traceback):
     self.log.debug('Exiting...')
@@ -247,11 +627,37 @@ class StreamHandler(object):
       self._socket.close()
       self._socket = None
 
+  def set_wire_format(self, wire_format):
+    self.log.debug('Switching to wire_format=[{}].'.format(wire_format))
+    self._serde.set_wire_format(wire_format)
+
   def sendMessage(self, message):
-    data = self._serde.serialise(message)
-    self.log.debug('Sending message of type [{}] and size [{}] bytes...'\
-        .format(message.type_str(), len(data)))
-    self._socket.sendall(data)
+    frames = []
+    data = self._serde.serialise(message, frames)
+    try:
+      self.log.debug('Sending message of type [{}] and size [{}] bytes...'\
+          .format(message.type_str(), len(data)))
+      with METRICS.timed('network.send_secs'):
+        self._send(data)
+        for frame in frames:
+          frame.send(self._socket, self._buckets)
+      METRICS.increment('network.bytes_sent',
+          len(data) + sum([len(frame) for frame in frames]))
+    finally:
+      for frame in frames:
+        frame.close()
+
+  def _send(self, data):
+    if not self._buckets:
+      self._socket.sendall(data)
+      return
+    # Sending a burst at a time keeps the remote from seeing an idle socket.
+    view = memoryview(data)
+    burst = min([bucket.burst for bucket in self._buckets])
+    for offset in xrange(0, len(data), burst):
+      piece = view[offset:offset + burst]
+      TokenBucket.consume(self._buckets, len(piece))
+      self._socket.sendall(piece)
 
 
 class MessageType(object):
@@ -262,6 +668,12 @@ class MessageType(object):
   DIFF_RESPONSE = 3
   UPLOAD_REQUEST = 4
   UPLOAD_RESPONSE = 5
+  SIGNATURE_REQUEST = 6
+  SIGNATURE_RESPONSE = 7
+  TREE_REQUEST = 8
+  TREE_RESPONSE = 9
+  STATS_REQUEST = 10
+  STATS_RESPONSE = 11
 
   @staticmethod
   def to_str(type_int):
@@ -278,6 +690,18 @@ class MessageType(object):
       return 'UPLOAD_REQUEST'
     elif type_int == MessageType.UPLOAD_RESPONSE:
       return 'UPLOAD_RESPONSE'
+    elif type_int == MessageType.SIGNATURE_REQUEST:
+      return 'SIGNATURE_REQUEST'
+    elif type_int == MessageType.SIGNATURE_RESPONSE:
+      return 'SIGNATURE_RESPONSE'
+    elif type_int == MessageType.TREE_REQUEST:
+      return 'TREE_REQUEST'
+    elif type_int == MessageType.TREE_RESPONSE:
+      return 'TREE_RESPONSE'
+    elif type_int == MessageType.STATS_REQUEST:
+      return 'STATS_REQUEST'
+    elif type_int == MessageType.STATS_RESPONSE:
+      return 'STATS_RESPONSE'
     else:
       return 'UNKNOWN'
 
@@ -289,142 +713,2057 @@ class MessageType(object):
 class Message(object):
   def __init__(self, message_type):
     self.type = message_type
+    # Responses carry the request_id of the request they answer.
+    self.request_id = 0
     self.body = {}
     self.body['ts'] = time.time()
 
   def __str__(self):
     return 'Message(type=[{}] body=[{}])'\
-        .format(self.type_str(), json.dumps(self.body))
+        .format(self.type_str(), json.dumps(self.body, default=repr))
 
   def type_str(self):
     return MessageType.to_pretty_str(self.type)
 
 
+class Blob(object):
+  """ Raw bytes carried inside a Message body (eg, file contents).
+
+  Each wire format decides how to encode them: base64 in JSON and raw byte
+  frames in the binary format. The data of a raw frame that did not match
+  its md5 is None.
+  """
+  __slots__ = ('data',)
+
+  def __init__(self, data):
+    self.data = data
+
+  def __len__(self):
+    return 0 if self.data is None else len(self.data)
+
+  def __eq__(self, other):
+    return type(other) == Blob and self.data == other.data
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'Blob([{}] bytes)'.format(len(self))
+
+
+class FileRange(object):
+  """ [count] bytes of a file from [offset] on carried inside a Message body.
+
+  The binary wire format sends them as a raw frame after the body, straight
+  from the file with sendfile(2), so they are never copied into Python. The
+  body only holds their length and md5. A duplicate of the file descriptor
+  keeps the file open until the frame has been sent.
+  The md5 and the frame read the file separately, so a file written in
+  between makes the remote discard the frame, and with it only the upload
+  of that file. A file that shrank is padded with zeros to keep the stream
+  in step.
+  """
+  __slots__ = ('fp', 'name', 'offset', 'count', '_version')
+  _libc = None
+
+  def __init__(self, fp, offset, count):
+    self.fp = os.fdopen(os.dup(fp.fileno()), 'rb')
+    self.name = fp.name
+    self.offset = offset
+    self.count = count
+    self._version = self._stat_version()
+
+  def __len__(self):
+    return self.count
+
+  def __repr__(self):
+    return 'FileRange([{}] bytes at [{}])'.format(self.count, self.offset)
+
+  def close(self):
+    self.fp.close()
+
+  def md5(self):
+    '''Returns the md5 of the range, of what is left of it if it shrank.'''
+    self.fp.seek(self.offset)
+    content_hash = hashlib.md5()
+    hash_fp(content_hash, self.fp, self.count)
+    return content_hash.hexdigest()
+
+  def _stat_version(self):
+    stat = os.fstat(self.fp.fileno())
+    return (stat.st_size, stat_mtime_ns(stat))
+
+  @staticmethod
+  def _load_libc():
+    if FileRange._libc == None and sys.platform.startswith('linux'):
+      try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_size_t]
+        libc.sendfile.restype = ctypes.c_ssize_t
+        FileRange._libc = libc
+      except (OSError, AttributeError):
+        pass
+    return FileRange._libc
+
+  def send(self, sock, buckets=()):
+    '''Sends the range over [sock], a burst at a time if [buckets] cap the
+    rate. Without sendfile(2) the bytes go through a single buffer.
+    '''
+    libc = FileRange._load_libc()
+    piece_bytes = min([bucket.burst for bucket in buckets] + \
+        [16 * BUFFER_SIZE_BYTES])
+    data = None
+    shrank = False
+    sent = 0
+    while sent < self.count:
+      count = min(piece_bytes, self.count - sent)
+      TokenBucket.consume(buckets, count)
+      if shrank:
+        sock.sendall(bytearray(count))
+      elif libc != None:
+        count = self._sendfile(libc, sock, self.offset + sent, count)
+        if count == None:
+          libc = None
+          continue
+      else:
+        if data == None:
+          data = memoryview(bytearray(min(piece_bytes, BUFFER_SIZE_BYTES)))
+        self.fp.seek(self.offset + sent)
+        count = self.fp.readinto(data[:min(len(data), count)])
+        sock.sendall(data[:count])
+      if count == 0:
+        shrank = True
+        continue
+      sent += count
+    if shrank or self._stat_version() != self._version:
+      LOG.warn(('File [{}] changed while [{}] bytes of it were sent. The '
+          'remote discards them if they no longer match.').format(
+              self.name, self.count))
+      METRICS.increment('upload.changed_frames')
+
+  def _sendfile(self, libc, sock, offset, count):
+    '''Returns the bytes sendfile(2) sent or None if it does not support
+    the file.
+    '''
+    position = ctypes.c_int64(offset)
+    while True:
+      sent = libc.sendfile(sock.fileno(), self.fp.fileno(),
+          ctypes.byref(position), count)
+      if sent >= 0:
+        return sent
+      error_number = ctypes.get_errno()
+      if error_number in SENDFILE_FALLBACK_ERRNOS:
+        return None
+      if error_number == errno.EINTR:
+        continue
+      if error_number not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise socket.error(error_number, os.strerror(error_number))
+      # Sockets with a timeout are non-blocking underneath.
+      if not select.select([], [sock], [], sock.gettimeout())[1]:
+        raise socket.timeout('timed out')
+
+
+class BinaryCodec(object):
+  """ Compact tagged encoding of Message bodies.
+
+  Every value is a one byte tag followed by a fixed size or length prefixed
+  payload. Blobs are copied as raw byte frames, 32 char hex digests are
+  packed into 16 bytes and file indexes (dicts of path => (mtime, md5)) are
+  written as a count followed by length prefixed records. FileRanges are
+  written as their length and md5 while their bytes follow the body as
+  raw frames.
+  """
+  VERSION = 1
+  NONE = 'N'
+  TRUE = 'T'
+  FALSE = 'F'
+  INT = 'i'
+  FLOAT = 'd'
+  TEXT = 's'
+  DIGEST = 'h'
+  BLOB = 'b'
+  LIST = 'l'
+  DICT = 'm'
+  INDEX = 'x'
+  FRAME = 'f'
+  HEX_DIGEST_RE = re.compile(r'^[0-9a-f]{32}$')
+
+  def encode(self, obj, frames=None):
+    '''Returns [obj] encoded, appending to [frames] the FileRanges to send
+    after it in order.
+    '''
+    out = [chr(BinaryCodec.VERSION)]
+    self._encode(obj, out, frames)
+    return ''.join(out)
+
+  def decode(self, data, frames=None):
+    '''Returns the object in [data], appending to [frames] a tuple (blob,
+    md5) per raw frame that follows it with a Blob to receive it into.
+    '''
+    version = ord(data[0])
+    if version != BinaryCodec.VERSION:
+      raise HumaReadbleException(
+          'Unsupported binary wire format version [{}].'.format(version))
+    obj, offset = self._decode(data, 1, frames)
+    assert offset == len(data), (offset, len(data))
+    return obj
+
+  def _encode(self, obj, out, frames):
+    obj_type = type(obj)
+    if obj is None:
+      out.append(BinaryCodec.NONE)
+    elif obj_type == bool:
+      out.append(BinaryCodec.TRUE if obj else BinaryCodec.FALSE)
+    elif obj_type in (int, long):
+      out.append(BinaryCodec.INT + struct.pack('>q', obj))
+    elif obj_type == float:
+      out.append(BinaryCodec.FLOAT + struct.pack('>d', obj))
+    elif obj_type in (str, unicode):
+      if BinaryCodec._is_digest(obj):
+        out.append(BinaryCodec.DIGEST + binascii.unhexlify(obj))
+      else:
+        text = obj.encode('utf-8') if obj_type == unicode else obj
+        out.append(BinaryCodec.TEXT + struct.pack('>I', len(text)))
+        out.append(text)
+    elif obj_type == Blob:
+      out.append(BinaryCodec.BLOB + struct.pack('>Q', len(obj.data)))
+      out.append(obj.data)
+    elif obj_type == FileRange and frames != None:
+      out.append(BinaryCodec.FRAME + struct.pack('>Q', obj.count) + \
+          binascii.unhexlify(obj.md5()))
+      frames.append(obj)
+    elif obj_type in (list, tuple):
+      out.append(BinaryCodec.LIST + struct.pack('>I', len(obj)))
+      for item in obj:
+        self._encode(item, out, frames)
+    elif obj_type == dict and BinaryCodec._is_index(obj):
+      out.append(BinaryCodec.INDEX + struct.pack('>I', len(obj)))
+      pack = struct.pack
+      unhexlify = binascii.unhexlify
+      for path, (mtime, md5_hash) in obj.iteritems():
+        if type(path) == unicode:
+          path = path.encode('utf-8')
+        out.append(pack('>H', len(path)) + path + pack('>d', mtime) + \
+            unhexlify(md5_hash))
+    elif obj_type == dict:
+      out.append(BinaryCodec.DICT + struct.pack('>I', len(obj)))
+      for key, value in obj.iteritems():
+        self._encode(key, out, frames)
+        self._encode(value, out, frames)
+    else:
+      raise TypeError('Cannot binary encode type [{}].'.format(obj_type))
+
+  def _decode(self, data, offset, frames):
+    tag = data[offset]
+    offset += 1
+    if tag == BinaryCodec.NONE:
+      return (None, offset)
+    elif tag == BinaryCodec.TRUE:
+      return (True, offset)
+    elif tag == BinaryCodec.FALSE:
+      return (False, offset)
+    elif tag == BinaryCodec.INT:
+      return (struct.unpack_from('>q', data, offset)[0], offset + 8)
+    elif tag == BinaryCodec.FLOAT:
+      return (struct.unpack_from('>d', data, offset)[0], offset + 8)
+    elif tag == BinaryCodec.TEXT:
+      length = struct.unpack_from('>I', data, offset)[0]
+      offset += 4
+      return (data[offset:offset + length].decode('utf-8'), offset + length)
+    elif tag == BinaryCodec.DIGEST:
+      return (binascii.hexlify(data[offset:offset + 16]), offset + 16)
+    elif tag == BinaryCodec.BLOB:
+      length = struct.unpack_from('>Q', data, offset)[0]
+      offset += 8
+      return (Blob(data[offset:offset + length]), offset + length)
+    elif tag == BinaryCodec.FRAME and frames != None:
+      length = struct.unpack_from('>Q', data, offset)[0]
+      blob = Blob(bytearray(length))
+      frames.append((blob, binascii.hexlify(data[offset + 8:offset + 24])))
+      return (blob, offset + 24)
+    elif tag == BinaryCodec.LIST:
+      count = struct.unpack_from('>I', data, offset)[0]
+      offset += 4
+      items = []
+      for i in xrange(count):
+        item, offset = self._decode(data, offset, frames)
+        items.append(item)
+      return (items, offset)
+    elif tag == BinaryCodec.DICT:
+      count = struct.unpack_from('>I', data, offset)[0]
+      offset += 4
+      result = {}
+      for i in xrange(count):
+        key, offset = self._decode(data, offset, frames)
+        value, offset = self._decode(data, offset, frames)
+        result[key] = value
+      return (result, offset)
+    elif tag == BinaryCodec.INDEX:
+      count = struct.unpack_from('>I', data, offset)[0]
+      offset += 4
+      result = {}
+      hexlify = binascii.hexlify
+      unpack_from = struct.unpack_from
+      for i in xrange(count):
+        length = unpack_from('>H', data, offset)[0]
+        offset += 2 + length
+        path = data[offset - length:offset].decode('utf-8')
+        mtime = unpack_from('>d', data, offset)[0]
+        result[path] = [mtime, hexlify(data[offset + 8:offset + 24])]
+        offset += 24
+      return (result, offset)
+    else:
+      raise HumaReadbleException(
+          'Unknown binary wire format tag [{}].'.format(repr(tag)))
+
+  @staticmethod
+  def _is_digest(text):
+    return len(text) == 32 and BinaryCodec.HEX_DIGEST_RE.match(text) != None
+
+  @staticmethod
+  def _is_index(obj):
+    if not obj:
+      return False
+    for value in obj.itervalues():
+      if type(value) not in (list, tuple) or len(value) != 2 or \
+          type(value[0]) not in (int, long, float) or \
+          type(value[1]) not in (str, unicode) or \
+          not BinaryCodec._is_digest(value[1]):
+        return False
+    return True
+
+
 class MessageSerde(object):
-  def __init__(self, token):
+  HEADER_FORMAT = '>ii32si'
+  HEADER_BYTES = struct.calcsize(HEADER_FORMAT)
+
+  def __init__(self, token, max_body_bytes=None):
     self.log = Logger(type(self).__name__)
     self._token = token
+    # Bodies are only authenticated once received, so their size is capped
+    # before a buffer for them is allocated.
+    self._max_body_bytes = max_body_bytes
+    self._wire_format = WIRE_FORMAT_JSON
+    self._codec = BinaryCodec()
+
+  def set_wire_format(self, wire_format):
+    assert wire_format in WIRE_FORMATS, wire_format
+    self._wire_format = wire_format
+
+  def serialise(self, message, frames=None):
+    """ Returns a list of bytes containing the serialised msg
+
+    The FileRanges in the body are appended to [frames] if it is a list, to
+    be sent after these bytes as raw frames.
+    """
+    with METRICS.timed('serde.serialise_secs'):
+      body = self._encode_body(message.body, frames)
+    body_md5 = self._md5(body)
+    body_bytes = len(body)
+    header = struct.pack(MessageSerde.HEADER_FORMAT, message.type,
+        message.request_id, body_md5, body_bytes)
+    return header + body
+
+  def parse_header(self, header):
+    """ Returns a tuple (msg_type, request_id, body_md5, body_bytes) """
+    msg_type, request_id, body_md5, body_bytes = \
+        struct.unpack(MessageSerde.HEADER_FORMAT, header)
+    if body_bytes < 0 or (self._max_body_bytes != None and \
+        body_bytes > self._max_body_bytes):
+      raise HumaReadbleException(
+          'Invalid message body size [{}].'.format(body_bytes))
+    return (msg_type, request_id, body_md5, body_bytes)
+
+  @staticmethod
+  def max_body_bytes(max_upload_bytes):
+    '''Returns the largest body of a message with up to [max_upload_bytes]
+    of file content, which base64 grows by a third in JSON.
+    '''
+    return 2 * max_upload_bytes + MESSAGE_OVERHEAD_BYTES
+
+  def deserialise_body(self, msg_type, request_id, body_md5, body,
+      frames=None):
+    """ Returns the Message for a complete body (str or bytearray)
+
+    The raw frames that follow the body are appended to [frames] if it is a
+    list, as tuples (blob, md5) to receive them into and check them with.
+    """
+    expected_md5 = self._md5(body)
+    if body_md5 != expected_md5:
+      err = 'Server aborting! Expected_MD5=[{}] Actual_MD5=[{}]'\
+          .format(expected_md5, body_md5)
+      self.log.error(err)
+      raise HumaReadbleException(err)
+    message = Message(msg_type)
+    message.request_id = request_id
+    with METRICS.timed('serde.deserialise_secs'):
+      message.body.update(self._decode_body(str(body), frames))
+    return message
+
+  @staticmethod
+  def check_frame(blob, frame_md5):
+    '''Drops the data of the raw frame received into [blob] if it does not
+    match its md5.
 
-  def serialise(self, message):
-    """ Returns a list of bytes containing the serialised msg """
-    json_body = json.dumps(message.body)
-    body_md5 = self._md5(json_body)
-    body_bytes = len(json_body)
-    header = struct.pack('>i32si', message.type, body_md5, body_bytes)
-    return header + json_body
+    The md5 travels in the signed body so it vouches for the frame. The
+    frame still had the length the body announced, so the stream is in step
+    and only the file it belongs to is lost, usually because it was written
+    to while being sent.
+    '''
+    if hashlib.md5(blob.data).hexdigest() != frame_md5:
+      LOG.warn(('Raw frame of [{}] bytes does not match its md5. '
+          'Discarding it.').format(len(blob)))
+      METRICS.increment('upload.discarded_frames')
+      blob.data = None
 
   def deserialise(self, input):
     """ Returns a tuple (Message, UnusedBytesList) """
     self.log.debug('Deserialising input of [{}] bytes...'.format(len(input)))
-    header_bytes = 4 + 32 + 4
+    header_bytes = MessageSerde.HEADER_BYTES
     if len(input) < header_bytes:
       return (None, input)
-    msg_type, body_md5, body_bytes = \
-        struct.unpack('>i32si', input[0:header_bytes])
+    msg_type, request_id, body_md5, body_bytes = \
+        self.parse_header(input[0:header_bytes])
     total_bytes = header_bytes + body_bytes
     if len(input) < total_bytes:
       return (None, input)
-    json_body = input[header_bytes:total_bytes]
-    expected_md5 = self._md5(json_body)
-    if body_md5 != expected_md5:
-      err = 'Server aborting! Expected_MD5=[{}] Actual_MD5=[{}]'\
-          .format(expected_md5, body_md5)
-      self.log.error(err)
-      raise HumaReadbleException(err)
-    message = Message(msg_type)
-    message.body.update(json.loads(json_body))
+    message = self.deserialise_body(
+        msg_type, request_id, body_md5, input[header_bytes:total_bytes])
     return (message, input[total_bytes:])
 
+  def _encode_body(self, body, frames):
+    if self._wire_format == WIRE_FORMAT_BINARY:
+      return self._codec.encode(body, frames)
+    return json.dumps(body, default=MessageSerde._json_default)
+
+  def _decode_body(self, body, frames):
+    if self._wire_format == WIRE_FORMAT_BINARY:
+      return self._codec.decode(body, frames)
+    return json.loads(body, object_hook=MessageSerde._json_object_hook)
+
+  @staticmethod
+  def _json_default(obj):
+    if type(obj) == Blob:
+      return {JSON_BLOB_KEY: base64.b64encode(obj.data)}
+    raise TypeError('Cannot JSON encode type [{}].'.format(type(obj)))
+
+  @staticmethod
+  def _json_object_hook(obj):
+    if len(obj) == 1 and JSON_BLOB_KEY in obj:
+      return Blob(base64.b64decode(obj[JSON_BLOB_KEY]))
+    return obj
+
   def _md5(self, data):
     return md5(os.getenv('USER'), data, self._token)
 
 
-class DirCrawler(object):
-  def __init__(self, root_dir, exclude_list=[]):
-    self.log = Logger(type(self).__name__)
-    self._dir = root_dir
-    self._dir = os.path.expanduser(self._dir)
-    self._dir = os.path.abspath(self._dir)
-    assert os.path.isdir(self._dir), \
-        'Argument root_dir [{}] => [{}] must exist.'.format(root_dir, self._dir)
-    self._excludes = [re.compile(pattern) for pattern in exclude_list]
+class Fingerprint(object):
+  """ Strategies to fingerprint files for change detection.
 
-  def crawl(self):
-    '''Returns a list of relative paths of all files recursively.'''
-    self.log.debug('Starting to crawl [{}]...'.format(self._dir))
-    all_files = []
-    for root, dirs, files in os.walk(self._dir):
-      for f in files:
-        complete_path = os.path.join(root, f)
-        rel_path = os.path.relpath(complete_path, self._dir)
-        if not self._is_excluded(rel_path):
-          assert not os.path.isabs(rel_path), rel_path
-          all_files.append(rel_path)
-    self.log.debug(
-        'Crawl found a total of [{}] files...'.format(len(all_files)))
-    return all_files
+  Content fingerprints hash every byte and are truncated to 128 bits so
+  they all fit the same index entries and wire records. The stat
+  fingerprint trusts size plus mtime like rsync's quick check and never
+  reads file contents, relying on the remote preserving uploaded mtimes,
+  except for recently modified files as explained in DirCrawler._hash_paths.
+  Either way a file is only fingerprinted again when its size, mtime or
+  inode change.
+  """
+  MD5 = 'md5'
+  SHA1 = 'sha1'
+  SHA256 = 'sha256'
+  BLAKE2B = 'blake2b'
+  STAT = 'stat'
 
-  def crawl_and_hash(self, previous_results={}):
-    '''Returns a dict with keyed off file_rel_path with md5_hash information.
+  @staticmethod
+  def available():
+    names = [Fingerprint.MD5, Fingerprint.SHA1, Fingerprint.SHA256]
+    if Fingerprint._blake2b_factory() != None:
+      names.append(Fingerprint.BLAKE2B)
+    names.append(Fingerprint.STAT)
+    return tuple(names)
 
-    Each dict key refers to the relative path of a file.
-    Each dict value contains a tuple with two elements:
-    1. Epoch modified time.
-    2. MD5 hash of the contents of the file.
+  @staticmethod
+  def _blake2b_factory():
+    if hasattr(hashlib, 'blake2b'):
+      return lambda: hashlib.blake2b(digest_size=16)
+    try:
+      hashlib.new('blake2b512')
+      return lambda: hashlib.new('blake2b512')
+    except ValueError:
+      return None
+
+  @staticmethod
+  def hash_file(file_path, name):
+    '''Hashes the contents of [file_path], with md5 for stat fingerprints.'''
+    if name == Fingerprint.BLAKE2B:
+      content_hash = Fingerprint._blake2b_factory()()
+    elif name == Fingerprint.STAT:
+      content_hash = hashlib.md5()
+    else:
+      content_hash = hashlib.new(name)
+    with open(file_path, 'rb') as f:
+      hash_fp(content_hash, f)
+    return content_hash.hexdigest()[:32]
+
+  @staticmethod
+  def from_stat(stat):
+    return md5('{}:{}'.format(
+        stat.st_size, Fingerprint._mtime_us(stat.st_mtime)))
+
+  @staticmethod
+  def set_mtime(file_path, mtime):
+    '''Sets the mtime of [file_path] so its stat fingerprint matches [mtime].
+
+    utime() truncates to microseconds so half of one is added to land on the
+    microsecond that from_stat() rounds to despite float errors.
     '''
-    all_files = self.crawl()
-    self.log.debug('Computing the md5 hash for [{}] files...'\
-        .format(len(all_files)))
-    data = {}
-    computed_md5s = 0
-    reused_md5s = 0
-    for rel_path in all_files:
-      abs_path = os.path.join(self._dir, rel_path)
-      mtime = os.path.getmtime(abs_path)
-      if rel_path in previous_results and \
-          previous_results[rel_path][0] >= mtime:
-        reused_md5s += 1
-        data[rel_path] = previous_results[rel_path]
-      else:
-        md5 = DirCrawler.md5_hash(abs_path)
-        computed_md5s += 1
-        data[rel_path] = (mtime, md5)
-    self.log.info('Finished computing all [{}] md5s and reused [{}].'.format(
-        computed_md5s, reused_md5s))
-    return data
+    mtime_us = Fingerprint._mtime_us(mtime)
+    os.utime(file_path, (time.time(), (mtime_us + 0.5) / 1000000.0))
 
   @staticmethod
-  def md5_hash(file_path):
-    md5_hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-      for fragment in iter(lambda: f.read(BUFFER_SIZE_BYTES), b''):
-        md5_hash.update(fragment)
-    return md5_hash.hexdigest()
+  def _mtime_us(mtime):
+    return int(round(mtime * 1000000))
 
-  def _is_excluded(self, path):
-    for regex in self._excludes:
-      if None != regex.match(path):
-        # print path
-        return True
-    return False
 
+class HashPool(object):
+  """ Hashes files concurrently in worker threads or processes.
 
-class DirMonitor(object):
-  def __init__(self, root_dirs):
+  hashlib releases the GIL while hashing large buffers so threads scale
+  well on fast disks. Processes also parallelise the small-file overhead.
+  """
+  def __init__(self, workers=1, use_processes=False):
     self.log = Logger(type(self).__name__)
-    self.dirs = root_dirs
-    self._crawlers = []
-    for root in root_dirs:
-      self._crawlers.append(DirCrawler(root))
-    self.files = [list() for i in range(len(self._crawlers))]
-    self._crawl_all()
+    self._pool = None
+    self._chunksize = 1
+    if workers > 1 and use_processes:
+      self._pool = multiprocessing.Pool(workers)
+      self._chunksize = HASH_PROCESS_CHUNKSIZE
+    elif workers > 1:
+      self._pool = multiprocessing.pool.ThreadPool(workers)
+    self.log.debug('Hashing with [{}] {}.'.format(
+        workers, 'processes' if use_processes else 'threads'))
 
-  def get_dirs(self):
+  def hash_files(self, file_paths, fingerprint_name=Fingerprint.MD5):
+    '''Yields tuples (file_path, fingerprint) in completion order.'''
+    tasks = [(file_path, fingerprint_name) for file_path in file_paths]
+    if self._pool == None:
+      for task in tasks:
+        yield hash_file(task)
+    else:
+      for result in self._pool.imap_unordered(
+          hash_file, tasks, self._chunksize):
+        yield result
+
+  def close(self):
+    if self._pool:
+      self._pool.terminate()
+      self._pool = None
+
+
+class CompactIndex(object):
+  """ A file index packed into flat arrays.
+
+  Maps relative paths to index entries like the dict it replaces at a
+  fraction of the memory. Each dir name is stored once together with the
+  sorted names of its files concatenated into a single string, which
+  lookups bisect, fingerprints are packed into 16 bytes and mtimes, sizes
+  and inodes live in typed arrays. This packed base never changes once
+  built so copies share it and only duplicate the overlay dict of entries
+  set or deleted since, which gets folded into a new base once it outgrows
+  an eighth of the index. Entries that do not fit the columns, like those
+  whose fingerprint is not a 32 char hex digest, just stay in the overlay.
+  """
+  # Stands for None in the stat columns, which are as wide as a C long.
+  MISSING = -(2 ** (8 * array.array('l').itemsize - 1))
+  STAT_COLUMNS = ('sizes', 'mtimes_ns', 'inodes')
+
+  def __init__(self, items=()):
+    self._base = CompactIndex._empty_base(None)
+    # rel_path => entry, or None if deleted from the base.
+    self._overlay = {}
+    # rel_dir => set(names) of the paths in the overlay.
+    self._overlay_dirs = {}
+    self._overlay_fingerprints = None
+    # A tuple (rel_dir, {name: entry}) of the last dir_items() as crawls
+    # look up the files of a dir right after listing it.
+    self._dir_cache = None
+    self._compact_at = COMPACT_INDEX_MIN_OVERLAY
+    if hasattr(items, 'iteritems'):
+      items = items.iteritems()
+    for rel_path, entry in items:
+      self._overlay[CompactIndex._key(rel_path)] = entry
+    self._len = len(self._overlay)
+    self.compact()
+
+  @staticmethod
+  def copy_of(index):
+    '''Returns a CompactIndex copy of the CompactIndex or dict [index].'''
+    if isinstance(index, CompactIndex):
+      return index.copy()
+    return CompactIndex(index)
+
+  def __len__(self):
+    return self._len
+
+  def __contains__(self, rel_path):
+    return self.get(rel_path) is not None
+
+  def __getitem__(self, rel_path):
+    entry = self.get(rel_path)
+    if entry is None:
+      raise KeyError(rel_path)
+    return entry
+
+  def __setitem__(self, rel_path, entry):
+    rel_path = CompactIndex._key(rel_path)
+    previous = self.get(rel_path)
+    if previous == entry:
+      return
+    if previous is None:
+      self._len += 1
+    self._set_overlay(rel_path, entry)
+
+  def __delitem__(self, rel_path):
+    rel_path = CompactIndex._key(rel_path)
+    if rel_path not in self:
+      raise KeyError(rel_path)
+    self._len -= 1
+    if self._base_row(rel_path) is None:
+      del self._overlay[rel_path]
+      rel_dir, unused, name = rel_path.rpartition(os.sep)
+      self._overlay_dirs[rel_dir].discard(name)
+      self._overlay_fingerprints = None
+      if self._dir_cache != None and self._dir_cache[0] == rel_dir:
+        self._dir_cache[1].pop(name, None)
+    else:
+      self._set_overlay(rel_path, None)
+
+  def __iter__(self):
+    return self.iterkeys()
+
+  def __eq__(self, other):
+    if not hasattr(other, 'get') or len(self) != len(other):
+      return False
+    if isinstance(other, CompactIndex) and other._base is self._base:
+      keys = set(self._overlay).union(other._overlay)
+    else:
+      keys = self.iterkeys()
+    for rel_path in keys:
+      if self.get(rel_path) != other.get(rel_path):
+        return False
+    return True
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'CompactIndex({})'.format(dict(self.iteritems()))
+
+  def get(self, rel_path, default=None):
+    rel_path = CompactIndex._key(rel_path)
+    dir_cache = self._dir_cache
+    if dir_cache != None:
+      rel_dir, unused, name = rel_path.rpartition(os.sep)
+      if rel_dir == dir_cache[0]:
+        return dir_cache[1].get(name, default)
+    if rel_path in self._overlay:
+      entry = self._overlay[rel_path]
+      return default if entry is None else entry
+    row = self._base_row(rel_path)
+    return default if row is None else CompactIndex._entry(self._base, row)
+
+  def pop(self, rel_path, default=None):
+    entry = self.get(rel_path)
+    if entry is None:
+      return default
+    del self[rel_path]
+    return entry
+
+  def update(self, items):
+    if hasattr(items, 'iteritems'):
+      items = items.iteritems()
+    for rel_path, entry in items:
+      self[rel_path] = entry
+
+  def copy(self):
+    '''Returns a copy sharing the packed base with this index.'''
+    result = CompactIndex()
+    result._base = self._base
+    result._overlay = dict(self._overlay)
+    result._overlay_dirs = dict((rel_dir, set(names)) \
+        for rel_dir, names in self._overlay_dirs.iteritems() if names)
+    result._len = self._len
+    result._compact_at = self._compact_at
+    return result
+
+  def iteritems(self):
+    base = self._base
+    for dir_id in xrange(len(base['dirs'])):
+      rel_dir = base['dirs'][dir_id]
+      overlay_names = self._overlay_dirs.get(rel_dir, ())
+      for row in xrange(base['dir_rows'][dir_id], base['dir_rows'][dir_id + 1]):
+        name = CompactIndex._name(base, dir_id, row)
+        if name not in overlay_names:
+          yield (os.path.join(rel_dir, name), CompactIndex._entry(base, row))
+    for rel_path, entry in self._overlay.iteritems():
+      if entry is not None:
+        yield (rel_path, entry)
+
+  def iterkeys(self):
+    for rel_path, entry in self.iteritems():
+      yield rel_path
+
+  def itervalues(self):
+    for rel_path, entry in self.iteritems():
+      yield entry
+
+  def items(self):
+    return list(self.iteritems())
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def dir_items(self, rel_dir):
+    '''Returns a sorted list of (name, entry) of the files in [rel_dir].'''
+    rel_dir = CompactIndex._key(rel_dir)
+    base = self._base
+    items = []
+    overlay_names = self._overlay_dirs.get(rel_dir, ())
+    dir_id = base['dir_ids'].get(rel_dir)
+    if dir_id != None:
+      for row in xrange(base['dir_rows'][dir_id], base['dir_rows'][dir_id + 1]):
+        name = CompactIndex._name(base, dir_id, row)
+        if name not in overlay_names:
+          items.append((name, CompactIndex._entry(base, row)))
+    for name in overlay_names:
+      entry = self._overlay[os.path.join(rel_dir, name)]
+      if entry is not None:
+        items.append((name, entry))
+    items.sort()
+    self._dir_cache = (rel_dir, dict(items))
+    return items
+
+  def has_dir(self, rel_dir):
+    '''Returns whether any file is right in [rel_dir].'''
+    rel_dir = CompactIndex._key(rel_dir)
+    overlay_names = self._overlay_dirs.get(rel_dir, ())
+    for name in overlay_names:
+      if self._overlay[os.path.join(rel_dir, name)] is not None:
+        return True
+    base = self._base
+    dir_id = base['dir_ids'].get(rel_dir)
+    if dir_id == None:
+      return False
+    for row in xrange(base['dir_rows'][dir_id], base['dir_rows'][dir_id + 1]):
+      if CompactIndex._name(base, dir_id, row) not in overlay_names:
+        return True
+    return False
+
+  def dirs(self):
+    '''Returns the set of dirs with files right in them.'''
+    return set([rel_dir for rel_dir in \
+        set(self._base['dirs']).union(self._overlay_dirs) \
+            if self.has_dir(rel_dir)])
+
+  def keys_under(self, rel_dir):
+    '''Returns the paths of all files under [rel_dir] at any depth.'''
+    rel_dir = CompactIndex._key(rel_dir)
+    prefix = os.path.join(rel_dir, '')
+    results = []
+    for current in set(self._base['dirs']).union(self._overlay_dirs):
+      if not rel_dir or current == rel_dir or current.startswith(prefix):
+        results.extend([os.path.join(current, name) \
+            for name, entry in self.dir_items(current)])
+    return results
+
+  @staticmethod
+  def changed_keys(old, new, rel_paths=None):
+    '''Returns the set of paths whose entries may differ between indexes.
+
+    Only [rel_paths], and everything under those that are dirs, are looked
+    at unless it is None. Indexes sharing a base only compare overlays.
+    '''
+    if rel_paths != None:
+      keys = set()
+      for rel_path in rel_paths:
+        rel_path = CompactIndex._key(rel_path)
+        if rel_path in old or rel_path in new:
+          keys.add(rel_path)
+        else:
+          keys.update(old.keys_under(rel_path))
+          keys.update(new.keys_under(rel_path))
+      return keys
+    if isinstance(old, CompactIndex) and isinstance(new, CompactIndex) and \
+        old._base is new._base:
+      return set([rel_path for rel_path in \
+          set(old._overlay).union(new._overlay) \
+              if old.get(rel_path) != new.get(rel_path)])
+    keys = set([rel_path for rel_path, entry in new.iteritems() \
+        if old.get(rel_path) != entry])
+    keys.update([rel_path for rel_path in old if rel_path not in new])
+    return keys
+
+  def find(self, fingerprint):
+    '''Returns the path of a file whose fingerprint is [fingerprint] or None.
+
+    The base rows sorted by digest are only built on the first call.
+    '''
+    if self._overlay_fingerprints == None:
+      self._overlay_fingerprints = dict((entry[1], rel_path) \
+          for rel_path, entry in self._overlay.iteritems() if entry != None)
+    if fingerprint in self._overlay_fingerprints:
+      return self._overlay_fingerprints[fingerprint]
+    if not BinaryCodec._is_digest(fingerprint):
+      return None
+    base = self._base
+    digests = base['digests']
+    if base['by_digest'] == None:
+      base['by_digest'] = array.array('l', sorted(xrange(len(digests) / 16),
+          key=lambda row: digests[16 * row:16 * row + 16]))
+    by_digest = base['by_digest']
+    digest = binascii.unhexlify(fingerprint)
+    low = 0
+    high = len(by_digest)
+    while low < high:
+      middle = (low + high) / 2
+      row = by_digest[middle]
+      if digests[16 * row:16 * row + 16] < digest:
+        low = middle + 1
+      else:
+        high = middle
+    for position in xrange(low, len(by_digest)):
+      row = by_digest[position]
+      if digests[16 * row:16 * row + 16] != digest:
+        break
+      dir_id = bisect.bisect_right(base['dir_rows'], row) - 1
+      rel_path = os.path.join(base['dirs'][dir_id],
+          CompactIndex._name(base, dir_id, row))
+      if rel_path not in self._overlay:
+        return rel_path
+    return None
+
+  def compact(self):
+    '''Folds the overlay into a new packed base.'''
+    self._base, self._overlay = CompactIndex._pack(self._base, self._overlay)
+    self._overlay_dirs = {}
+    for rel_path in self._overlay:
+      rel_dir, unused, name = rel_path.rpartition(os.sep)
+      self._overlay_dirs.setdefault(rel_dir, set()).add(name)
+    self._overlay_fingerprints = None
+    self._compact_at = max(COMPACT_INDEX_MIN_OVERLAY, self._len / 8) + \
+        len(self._overlay)
+
+  def to_marshal(self):
+    '''Returns the index as built-in types marshal can serialise.'''
+    base, overlay = CompactIndex._pack(self._base, self._overlay)
+    return (base['width'], base['dirs'], base['dir_rows'].tostring(),
+        base['blobs'], base['name_ends'].tostring(),
+        base['mtimes'].tostring(), base['digests'],
+        [base[column].tostring() for column in CompactIndex.STAT_COLUMNS],
+        overlay)
+
+  @staticmethod
+  def from_marshal(data):
+    width, dirs, dir_rows, blobs, name_ends, mtimes, digests, stat_columns, \
+        overlay = data
+    base = CompactIndex._empty_base(width)
+    base['dirs'] = dirs
+    base['dir_ids'] = dict((dirs[i], i) for i in xrange(len(dirs)))
+    base['dir_rows'] = array.array('l')
+    base['dir_rows'].fromstring(dir_rows)
+    base['blobs'] = blobs
+    base['name_ends'].fromstring(name_ends)
+    base['mtimes'].fromstring(mtimes)
+    base['digests'] = digests
+    for i in range(len(CompactIndex.STAT_COLUMNS)):
+      base[CompactIndex.STAT_COLUMNS[i]].fromstring(stat_columns[i])
+    rows = base['dir_rows'][-1]
+    if len(base['dir_rows']) != len(dirs) + 1 or len(blobs) != len(dirs) or \
+        len(base['name_ends']) != rows or len(base['mtimes']) != rows or \
+        len(digests) != 16 * rows:
+      raise ValueError('Inconsistent index columns.')
+    index = CompactIndex()
+    index._base = base
+    index._overlay = overlay
+    index._len = rows + len(overlay)
+    index.compact()
+    return index
+
+  def _set_overlay(self, rel_path, entry):
+    self._overlay[rel_path] = entry
+    rel_dir, unused, name = rel_path.rpartition(os.sep)
+    self._overlay_dirs.setdefault(rel_dir, set()).add(name)
+    self._overlay_fingerprints = None
+    if self._dir_cache != None and self._dir_cache[0] == rel_dir:
+      if entry is None:
+        self._dir_cache[1].pop(name, None)
+      else:
+        self._dir_cache[1][name] = entry
+    if len(self._overlay) > self._compact_at:
+      self.compact()
+
+  def _base_row(self, rel_path):
+    '''Returns the row of [rel_path] in the base or None.'''
+    rel_dir, unused, name = rel_path.rpartition(os.sep)
+    base = self._base
+    dir_id = base['dir_ids'].get(rel_dir)
+    if dir_id == None:
+      return None
+    # CompactIndex._name() inlined as this is the hottest loop of lookups.
+    blob = base['blobs'][dir_id]
+    name_ends = base['name_ends']
+    first = base['dir_rows'][dir_id]
+    low = first
+    high = end = base['dir_rows'][dir_id + 1]
+    while low < high:
+      middle = (low + high) / 2
+      if blob[name_ends[middle - 1] if middle > first else 0:\
+          name_ends[middle]] < name:
+        low = middle + 1
+      else:
+        high = middle
+    if low < end and \
+        blob[name_ends[low - 1] if low > first else 0:name_ends[low]] == name:
+      return low
+    return None
+
+  @staticmethod
+  def _name(base, dir_id, row):
+    start = 0 if row == base['dir_rows'][dir_id] else base['name_ends'][row - 1]
+    return base['blobs'][dir_id][start:base['name_ends'][row]]
+
+  @staticmethod
+  def _entry(base, row):
+    mtime = base['mtimes'][row]
+    fingerprint = binascii.hexlify(base['digests'][16 * row:16 * row + 16])
+    if base['width'] == 2:
+      return (mtime, fingerprint)
+    missing = CompactIndex.MISSING
+    size = base['sizes'][row]
+    mtime_ns = base['mtimes_ns'][row]
+    inode = base['inodes'][row]
+    return (mtime, fingerprint, None if size == missing else size,
+        None if mtime_ns == missing else mtime_ns,
+        None if inode == missing else inode)
+
+  @staticmethod
+  def _key(rel_path):
+    # Paths decoded from the wire are unicode while crawled ones are not.
+    if type(rel_path) == unicode:
+      return rel_path.encode('utf-8')
+    return rel_path
+
+  @staticmethod
+  def _empty_base(width):
+    base = {
+        # Every entry has [width] fields, 2 or 2 + len(STAT_COLUMNS).
+        'width': width,
+        'dirs': [],
+        'dir_ids': {},
+        # The rows of dirs[i] are dir_rows[i] up to dir_rows[i + 1].
+        'dir_rows': array.array('l', [0]),
+        'blobs': [],
+        # Where each name ends in the blob of its dir.
+        'name_ends': array.array('I'),
+        'mtimes': array.array('d'),
+        'digests': '',
+        # Rows sorted by digest, only built when first needed.
+        'by_digest': None,
+    }
+    for column in CompactIndex.STAT_COLUMNS:
+      base[column] = array.array('l')
+    return base
+
+  @staticmethod
+  def _is_packable(entry, width):
+    if type(entry) not in (tuple, list) or len(entry) != width or \
+        type(entry[0]) not in (int, long, float) or \
+        type(entry[1]) not in (str, unicode) or \
+        not BinaryCodec._is_digest(entry[1]):
+      return False
+    for value in entry[2:]:
+      if value != None and (type(value) not in (int, long) or \
+          not CompactIndex.MISSING < value < -CompactIndex.MISSING):
+        return False
+    return True
+
+  @staticmethod
+  def _pack(base, overlay):
+    '''Returns a tuple (base, overlay) with [overlay] merged into [base].
+
+    The returned overlay holds the entries that could not be packed. The
+    rows of dirs that [overlay] does not touch are copied over in runs.
+    '''
+    width = base['width']
+    if not base['dirs']:
+      width = None
+      for entry in overlay.itervalues():
+        if entry != None and \
+            len(entry) in (2, 2 + len(CompactIndex.STAT_COLUMNS)):
+          width = len(entry)
+          break
+    touched = {}
+    for rel_path, entry in overlay.iteritems():
+      rel_dir, unused, name = rel_path.rpartition(os.sep)
+      touched.setdefault(rel_dir, {})[name] = entry
+    packed = CompactIndex._empty_base(width)
+    columns = ['name_ends', 'mtimes']
+    if width > 2:
+      columns.extend(CompactIndex.STAT_COLUMNS)
+    digests = []
+    leftover = {}
+    def add_dir(rel_dir, blob, rows):
+      packed['dir_ids'][rel_dir] = len(packed['dirs'])
+      packed['dirs'].append(rel_dir)
+      packed['blobs'].append(blob)
+      packed['dir_rows'].append(packed['dir_rows'][-1] + rows)
+    run_start = None
+    for dir_id in range(len(base['dirs']) + 1):
+      if dir_id < len(base['dirs']) and base['dirs'][dir_id] not in touched:
+        if run_start == None:
+          run_start = base['dir_rows'][dir_id]
+        add_dir(base['dirs'][dir_id], base['blobs'][dir_id],
+            base['dir_rows'][dir_id + 1] - base['dir_rows'][dir_id])
+      elif run_start != None:
+        run_end = base['dir_rows'][dir_id]
+        for column in columns:
+          packed[column].extend(base[column][run_start:run_end])
+        digests.append(base['digests'][16 * run_start:16 * run_end])
+        run_start = None
+    for rel_dir in sorted(touched):
+      merged = {}
+      dir_id = base['dir_ids'].get(rel_dir)
+      if dir_id != None:
+        for row in xrange(base['dir_rows'][dir_id],
+            base['dir_rows'][dir_id + 1]):
+          merged[CompactIndex._name(base, dir_id, row)] = \
+              CompactIndex._entry(base, row)
+      for name, entry in touched[rel_dir].iteritems():
+        if entry is None:
+          merged.pop(name, None)
+        else:
+          merged[name] = entry
+      names = []
+      for name in sorted(merged):
+        entry = merged[name]
+        if not CompactIndex._is_packable(entry, width):
+          leftover[os.path.join(rel_dir, name)] = entry
+          continue
+        names.append(name)
+        packed['name_ends'].append(len(name) + \
+            (packed['name_ends'][-1] if len(names) > 1 else 0))
+        packed['mtimes'].append(entry[0])
+        digests.append(binascii.unhexlify(entry[1]))
+        for i in range(2, width):
+          packed[CompactIndex.STAT_COLUMNS[i - 2]].append(
+              CompactIndex.MISSING if entry[i] == None else entry[i])
+      if names:
+        add_dir(rel_dir, ''.join(names), len(names))
+    packed['digests'] = ''.join(digests)
+    return (packed, leftover)
+
+
+class IgnorePatterns(object):
+  """ gitignore style patterns compiled into a single regex.
+
+  Follows gitignore(5): blank lines and lines starting with '#' are
+  skipped, '!' re-includes what earlier patterns excluded, a trailing '/'
+  only matches dirs and patterns without a '/' elsewhere match at any
+  depth while the rest are relative to the dir the patterns apply to. '*',
+  '?' and '[...]' do not match '/' but '**' does. Later patterns win so
+  they are matched last to first and, as negations are rare, runs of
+  patterns with the same sign share one regex.
+  """
+  def __init__(self, lines=()):
+    patterns = []
+    for line in lines:
+      pattern = IgnorePatterns._parse(line)
+      if pattern:
+        patterns.append(pattern)
+    # A list of (negated, file_regex, dir_regex) from the last run to the
+    # first. Either regex is None if no pattern of the run applies.
+    self._runs = []
+    patterns.reverse()
+    while patterns:
+      negated = patterns[0][0]
+      run = []
+      while patterns and patterns[0][0] == negated:
+        run.append(patterns.pop(0))
+      self._runs.append((negated,
+          IgnorePatterns._compile([regex \
+              for unused, dir_only, regex in run if not dir_only]),
+          IgnorePatterns._compile([regex for unused, unused, regex in run])))
+
+  def __len__(self):
+    return len(self._runs)
+
+  @staticmethod
+  def from_file(path):
+    '''Returns the IgnorePatterns in the file [path] or None.'''
+    try:
+      with open(path, 'rb') as fp:
+        return IgnorePatterns(fp.read().splitlines())
+    except (IOError, OSError):
+      return None
+
+  def match(self, rel_path, is_dir):
+    '''Returns True if [rel_path] is excluded, False if it is re-included
+    by a negation or None if no pattern matches it.
+    '''
+    for negated, file_regex, dir_regex in self._runs:
+      regex = dir_regex if is_dir else file_regex
+      if regex != None and regex.match(rel_path) != None:
+        return not negated
+    return None
+
+  @staticmethod
+  def _compile(regexes):
+    if not regexes:
+      return None
+    return re.compile('(?:{})\\Z'.format('|'.join(regexes)), re.DOTALL)
+
+  @staticmethod
+  def _parse(line):
+    '''Returns a tuple (negated, dir_only, regex) for [line] or None.'''
+    line = line.rstrip('\r\n')
+    if line.rstrip(' ') != line and not line.rstrip(' ').endswith('\\'):
+      line = line.rstrip(' ')
+    if not line or line.startswith('#'):
+      return None
+    negated = line.startswith('!')
+    if negated or line.startswith('\\#') or line.startswith('\\!'):
+      line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+      return None
+    anchored = '/' in line
+    segments = line.lstrip('/').split('/')
+    parts = [] if anchored else ['(?:.*/)?']
+    for i in range(len(segments)):
+      last = i == len(segments) - 1
+      if segments[i] == '**':
+        parts.append('.*' if last else '(?:.*/)?')
+      else:
+        parts.append(IgnorePatterns._translate(segments[i]))
+        if not last:
+          parts.append('/')
+    return (negated, dir_only, ''.join(parts))
+
+  @staticmethod
+  def _translate(segment):
+    '''Returns the regex of the glob [segment] of a path.'''
+    parts = []
+    i = 0
+    while i < len(segment):
+      c = segment[i]
+      i += 1
+      if c == '*':
+        while i < len(segment) and segment[i] == '*':
+          i += 1
+        parts.append('[^/]*')
+      elif c == '?':
+        parts.append('[^/]')
+      elif c == '\\' and i < len(segment):
+        parts.append(re.escape(segment[i]))
+        i += 1
+      elif c == '[' and segment.find(']', i + 1) >= 0:
+        end = segment.find(']', i + 1)
+        chars = segment[i:end]
+        i = end + 1
+        if chars.startswith('!') or chars.startswith('^'):
+          chars = '^' + chars[1:].replace('\\', '\\\\')
+        else:
+          chars = chars.replace('\\', '\\\\')
+        parts.append('[{}]'.format(chars))
+      else:
+        parts.append(re.escape(c))
+    return ''.join(parts)
+
+
+class ExcludeRules(object):
+  """ Decides which paths under a root dir a DirCrawler leaves out.
+
+  The patterns given apply relative to the root dir, below those in any of
+  [ignore_files] found along the way, which apply relative to the dir
+  holding them with deeper files taking precedence. Files inside an
+  excluded dir are excluded too, whatever the patterns say about them.
+  """
+  def __init__(self, root_dir, patterns=(), ignore_files=()):
+    self._dir = root_dir
+    self._patterns = IgnorePatterns(patterns)
+    self._ignore_files = tuple(ignore_files)
+    # rel_dir => list of (rel_dir, IgnorePatterns) that apply in it with
+    # the deepest first.
+    self._chains = {}
+
+  def is_ignore_file(self, rel_path):
+    return os.path.basename(rel_path) in self._ignore_files
+
+  def reset(self):
+    '''Forgets the ignore files read so far.'''
+    self._chains = {}
+
+  def chain(self, rel_dir, names=None):
+    '''Returns the patterns that apply to the entries of [rel_dir].
+
+    [names] are the files in [rel_dir] if the caller listed them already,
+    in which case the ignore files among them are read again.
+    '''
+    if names == None and rel_dir in self._chains:
+      return self._chains[rel_dir]
+    if not self._ignore_files:
+      return []
+    chain = [] if not rel_dir else self.chain(os.path.dirname(rel_dir))
+    for name in self._ignore_files:
+      if names == None or name in names:
+        patterns = IgnorePatterns.from_file(
+            os.path.join(self._dir, rel_dir, name))
+        if patterns:
+          chain = [(rel_dir, patterns)] + chain
+    self._chains[rel_dir] = chain
+    return chain
+
+  def is_excluded(self, rel_path, is_dir, chain):
+    '''Returns whether [rel_path] is excluded given its parent's [chain].
+
+    Only looks at the patterns, not at whether a parent dir is excluded.
+    '''
+    for rel_dir, patterns in chain:
+      matched = patterns.match(
+          rel_path[len(rel_dir) + 1:] if rel_dir else rel_path, is_dir)
+      if matched != None:
+        return matched
+    return self._patterns.match(rel_path, is_dir) == True
+
+  def is_path_excluded(self, rel_path, is_dir=False):
+    '''Returns whether [rel_path] or any of its parent dirs is excluded.'''
+    if not self._patterns and not self._ignore_files:
+      return False
+    parts = rel_path.split(os.sep)
+    for i in range(len(parts)):
+      parent = os.sep.join(parts[:i])
+      if self.is_excluded(os.sep.join(parts[:i + 1]),
+          is_dir or i < len(parts) - 1, self.chain(parent)):
+        return True
+    return False
+
+
+class DirCrawler(object):
+  def __init__(self, root_dir, exclude_list=[], hash_pool=None,
+      fingerprint=Fingerprint.MD5, ignore_files=(), walk_workers=1):
+    self.log = Logger(type(self).__name__)
+    self._dir = root_dir
+    self._dir = os.path.expanduser(self._dir)
+    self._dir = os.path.abspath(self._dir)
+    assert os.path.isdir(self._dir), \
+        'Argument root_dir [{}] => [{}] must exist.'.format(root_dir, self._dir)
+    self._excludes = ExcludeRules(self._dir, exclude_list, ignore_files)
+    self._hash_pool = hash_pool if hash_pool else HashPool()
+    self._fingerprint = fingerprint
+    self._walk_workers = walk_workers
+    self._recorded = 0
+
+  def get_dir(self):
+    return self._dir
+
+  def get_fingerprint(self):
+    return self._fingerprint
+
+  def crawl(self, rel_dir=''):
+    '''Returns a list of relative paths of all files recursively.'''
+    all_files = [rel_path for rel_path, unused in self._walk(rel_dir)]
+    self.log.debug(
+        'Crawl found a total of [{}] files...'.format(len(all_files)))
+    return all_files
+
+  def _walk(self, rel_dir='', on_dir=None, skipped=None):
+    '''Yields a tuple (rel_path, stat) for every file under [rel_dir].
+
+    Each entry costs a single stat, none for dirs if scandir tells their
+    type, and with more than one walk worker dirs are listed concurrently to
+    hide the metadata latency of network filesystems. Only
+    WALK_LISTINGS_PER_WORKER listings per worker are made ahead of the
+    caller so the walk never holds much more of the tree in memory than
+    what is being yielded. [on_dir] is called
+    with the relative path of each dir and the set of names of the files in
+    it before they are yielded. Excluded dirs are pruned from the walk
+    rather than filtered file by file and the number of dirs and files left
+    out is added to the list [skipped].
+    '''
+    if rel_dir and self._excludes.is_path_excluded(rel_dir, True):
+      return
+    self.log.debug('Starting to crawl [{}]...'.format(
+        os.path.join(self._dir, rel_dir)))
+    excludes = self._excludes
+    pool = None
+    if self._walk_workers > 1:
+      pool = multiprocessing.pool.ThreadPool(self._walk_workers)
+    max_listings = self._walk_workers * WALK_LISTINGS_PER_WORKER
+    try:
+      # Dirs listed or being listed go in [listings] ahead of the [waiting]
+      # ones, both in walk order.
+      listings = collections.deque()
+      waiting = collections.deque([rel_dir])
+      while listings or waiting:
+        while waiting and \
+            (not listings or (pool and len(listings) < max_listings)):
+          path = waiting.popleft()
+          listings.append((path, pool and \
+              pool.apply_async(self._list_dir, (path,))))
+        rel_root, listing = listings.popleft()
+        dir_names, files = listing.get() if listing else \
+            self._list_dir(rel_root)
+        file_names = [name for name, unused in files]
+        chain = excludes.chain(rel_root, file_names)
+        for name in dir_names:
+          path = os.path.join(rel_root, name)
+          if excludes.is_excluded(path, True, chain):
+            if skipped != None:
+              skipped[0] += 1
+            continue
+          waiting.append(path)
+        files = [(os.path.join(rel_root, name), file_stat) \
+            for name, file_stat in files]
+        kept = [(path, file_stat) for path, file_stat in files \
+            if not excludes.is_excluded(path, False, chain)]
+        if skipped != None:
+          skipped[1] += len(files) - len(kept)
+        if on_dir:
+          on_dir(rel_root, set([os.path.basename(path) for path, unused \
+              in kept]))
+        for item in kept:
+          yield item
+    finally:
+      if pool:
+        pool.terminate()
+
+  def _list_dir(self, rel_dir):
+    '''Returns a tuple ([dir names], [(file name, stat)]) for [rel_dir].
+
+    Like os.walk symlinks are followed to files but never into dirs, and
+    anything that is not a regular file is left out. A dir that cannot be
+    listed, usually because it just vanished, looks empty.
+    '''
+    abs_dir = os.path.join(self._dir, rel_dir)
+    dir_names = []
+    files = []
+    try:
+      if scandir != None:
+        entries = [(entry.name, entry) for entry in scandir(abs_dir)]
+      else:
+        entries = [(name, None) for name in os.listdir(abs_dir)]
+    except OSError:
+      return (dir_names, files)
+    for name, entry in entries:
+      path = os.path.join(abs_dir, name)
+      try:
+        if entry != None and entry.is_dir(follow_symlinks=False):
+          dir_names.append(name)
+          continue
+        entry_stat = entry.stat(follow_symlinks=False) if entry != None \
+            else os.lstat(path)
+        if stat.S_ISLNK(entry_stat.st_mode):
+          entry_stat = os.stat(path)
+        elif stat.S_ISDIR(entry_stat.st_mode):
+          dir_names.append(name)
+          continue
+      except OSError:
+        # Vanished or a dangling symlink.
+        continue
+      if stat.S_ISREG(entry_stat.st_mode):
+        files.append((name, entry_stat))
+    return (dir_names, files)
+
+  def crawl_and_hash(self, previous_results={}):
+    '''Returns a CompactIndex keyed off file_rel_path with md5_hash information.
+
+    Each key refers to the relative path of a file.
+    Each value contains a tuple with five elements:
+    1. Epoch modified time.
+    2. MD5 hash of the contents of the file.
+    3. Size in bytes.
+    4. Modified time in nanoseconds.
+    5. Inode number.
+    The result starts off as a copy of [previous_results] so unchanged files
+    cost neither a hash nor a new entry, and the paths found are consumed
+    as the crawl yields them instead of being listed first.
+    '''
+    self.log.debug('Computing the md5 hashes of [{}]...'.format(self._dir))
+    start = time.time()
+    data = CompactIndex.copy_of(previous_results)
+    crawled_dirs = set()
+    def forget_vanished(rel_dir, names):
+      crawled_dirs.add(rel_dir)
+      for name, entry in data.dir_items(rel_dir):
+        if name not in names:
+          del data[os.path.join(rel_dir, name)]
+    skipped = [0, 0]
+    computed_md5s, reused_md5s, hashed_bytes = \
+        self._hash_paths(self._walk('', forget_vanished, skipped), data)
+    for rel_dir in data.dirs().difference(crawled_dirs):
+      for name, entry in data.dir_items(rel_dir):
+        del data[os.path.join(rel_dir, name)]
+    elapsed = max(time.time() - start, 1e-6)
+    self.log.info(('Finished computing all [{}] {} fingerprints and reused '
+        '[{}] at [{:.1f}] files/sec and [{:.1f}] MB/sec.').format(
+            computed_md5s, self._fingerprint, reused_md5s,
+            computed_md5s / elapsed,
+            hashed_bytes / elapsed / (1024 * 1024)))
+    self.log.info('Crawl skipped [{}] excluded dirs and [{}] files.'.format(
+        skipped[0], skipped[1]))
+    return data
+
+  def update(self, previous_results, rel_paths):
+    '''Returns a copy of [previous_results] refreshed for [rel_paths] only.
+
+    Paths that are directories are crawled recursively and paths that no
+    longer exist are dropped together with everything underneath them.
+    Changing an ignore file may exclude or include anything below it so
+    that crawls everything again, see needs_recrawl().
+    '''
+    if self.needs_recrawl(rel_paths):
+      self.log.info('Ignore files changed. Crawling [{}] again.'.format(
+          self._dir))
+      self._excludes.reset()
+      return self.crawl_and_hash(previous_results)
+    data = CompactIndex.copy_of(previous_results)
+    candidates = []
+    for rel_path in rel_paths:
+      abs_path = os.path.join(self._dir, rel_path)
+      if os.path.isdir(abs_path):
+        candidates.extend(self._walk(rel_path))
+      elif os.path.isfile(abs_path) and not self._is_excluded(rel_path):
+        candidates.append((rel_path, None))
+      else:
+        DirCrawler._forget(data, rel_path)
+    computed_md5s, reused_md5s, hashed_bytes = \
+        self._hash_paths(candidates, data)
+    self.log.debug('Updated [{}] changed paths computing [{}] md5s.'.format(
+        len(rel_paths), computed_md5s))
+    return data
+
+  def needs_recrawl(self, rel_paths):
+    '''Returns whether updating [rel_paths] means crawling everything.'''
+    return len([rel_path for rel_path in rel_paths \
+        if self._excludes.is_ignore_file(rel_path)]) > 0
+
+  def record(self, previous_results, fingerprints):
+    '''Returns a copy of [previous_results] with [fingerprints] added.
+
+    [fingerprints] maps the relative paths of files just written to the
+    fingerprint of their contents as computed by whoever wrote them, so
+    only their stat is read. As a safety net every
+    WRITE_THROUGH_VERIFY_EVERY-th file is fingerprinted anyway and the
+    computed value wins if they differ. Files are recorded even if they
+    are excluded, otherwise they would be asked for again on every diff.
+    '''
+    data = CompactIndex.copy_of(previous_results)
+    for rel_path, fingerprint in fingerprints.iteritems():
+      abs_path = os.path.join(self._dir, rel_path)
+      try:
+        stat = os.stat(abs_path)
+      except OSError:
+        continue
+      self._recorded += 1
+      if self._recorded % WRITE_THROUGH_VERIFY_EVERY == 0:
+        if self._fingerprint == Fingerprint.STAT:
+          actual = Fingerprint.from_stat(stat)
+        else:
+          actual = Fingerprint.hash_file(abs_path, self._fingerprint)
+        if actual != fingerprint:
+          self.log.warn(('Written file [{}] has fingerprint [{}] but the '
+              'writer claimed [{}].').format(abs_path, actual, fingerprint))
+          fingerprint = actual
+      data[rel_path] = DirCrawler._entry(stat, fingerprint)
+    return data
+
+  def _hash_paths(self, files, data):
+    '''Brings the entries of [files] in the index [data] up to date.
+
+    [files] holds tuples (rel_path, stat) with a None stat for the files
+    that the caller did not stat already.
+    Entries whose size, mtime and inode did not change are kept and the
+    rest are fingerprinted, from their stat or
+    by hashing their contents in the HashPool, largest
+    files first so they do not end up as a single threaded tail. Files that
+    vanish are dropped. Stat fingerprints of files modified within the
+    last FINGERPRINT_RACY_SECS cannot be trusted, as another write in the
+    same timestamp tick would go unnoticed, so those get hashed instead and
+    are re-examined by the next crawl.
+    Returns a tuple (computed_md5s, reused_md5s, hashed_bytes).
+    '''
+    pending = []
+    computed_md5s = 0
+    reused_md5s = 0
+    start = time.time()
+    racy_mtime = start - FINGERPRINT_RACY_SECS
+    for rel_path, stat in files:
+      if stat == None:
+        try:
+          stat = os.stat(os.path.join(self._dir, rel_path))
+        except OSError:
+          data.pop(rel_path, None)
+          continue
+      previous = data.get(rel_path)
+      if previous and DirCrawler._is_unchanged(previous, stat):
+        reused_md5s += 1
+      elif self._fingerprint == Fingerprint.STAT and \
+          stat.st_mtime < racy_mtime:
+        computed_md5s += 1
+        data[rel_path] = DirCrawler._entry(stat, Fingerprint.from_stat(stat))
+      else:
+        pending.append((stat.st_size, rel_path, stat))
+    pending.sort(reverse=True)
+    # [files] is often a crawl still walking the dirs, so this is its cost.
+    METRICS.record('crawl.secs', time.time() - start)
+    hash_start = time.time()
+    stats = {}
+    hashed_bytes = 0
+    for size, rel_path, stat in pending:
+      stats[os.path.join(self._dir, rel_path)] = (rel_path, stat)
+      hashed_bytes += size
+    abs_paths = [os.path.join(self._dir, rel_path) \
+        for size, rel_path, stat in pending]
+    for abs_path, fingerprint in self._hash_pool.hash_files(
+        abs_paths, self._fingerprint):
+      rel_path, stat = stats[abs_path]
+      if fingerprint == None:
+        data.pop(rel_path, None)
+        continue
+      entry = DirCrawler._entry(stat, fingerprint)
+      if self._fingerprint == Fingerprint.STAT:
+        entry = entry[:3] + (None, None)
+      data[rel_path] = entry
+      computed_md5s += 1
+    METRICS.record('hash.secs', time.time() - hash_start)
+    METRICS.increment('hash.bytes', hashed_bytes)
+    METRICS.increment('crawl.files_hashed', computed_md5s)
+    METRICS.increment('crawl.files_reused', reused_md5s)
+    return (computed_md5s, reused_md5s, hashed_bytes)
+
+  @staticmethod
+  def _entry(stat, fingerprint):
+    return (stat.st_mtime, fingerprint, stat.st_size, stat_mtime_ns(stat),
+        stat.st_ino)
+
+  @staticmethod
+  def _is_unchanged(entry, stat):
+    return entry[2] == stat.st_size and \
+        entry[3] == stat_mtime_ns(stat) and \
+        entry[4] == stat.st_ino
+
+  @staticmethod
+  def _forget(data, rel_path):
+    if data.pop(rel_path, None) is None:
+      for path in data.keys_under(rel_path):
+        del data[path]
+
+  @staticmethod
+  def md5_hash(file_path):
+    md5_hash = hashlib.md5()
+    with open(file_path, "rb") as f:
+      hash_fp(md5_hash, f)
+    return md5_hash.hexdigest()
+
+  def _is_excluded(self, path, is_dir=False):
+    return self._excludes.is_path_excluded(path, is_dir)
+
+
+class InotifyError(HumaReadbleException):
+  def __init__(self, msg):
+    HumaReadbleException.__init__(self, msg)
+
+
+class InotifyWatcher(object):
+  """ Recursive Linux inotify watches on top of libc via ctypes.
+
+  Reports the paths that changed relative to the root dir they belong to.
+  New directories are watched as soon as their creation event is seen.
+  """
+  IN_MODIFY = 0x00000002
+  IN_ATTRIB = 0x00000004
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_DELETE_SELF = 0x00000400
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_ISDIR = 0x40000000
+  IN_CLOEXEC = 0o2000000
+  IN_NONBLOCK = 0o4000
+  WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+      IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+  EVENT_FORMAT = 'iIII'
+  EVENT_BYTES = struct.calcsize(EVENT_FORMAT)
+  _libc = None
+
+  @staticmethod
+  def is_supported():
+    return InotifyWatcher._load_libc() != None
+
+  @staticmethod
+  def _load_libc():
+    if InotifyWatcher._libc == None and sys.platform.startswith('linux'):
+      try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = \
+            [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        InotifyWatcher._libc = libc
+      except (OSError, AttributeError):
+        pass
+    return InotifyWatcher._libc
+
+  def __init__(self, is_excluded=None):
+    self.log = Logger(type(self).__name__)
+    # Called with (root_index, rel_dir) to tell dirs not worth watching.
+    self._is_excluded = is_excluded
+    self._libc = InotifyWatcher._load_libc()
+    if self._libc == None:
+      raise InotifyError('inotify is not available on this platform.')
+    self._fd = self._libc.inotify_init1(
+        InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+    if self._fd < 0:
+      raise InotifyError('inotify_init1 failed with [{}].'.format(
+          os.strerror(ctypes.get_errno())))
+    # Watch descriptor => (root_index, root_dir, rel_dir)
+    self._watches = {}
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+      self._watches = {}
+
+  def watch_count(self):
+    return len(self._watches)
+
+  def add_tree(self, root_index, root_dir, rel_dir=''):
+    '''Watches [rel_dir] inside [root_dir] and all directories below it.'''
+    if rel_dir and self._is_excluded and self._is_excluded(root_index, rel_dir):
+      return
+    for dir_path, dirs, files in os.walk(os.path.join(root_dir, rel_dir)):
+      rel_path = os.path.relpath(dir_path, root_dir)
+      if rel_path == os.curdir:
+        rel_path = ''
+      if self._is_excluded:
+        dirs[:] = [d for d in dirs \
+            if not self._is_excluded(root_index, os.path.join(rel_path, d))]
+      wd = self._libc.inotify_add_watch(
+          self._fd, dir_path, InotifyWatcher.WATCH_MASK)
+      if wd < 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOENT, errno.ENOTDIR):
+          # The directory vanished before we could watch it.
+          continue
+        raise InotifyError('Failed to watch [{}] with [{}].'.format(
+            dir_path, os.strerror(err)))
+      self._watches[wd] = (root_index, root_dir, rel_path)
+
+  def read_changes(self, timeout_secs, settle_secs, max_batch_secs):
+    '''Returns a dict root_index => set(rel_paths) or None on overflow.
+
+    Waits up to [timeout_secs] for the first event and then keeps
+    coalescing events until none arrive for [settle_secs] or
+    [max_batch_secs] have passed.
+    '''
+    changes = {}
+    timeout = timeout_secs
+    batch_start = None
+    while batch_start == None or time.time() - batch_start < max_batch_secs:
+      readable, unused_w, unused_x = select.select([self._fd], [], [], timeout)
+      if not readable:
+        break
+      try:
+        data = os.read(self._fd, INOTIFY_READ_BYTES)
+      except OSError as exception:
+        if exception.errno == errno.EAGAIN:
+          continue
+        raise
+      if not self._parse_events(data, changes):
+        return None
+      if batch_start == None:
+        batch_start = time.time()
+      timeout = settle_secs
+    return changes
+
+  def _parse_events(self, data, changes):
+    '''Adds the paths in the raw [data] events to [changes].
+
+    Returns False if the kernel queue overflowed and events were lost.
+    '''
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, name_bytes = struct.unpack_from(
+          InotifyWatcher.EVENT_FORMAT, data, offset)
+      offset += InotifyWatcher.EVENT_BYTES
+      name = data[offset:offset + name_bytes].rstrip('\0')
+      offset += name_bytes
+      if mask & InotifyWatcher.IN_Q_OVERFLOW:
+        return False
+      if wd not in self._watches:
+        continue
+      root_index, root_dir, rel_dir = self._watches[wd]
+      if mask & InotifyWatcher.IN_IGNORED:
+        del self._watches[wd]
+        continue
+      if not name:
+        changes.setdefault(root_index, set()).add(rel_dir)
+        continue
+      rel_path = os.path.join(rel_dir, name)
+      if mask & InotifyWatcher.IN_ISDIR:
+        if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+          self.add_tree(root_index, root_dir, rel_path)
+        elif mask & InotifyWatcher.IN_MOVED_FROM:
+          self._remove_tree(root_index, rel_path)
+      changes.setdefault(root_index, set()).add(rel_path)
+    return True
+
+  def _remove_tree(self, root_index, rel_dir):
+    prefix = os.path.join(rel_dir, '')
+    for wd, (index, root_dir, rel_path) in self._watches.items():
+      if index == root_index and \
+          (rel_path == rel_dir or rel_path.startswith(prefix)):
+        self._libc.inotify_rm_watch(self._fd, wd)
+        del self._watches[wd]
+
+
+class IndexCache(object):
+  """ Persists the index of a DirCrawler across restarts.
+
+  The file holds a small header followed by the marshalled columns of the
+  CompactIndex, which load a million entries in well under a second.
+  Entries are validated against a fresh stat by the next crawl so stale
+  ones just get re-hashed.
+  Saves go to a temporary file that is fsynced and renamed over the
+  previous one so a crash never leaves a torn cache behind.
+  """
+  MAGIC = 'SDRI'
+  VERSION = 2
+  HEADER_FORMAT = '>4sBIQ'
+  HEADER_BYTES = struct.calcsize(HEADER_FORMAT)
+
+  def __init__(self, cache_dir, root_dir, fingerprint=Fingerprint.MD5):
+    self.log = Logger(type(self).__name__)
+    self._cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    self._path = os.path.join(self._cache_dir, '{}.{}.index'.format(
+        md5(os.path.abspath(os.path.expanduser(root_dir))), fingerprint))
+
+  def get_path(self):
+    return self._path
+
+  def load(self):
+    '''Returns the persisted CompactIndex or an empty one if there is none.'''
+    if not os.path.isfile(self._path):
+      return CompactIndex()
+    start = time.time()
+    try:
+      with open(self._path, 'rb') as fp:
+        data = fp.read()
+      magic, version, crc, payload_bytes = struct.unpack_from(
+          IndexCache.HEADER_FORMAT, data)
+      payload = data[IndexCache.HEADER_BYTES:]
+      if magic != IndexCache.MAGIC or version != IndexCache.VERSION or \
+          payload_bytes != len(payload) or \
+          crc != zlib.crc32(payload) & 0xffffffff:
+        raise ValueError('Invalid header.')
+      index = CompactIndex.from_marshal(marshal.loads(payload))
+    except (IOError, OSError, ValueError, EOFError, TypeError,
+        struct.error) as exception:
+      self.log.warn('Ignoring unreadable index cache [{}]: [{}].'.format(
+          self._path, exception))
+      return CompactIndex()
+    self.log.info('Loaded [{}] cached entries from [{}] in [{:.3f}] secs.'\
+        .format(len(index), self._path, time.time() - start))
+    return index
+
+  def save(self, index):
+    start = time.time()
+    if not os.path.isdir(self._cache_dir):
+      os.makedirs(self._cache_dir)
+    if not isinstance(index, CompactIndex):
+      index = CompactIndex(index)
+    payload = marshal.dumps(index.to_marshal())
+    header = struct.pack(IndexCache.HEADER_FORMAT, IndexCache.MAGIC,
+        IndexCache.VERSION, zlib.crc32(payload) & 0xffffffff, len(payload))
+    tmp_path = '{}.{}{}'.format(self._path, os.getpid(), TMP_SUFFIX)
+    with open(tmp_path, 'wb') as fp:
+      fp.write(header)
+      fp.write(payload)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.rename(tmp_path, self._path)
+    dir_fd = os.open(self._cache_dir, os.O_RDONLY)
+    try:
+      os.fsync(dir_fd)
+    finally:
+      os.close(dir_fd)
+    self.log.debug('Saved [{}] entries to [{}] in [{:.3f}] secs.'.format(
+        len(index), self._path, time.time() - start))
+
+
+class MerkleTree(object):
+  """ Rolled up fingerprints of every directory of a file index.
+
+  The hash of a dir covers the names and fingerprints of its files and the
+  names and hashes of its subdirs, so two indexes hold the same files under
+  a dir exactly when their hashes for it match. As in StateDiffer only
+  fingerprints count, mtimes do not. Files are read straight from the
+  CompactIndex the tree is built on, so only the dir structure and hashes
+  take extra memory. Hashes are computed lazily and updates only invalidate
+  the dirs above the paths they touch. A dir exists as long as some file
+  underneath it does.
+  """
+  def __init__(self, index={}):
+    # rel_dir => set(subdir names)
+    self._dirs = {'': set()}
+    # rel_dir => hash. A dir is only hashed if all its subdirs are.
+    self._hashes = {}
+    if not isinstance(index, CompactIndex):
+      index = CompactIndex(index)
+    self._index = index
+    for rel_dir in index.dirs():
+      if rel_dir not in self._dirs:
+        self._add_dir(rel_dir)
+
+  def update(self, changed, removed):
+    '''Adds or replaces the entries in [changed] and drops [removed].'''
+    index = self._index.copy()
+    index.update(changed)
+    for rel_path in removed:
+      index.pop(rel_path, None)
+    self.set_index(index, list(changed) + list(removed))
+
+  def set_index(self, index, changed_paths):
+    '''Switches to the CompactIndex [index].
+
+    [changed_paths] must hold every path whose entry differs from the
+    previous index, as returned by CompactIndex.changed_keys().
+    '''
+    self._index = index
+    for rel_path in changed_paths:
+      rel_dir = os.path.dirname(MerkleTree._key(rel_path))
+      if rel_dir not in self._dirs:
+        if index.has_dir(rel_dir):
+          self._add_dir(rel_dir)
+        continue
+      self._invalidate(rel_dir)
+      self._prune(rel_dir)
+
+  def get(self, rel_path):
+    return self._index.get(rel_path)
+
+  def hash(self, rel_dir=''):
+    '''Returns the hash of [rel_dir] or None if no file is under it.'''
+    rel_dir = MerkleTree._key(rel_dir)
+    if rel_dir not in self._dirs:
+      return None
+    dir_hash = self._hashes.get(rel_dir)
+    if dir_hash == None:
+      content = hashlib.md5()
+      for name, entry in self._index.dir_items(rel_dir):
+        content.update('f{}\0{}\0'.format(name, str(entry[1])))
+      for name in sorted(self._dirs[rel_dir]):
+        content.update('d{}\0{}\0'.format(
+            name, self.hash(os.path.join(rel_dir, name))))
+      dir_hash = content.hexdigest()
+      self._hashes[rel_dir] = dir_hash
+    return dir_hash
+
+  def files(self, rel_dir):
+    '''Returns a dict rel_path => entry of the files right in [rel_dir].'''
+    rel_dir = MerkleTree._key(rel_dir)
+    return dict((os.path.join(rel_dir, name), entry) \
+        for name, entry in self._index.dir_items(rel_dir))
+
+  def subdirs(self, rel_dir):
+    rel_dir = MerkleTree._key(rel_dir)
+    return [os.path.join(rel_dir, name) \
+        for name in self._dirs.get(rel_dir, ())]
+
+  def entries(self, rel_dir=''):
+    '''Yields (rel_path, entry) for every file under [rel_dir].'''
+    pending = [MerkleTree._key(rel_dir)]
+    while pending:
+      current = pending.pop()
+      for item in self.files(current).iteritems():
+        yield item
+      pending.extend(self.subdirs(current))
+
+  def diff(self, other):
+    '''Returns the paths whose fingerprint [other] lacks or differs in.
+
+    Only descends into the dirs whose hashes differ.
+    '''
+    results = []
+    pending = ['']
+    while pending:
+      rel_dir = pending.pop()
+      if self.hash(rel_dir) == other.hash(rel_dir):
+        continue
+      other_files = dict(other._index.dir_items(rel_dir))
+      for name, entry in self._index.dir_items(rel_dir):
+        other_entry = other_files.get(name)
+        if other_entry == None or other_entry[1] != entry[1]:
+          results.append(os.path.join(rel_dir, name))
+      pending.extend(self.subdirs(rel_dir))
+    return results
+
+  def _add_dir(self, rel_dir):
+    parent, name = os.path.split(rel_dir)
+    if parent not in self._dirs:
+      self._add_dir(parent)
+    self._dirs[rel_dir] = set()
+    self._dirs[parent].add(name)
+    self._invalidate(parent)
+
+  def _invalidate(self, rel_dir):
+    '''Forgets the hash of [rel_dir] and of all its hashed parents.'''
+    while True:
+      self._hashes.pop(rel_dir, None)
+      if not rel_dir:
+        return
+      rel_dir = os.path.dirname(rel_dir)
+      if rel_dir not in self._hashes:
+        return
+
+  def _prune(self, rel_dir):
+    while rel_dir and not self._dirs[rel_dir] and \
+        not self._index.has_dir(rel_dir):
+      del self._dirs[rel_dir]
+      self._hashes.pop(rel_dir, None)
+      parent, name = os.path.split(rel_dir)
+      self._dirs[parent].discard(name)
+      self._invalidate(parent)
+      rel_dir = parent
+
+  @staticmethod
+  def _key(rel_path):
+    return CompactIndex._key(rel_path)
+
+
+class DirMonitor(object):
+  def __init__(self, root_dirs, use_inotify=False, hash_pool=None,
+      cache_dir=None, fingerprint=Fingerprint.MD5, exclude_list=[],
+      ignore_files=(), crawl_workers=1):
+    self.log = Logger(type(self).__name__)
+    self.dirs = root_dirs
+    self._exclude_list = exclude_list
+    self._ignore_files = ignore_files
+    self._crawl_workers = crawl_workers
+    self._use_inotify = use_inotify
+    self._hash_pool = hash_pool
+    self._cache_dir = cache_dir
+    # Serialises index updates with changes of fingerprint.
+    self._lock = threading.Lock()
+    # A pipe rather than a threading.Event, whose timed waits poll every
+    # 50ms in Python 2, so waiters wake up as soon as the index changes.
+    self._changed_read, self._changed_write = os.pipe()
+    fcntl.fcntl(self._changed_write, fcntl.F_SETFL, os.O_NONBLOCK)
+    # Guards swapping the index and keeping the MerkleTrees in sync with it.
+    self._trees_lock = threading.Lock()
+    self._trees = None
+    self._reset(fingerprint)
+
+  def get_dirs(self):
     return self.dirs
 
   def get_files(self):
     return self.files
 
+  def get_fingerprint(self):
+    return self._fingerprint
+
+  @contextlib.contextmanager
+  def locked_trees(self):
+    '''Yields a MerkleTree per dir that the index does not change under.
+
+    The trees are only built the first time they are asked for and from
+    then on kept up to date with every change of the index.
+    '''
+    with self._trees_lock:
+      if self._trees == None:
+        self._trees = [MerkleTree(files) for files in self.files]
+      yield self._trees
+
+  def _set_files(self, files, changed_paths=None):
+    '''Swaps in the index [files], updating the MerkleTrees if there are any.
+
+    [changed_paths] has per dir the paths that may have changed, to spare
+    comparing whole indexes, or None for the dirs whose indexes have to be
+    compared whole. It may also be None altogether.
+    '''
+    with self._trees_lock:
+      if self._trees != None:
+        for i in range(len(files)):
+          if files[i] is not self.files[i]:
+            self._trees[i].set_index(files[i], CompactIndex.changed_keys(
+                self.files[i], files[i],
+                changed_paths[i] if changed_paths else None))
+      self.files = files
+    METRICS.set_gauge('index.files', sum([len(index) for index in files]))
+
+  def wait_for_change(self, timeout_secs):
+    '''Returns whether the index changed since the previous call.
+
+    Blocks for up to [timeout_secs] waiting for the next change.
+    '''
+    readable, unused, unused = select.select(
+        [self._changed_read], [], [], timeout_secs)
+    if readable:
+      os.read(self._changed_read, WAKEUP_READ_BYTES)
+    return len(readable) > 0
+
+  def _notify_change(self):
+    try:
+      os.write(self._changed_write, 'x')
+    except OSError as exception:
+      # A full pipe already tells waiters about the change.
+      if exception.errno != errno.EAGAIN:
+        raise
+
+  def set_fingerprint(self, fingerprint):
+    '''Re-fingerprints all files if [fingerprint] differs from the current.'''
+    if fingerprint == self._fingerprint:
+      return
+    self.log.info('Switching from [{}] to [{}] fingerprints.'.format(
+        self._fingerprint, fingerprint))
+    with self._lock:
+      self._save_caches(force=True)
+      self._reset(fingerprint)
+
+  def _reset(self, fingerprint):
+    self._fingerprint = fingerprint
+    self._crawlers = []
+    for root in self.dirs:
+      self._crawlers.append(DirCrawler(root, self._exclude_list,
+          self._hash_pool, fingerprint, self._ignore_files,
+          self._crawl_workers))
+    self._caches = []
+    with self._trees_lock:
+      self._trees = None
+      if self._cache_dir:
+        self._caches = [IndexCache(self._cache_dir, root, fingerprint) \
+            for root in self.dirs]
+        self.files = [cache.load() for cache in self._caches]
+      else:
+        self.files = [CompactIndex() for i in range(len(self._crawlers))]
+    self._saved_files = list(self.files)
+    self._last_save = time.time()
+    self._crawl_all()
+    self._save_caches(force=True)
+
   def start_monitoring(self):
     self._thread = threading.Thread(
         target=self._thread_main, name='DirMonitorThread')
@@ -438,23 +2777,152 @@ class DirMonitor(object):
     if self._thread:
       # self._thread.join()
       self._thread = None
+    self._save_caches(force=True)
     return self
 
   def _thread_main(self):
     self.log.info('Monitoring thread is running...')
+    if self._use_inotify:
+      try:
+        self._watch()
+      except InotifyError as exception:
+        self.log.warn('Falling back to crawling. inotify failed with [{}].'\
+            .format(exception.msg))
     while self._is_monitoring:
       self.log.info('Monitor knows of [{}] files.'.format(len(self.files)))
-      self._crawl_all()
-      time.sleep(5.0)
+      with self._lock:
+        self._crawl_all()
+      time.sleep(MONITOR_CRAWL_SECS)
     self.log.info('Monitoring thread is exiting.')
 
+  def _watch(self):
+    '''Applies inotify events to the index until monitoring stops.
+
+    A full crawl still runs every INOTIFY_CRAWL_SECS as a consistency check
+    and whenever the kernel event queue overflows.
+    '''
+    watcher = self._start_watcher()
+    try:
+      last_crawl = time.time()
+      while self._is_monitoring:
+        changes = watcher.read_changes(
+            INOTIFY_WAIT_SECS, INOTIFY_SETTLE_SECS, INOTIFY_MAX_BATCH_SECS)
+        if changes is None:
+          self.log.warn('The inotify queue overflowed. Rescanning all dirs.')
+          watcher.close()
+          watcher = self._start_watcher()
+          last_crawl = time.time()
+        elif changes:
+          with self._lock:
+            self._update(changes)
+        if time.time() - last_crawl >= INOTIFY_CRAWL_SECS:
+          with self._lock:
+            self._crawl_all()
+          last_crawl = time.time()
+    finally:
+      watcher.close()
+
+  def _start_watcher(self):
+    '''Watches all dirs and then crawls so no change is missed in between.'''
+    watcher = InotifyWatcher(lambda root_index, rel_dir: \
+        self._crawlers[root_index]._is_excluded(rel_dir, True))
+    try:
+      for i in range(len(self._crawlers)):
+        watcher.add_tree(i, self._crawlers[i].get_dir())
+    except InotifyError:
+      watcher.close()
+      raise
+    self.log.info('Watching [{}] directories with inotify.'.format(
+        watcher.watch_count()))
+    with self._lock:
+      self._crawl_all()
+    return watcher
+
+  def find_by_fingerprint(self, fingerprint):
+    '''Returns the absolute path of an indexed file with [fingerprint].
+
+    Stat fingerprints say nothing about contents so they never match.
+    Candidates are only returned while their stat still matches the index.
+    '''
+    if self._fingerprint == Fingerprint.STAT:
+      return None
+    files = self.files
+    for i in range(len(files)):
+      rel_path = files[i].find(fingerprint)
+      if rel_path == None:
+        continue
+      abs_path = os.path.join(self.dirs[i], rel_path)
+      try:
+        if DirCrawler._is_unchanged(files[i][rel_path], os.stat(abs_path)):
+          return abs_path
+      except OSError:
+        pass
+    return None
+
+  def record(self, written_files):
+    '''Writes through files whose fingerprint is already known.
+
+    [written_files] has one dict per dir mapping the relative paths of files
+    that were just written to their fingerprint, so the next crawl finds
+    them unchanged instead of hashing them again.
+    '''
+    if not [fingerprints for fingerprints in written_files if fingerprints]:
+      return
+    with self._lock:
+      files = list(self.files)
+      for i in range(len(written_files)):
+        if written_files[i]:
+          files[i] = self._crawlers[i].record(files[i], written_files[i])
+      self._set_files(files, [fingerprints.keys() \
+          for fingerprints in written_files])
+      self._notify_change()
+      self._save_caches()
+
+  def _update(self, changes):
+    files = list(self.files)
+    # None for the dirs crawled all over again, anything may have changed.
+    changed_paths = [[] for i in range(len(self._crawlers))]
+    for root_index, rel_paths in changes.items():
+      crawler = self._crawlers[root_index]
+      if crawler.needs_recrawl(rel_paths):
+        changed_paths[root_index] = None
+      else:
+        changed_paths[root_index] = rel_paths
+      files[root_index] = crawler.update(files[root_index], rel_paths)
+    self._set_files(files, changed_paths)
+    self._notify_change()
+    self._save_caches()
+
   def _crawl_all(self):
     files = []
     for i in range(len(self._crawlers)):
       crawler = self._crawlers[i]
       previous = self.files[i]
-      files.append(crawler.crawl_and_hash(previous))
-    self.files = files
+      current = crawler.crawl_and_hash(previous)
+      # Keeping the previous dict when nothing changed lets readers tell
+      # that cheaply by identity.
+      files.append(previous if current == previous else current)
+    if [i for i in range(len(files)) if files[i] is not self.files[i]]:
+      self._set_files(files)
+      self._notify_change()
+    self._save_caches()
+
+  def _save_caches(self, force=False):
+    '''Persists changed indexes at most once every INDEX_CACHE_SAVE_SECS.'''
+    if not self._caches or \
+        (not force and time.time() - self._last_save < INDEX_CACHE_SAVE_SECS):
+      return
+    files = self.files
+    for i in range(len(self._caches)):
+      if files[i] is self._saved_files[i] or files[i] == self._saved_files[i]:
+        continue
+      try:
+        self._caches[i].save(files[i])
+      except (IOError, OSError) as exception:
+        self.log.warn('Failed to save the index cache [{}]: [{}].'.format(
+            self._caches[i].get_path(), exception))
+    self._saved_files = list(files)
+    self._last_save = time.time()
 
 
 class StateDiffer(object):
@@ -488,6 +2956,330 @@ class StateDiffer(object):
     return results
 
 
+class HashingReader(object):
+  """ Wraps a file object and computes the MD5 of everything read from it. """
+  def __init__(self, fp):
+    self._fp = fp
+    self._md5 = hashlib.md5()
+
+  def read(self, size):
+    data = self._fp.read(size)
+    self._md5.update(data)
+    return data
+
+  def hexdigest(self):
+    return self._md5.hexdigest()
+
+
+class Compressor(object):
+  """ Compresses uploaded file contents and accounts for the savings.
+
+  Algorithms are named like 'zlib/6' or 'bz2'. Files with a well known
+  compressed extension or whose first COMPRESSION_SAMPLE_BYTES barely
+  shrink are sent as they are so no CPU is wasted on them.
+  """
+  NONE = 'none'
+  _libc = None
+
+  class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+  @staticmethod
+  def _load_libc():
+    if Compressor._libc == None and sys.platform.startswith('linux'):
+      try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.clock_gettime.argtypes = [ctypes.c_int,
+            ctypes.POINTER(Compressor._Timespec)]
+        libc.clock_gettime.restype = ctypes.c_int
+        Compressor._libc = libc
+      except (OSError, AttributeError):
+        pass
+    return Compressor._libc
+
+  @staticmethod
+  def thread_cpu_secs():
+    '''Returns the CPU secs used by the calling thread alone.
+
+    time.clock() counts the CPU of all threads, so this is read with
+    clock_gettime(2), falling back to wall time where that is missing.
+    '''
+    libc = Compressor._load_libc()
+    if libc:
+      timespec = Compressor._Timespec()
+      if libc.clock_gettime(CLOCK_THREAD_CPUTIME_ID,
+          ctypes.byref(timespec)) == 0:
+        return timespec.tv_sec + timespec.tv_nsec / 1e9
+    return time.time()
+
+  @staticmethod
+  def available():
+    names = [Compressor.NONE]
+    names.extend(['zlib/{}'.format(level) for level in range(1, 10)])
+    names.append('bz2')
+    if lzma != None:
+      names.append('lzma')
+    return tuple(names)
+
+  @staticmethod
+  def decompress(name, data):
+    if name.startswith('zlib/'):
+      return zlib.decompress(data)
+    elif name == 'bz2':
+      return bz2.decompress(data)
+    elif name == 'lzma' and lzma != None:
+      return lzma.decompress(data)
+    raise HumaReadbleException('Unsupported compression [{}].'.format(name))
+
+  def __init__(self, name):
+    assert name in Compressor.available(), name
+    self.log = Logger(type(self).__name__)
+    self._name = name
+    # Uploads striped across streams share a Compressor.
+    self._lock = threading.Lock()
+    self.raw_bytes = 0
+    self.compressed_bytes = 0
+    # CPU secs of the threads that compressed, summed.
+    self.cpu_secs = 0.0
+    self.compressed_files = 0
+    self.skipped_files = 0
+
+  def get_name(self):
+    return self._name
+
+  def ratio(self):
+    '''Returns compressed over raw bytes of everything compressed so far.'''
+    if self.raw_bytes == 0:
+      return 1.0
+    return self.compressed_bytes / float(self.raw_bytes)
+
+  def for_file(self, fp, file_path):
+    '''Returns the compression to apply to [fp] and rewinds it.'''
+    if self._name == Compressor.NONE:
+      return Compressor.NONE
+    compression = self._name
+    if os.path.splitext(file_path)[1].lower() in COMPRESSED_EXTENSIONS:
+      compression = Compressor.NONE
+    else:
+      sample = fp.read(COMPRESSION_SAMPLE_BYTES)
+      fp.seek(0)
+      if len(sample) > 0 and \
+          len(zlib.compress(sample, 1)) > len(sample) * COMPRESSION_MAX_RATIO:
+        compression = Compressor.NONE
+    with self._lock:
+      if compression == Compressor.NONE:
+        self.skipped_files += 1
+      else:
+        self.compressed_files += 1
+    return compression
+
+  def compress(self, data):
+    start = Compressor.thread_cpu_secs()
+    if self._name.startswith('zlib/'):
+      compressed = zlib.compress(data, int(self._name.split('/')[1]))
+    elif self._name == 'bz2':
+      compressed = bz2.compress(data)
+    else:
+      compressed = lzma.compress(data)
+    with self._lock:
+      self.cpu_secs += Compressor.thread_cpu_secs() - start
+      self.raw_bytes += len(data)
+      self.compressed_bytes += len(compressed)
+    return compressed
+
+  def log_stats(self):
+    self.log.info(('Compressed [{}] files with [{}] from [{}] to [{}] bytes '
+        '(ratio [{:.3f}]) in [{:.3f}] CPU secs summed over threads and '
+        'skipped [{}] files.').format(self.compressed_files, self._name,
+            self.raw_bytes, self.compressed_bytes, self.ratio(),
+            self.cpu_secs, self.skipped_files))
+
+
+class DeltaCodec(object):
+  """ rsync-style block deltas.
+
+  The remote computes a signature of its copy of a file: one weak rolling
+  checksum plus one strong MD5 per block. The local side slides a window over
+  its copy and emits either references to remote blocks or literal runs of
+  bytes. The weak checksum is the same value as zlib.adler32() so full blocks
+  are checksummed in C and only the byte-by-byte roll happens in Python.
+  """
+  ADLER_MOD = 65521
+
+  @staticmethod
+  def block_size_for(file_bytes):
+    block_size = int(file_bytes ** 0.5) & ~7
+    return max(DELTA_MIN_BLOCK_BYTES, min(DELTA_MAX_BLOCK_BYTES, block_size))
+
+  @staticmethod
+  def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+  @staticmethod
+  def roll(weak, out_byte, in_byte, block_size):
+    '''Slides the window of [weak] one byte forward.'''
+    mod = DeltaCodec.ADLER_MOD
+    a = ((weak & 0xffff) - out_byte + in_byte) % mod
+    b = ((weak >> 16) - block_size * out_byte + a - 1) % mod
+    return (b << 16) | a
+
+  @staticmethod
+  def signature(file_path):
+    '''Returns the block signature of the file in [file_path].
+
+    The signature is a dict with the block size, the size of the last
+    (possibly shorter) block and a list of [weak_checksum, md5] pairs, one
+    per block in file order.
+    '''
+    block_size = DeltaCodec.block_size_for(os.path.getsize(file_path))
+    blocks = []
+    last_block_bytes = 0
+    with open(file_path, 'rb') as fp:
+      for block in iter(lambda: fp.read(block_size), b''):
+        blocks.append([DeltaCodec.weak_checksum(block), md5(block)])
+        last_block_bytes = len(block)
+    return {
+        'block_size': block_size,
+        'last_block_bytes': last_block_bytes,
+        'blocks': blocks,
+    }
+
+  @staticmethod
+  def delta(fp, signature, max_literal_bytes):
+    '''Yields the ops that rebuild the contents of [fp] from the signed file.
+
+    Each op is either a [first_block, block_count] list referencing blocks
+    of the remote copy or a Blob of at most [max_literal_bytes] literal
+    bytes. Only a window of the file is held in memory at any time.
+    '''
+    block_size = signature['block_size']
+    blocks = signature['blocks']
+    candidates = {}
+    for index, (weak, strong) in enumerate(blocks):
+      candidates.setdefault(weak, []).append((index, strong))
+    read_bytes = max(BUFFER_SIZE_BYTES, block_size)
+
+    def find_block(data, weak):
+      if weak not in candidates:
+        return None
+      strong = md5(data)
+      for index, candidate in candidates[weak]:
+        if candidate == strong:
+          return index
+      return None
+
+    buf = ''
+    eof = False
+    literal_start = 0
+    pos = 0
+    weak = None
+    # Block references are held back so consecutive ones can be merged.
+    pending = None
+    while True:
+      if pos + block_size > len(buf) and not eof:
+        fragment = fp.read(read_bytes)
+        eof = not fragment
+        buf = buf[literal_start:] + fragment
+        pos -= literal_start
+        literal_start = 0
+        continue
+      if pos + block_size > len(buf):
+        break
+      if weak is None:
+        weak = DeltaCodec.weak_checksum(buf[pos:pos + block_size])
+      index = find_block(buf[pos:pos + block_size], weak)
+      if index is not None:
+        if pos > literal_start:
+          if pending:
+            yield pending
+            pending = None
+          yield Blob(buf[literal_start:pos])
+        if pending and sum(pending) == index:
+          pending[1] += 1
+        else:
+          if pending:
+            yield pending
+          pending = [index, 1]
+        pos += block_size
+        literal_start = pos
+        weak = None
+        continue
+      if pos + block_size < len(buf):
+        weak = DeltaCodec.roll(weak, ord(buf[pos]),
+            ord(buf[pos + block_size]), block_size)
+      else:
+        weak = None
+      pos += 1
+      if pos - literal_start >= max_literal_bytes:
+        if pending:
+          yield pending
+          pending = None
+        yield Blob(buf[literal_start:pos])
+        literal_start = pos
+    # The last remote block is usually shorter than block_size.
+    literal_end = len(buf)
+    if blocks:
+      tail_bytes = signature['last_block_bytes']
+      tail_start = len(buf) - tail_bytes
+      if tail_bytes < block_size and tail_start >= literal_start:
+        tail = buf[tail_start:]
+        weak = DeltaCodec.weak_checksum(tail)
+        if find_block(tail, weak) == len(blocks) - 1:
+          literal_end = tail_start
+    if literal_end > literal_start and pending:
+      yield pending
+      pending = None
+    while literal_end > literal_start:
+      yield Blob(buf[literal_start:min(literal_end,
+          literal_start + max_literal_bytes)])
+      literal_start += max_literal_bytes
+    if literal_end < len(buf):
+      if pending and sum(pending) == len(blocks) - 1:
+        pending[1] += 1
+      else:
+        if pending:
+          yield pending
+        pending = [len(blocks) - 1, 1]
+    if pending:
+      yield pending
+
+  @staticmethod
+  def op_bytes(op, signature):
+    '''Returns how many bytes [op] contributes to the rebuilt file.'''
+    if type(op) != list:
+      return len(op)
+    first_block, block_count = op
+    total_bytes = block_count * signature['block_size']
+    if first_block + block_count == len(signature['blocks']):
+      total_bytes -= signature['block_size'] - signature['last_block_bytes']
+    return total_bytes
+
+  @staticmethod
+  def patch(old_fp, ops, block_size, out_fp):
+    '''Writes into [out_fp] the file described by [ops].
+
+    Returns the number of bytes written.
+    '''
+    total_bytes = 0
+    for op in ops:
+      if type(op) == list:
+        first_block, block_count = op
+        old_fp.seek(first_block * block_size)
+        remaining = block_count * block_size
+        while remaining > 0:
+          fragment = old_fp.read(min(remaining, BUFFER_SIZE_BYTES))
+          if not fragment:
+            break
+          out_fp.write(fragment)
+          remaining -= len(fragment)
+          total_bytes += len(fragment)
+      else:
+        out_fp.write(op.data)
+        total_bytes += len(op.data)
+    return total_bytes
+
+
 
 #########################################################
 # Remote Server Classes
@@ -497,8 +3289,11 @@ class RemoteServer(object):
     self.log = Logger(type(self).__name__)
     self.log.debug('Initializing...')
     self._args = args
-    self._monitor = DirMonitor(args.dirs)
-    self._msg_handler = RemoteMessageHandler(self._monitor)
+    # Excludes only apply to what the client uploads. The remote indexes
+    # everything it holds, or it would ask for excluded files forever.
+    self._monitor = DirMonitor(args.dirs, args.inotify,
+        HashPool(args.hash_workers, args.hash_processes), args.index_cache_dir,
+        args.fingerprint, [], (), args.crawl_workers)
 
   def __enter__(self):
     self.log.debug('Entering...')
@@ -509,29 +3304,20 @@ class RemoteServer(object):
 
   def run(self):
     self.log.debug('Running...')
-    while True:
-      self.log.info('Listening for incoming connections in port [{}]...'.format(
-          self._args.port))
-      self._socket.listen(1)
-      connection, address = self._socket.accept()
-      connection.settimeout(SOCKET_TIMEOUT_SECS)
-      self.log.info('Accepted connection from address: [{}]'.format(
-          str(address)))
-      with StreamHandler(self._args.token, connection) as streamHandler:
-        while True:
-          try:
-            request = streamHandler.recvMessage()
-            response = self._msg_handler.handle_message(request)
-            assert response.type % 2 == 1, \
-                ('All responses must be of an odd type. '
-                    'Found type [{}] instead.').format(response.type_str())
-            streamHandler.sendMessage(response)
-          except socket.timeout:
-            self.log.warn('Socket timed out. Closing the connection.')
-            break
-          except socket.error:
-            self.log.warn('Remote client disconneded. Closing the connection.')
-            break
+    self._socket.listen(LISTEN_BACKLOG)
+    self.log.info('Listening for incoming connections in port [{}]...'.format(
+        self._args.port))
+    writer = FileWriter(self._args.dirs, self._args.writer_workers,
+        self._args.durability)
+    session_loop = SessionLoop(self._args.token, self._monitor,
+        self._args.workers, self._args.window, writer,
+        self._args.max_kb_per_sec, self._args.max_session_kb_per_sec,
+        MessageSerde.max_body_bytes(self._args.max_upload_bytes))
+    session_loop.add_listener(self._socket)
+    try:
+      session_loop.run()
+    finally:
+      writer.close()
 
   def __exit__(self, exc_type, exc_value, traceback):
     self.log.debug('Exiting...')
@@ -546,57 +3332,761 @@ class RemoteServer(object):
       self._monitor = None
 
 
+class RemoteSession(object):
+  """ The state of one client connection served by a SessionLoop.
+
+  Messages are read incrementally from the non-blocking socket into buffers
+  of their exact size and responses are queued until the socket is
+  writable. Requests are handled one at a time, in order, by a worker.
+  """
+  def __init__(self, token, monitor, connection, address, writer=None,
+      max_body_bytes=None):
+    self.log = Logger(type(self).__name__)
+    self.connection = connection
+    self.address = address
+    # Connections from the same host share their fair share of the workers.
+    self.client = address[0] if type(address) == tuple else str(address)
+    self.handler = RemoteMessageHandler(monitor, writer)
+    # Caps the rate this session is read at, if set.
+    self.bucket = None
+    self.requests = []
+    self.busy = False
+    self.closed = False
+    self.last_active = time.time()
+    self._serde = MessageSerde(token, max_body_bytes)
+    self._output = []
+    self._output_offset = 0
+    self._start_header()
+
+  def fileno(self):
+    return self.connection.fileno()
+
+  def read(self, budget=None):
+    '''Appends to [requests] a tuple (request, body_bytes) for each message
+    completed by the available bytes and returns how many were read, at
+    most [budget] or BUFFER_SIZE_BYTES.
+
+    Raises socket.error once the client disconnects.
+    '''
+    if budget == None:
+      budget = BUFFER_SIZE_BYTES
+    total = 0
+    while total < budget:
+      remaining = len(self._buffer) - self._received
+      try:
+        received = self.connection.recv_into(
+            self._view[self._received:], min(remaining, budget - total))
+      except socket.error as exception:
+        if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return total
+        raise
+      if received == 0:
+        raise socket.error('Remote client disconnected.')
+      self.last_active = time.time()
+      self._received += received
+      total += received
+      if self._received == len(self._buffer):
+        self._complete_buffer()
+    return total
+
+  def _start_header(self):
+    self._header = None
+    self._header_time = None
+    self._frames = None
+    self._request = None
+    self._start_buffer(bytearray(MessageSerde.HEADER_BYTES))
+
+  def _start_buffer(self, data):
+    self._buffer = data
+    self._view = memoryview(self._buffer)
+    self._received = 0
+
+  def _complete_buffer(self):
+    '''Moves on after the header, the body or one of the raw frames that
+    follow it were received into their buffer.
+    '''
+    if self._header is None:
+      self._header = self._serde.parse_header(str(self._buffer))
+      self._header_time = time.time()
+      self._start_buffer(bytearray(self._header[3]))
+      if len(self._buffer) > 0:
+        return
+    if self._frames is None:
+      msg_type, request_id, body_md5, body_bytes = self._header
+      self._frames = []
+      request = self._serde.deserialise_body(
+          msg_type, request_id, body_md5, self._buffer, self._frames)
+      self._request = (request, body_bytes + \
+          sum([len(blob) for blob, frame_md5 in self._frames]))
+    else:
+      MessageSerde.check_frame(*self._frames.pop(0))
+    # Frames are received straight into the buffers the body decoded into.
+    while self._frames:
+      self._start_buffer(self._frames[0][0].data)
+      if len(self._buffer) > 0:
+        return
+      MessageSerde.check_frame(*self._frames.pop(0))
+    self.requests.append(self._request)
+    METRICS.record('network.recv_secs', time.time() - self._header_time)
+    self._start_header()
+
+  def respond(self, response):
+    self._output.append(self._serde.serialise(response))
+    if response.type == MessageType.PING_RESPONSE:
+      self._serde.set_wire_format(response.body['wire_format'])
+
+  def wants_write(self):
+    return len(self._output) > 0
+
+  def write(self):
+    '''Sends as much of the queued responses as the socket takes.'''
+    while self._output:
+      data = memoryview(self._output[0])[self._output_offset:]
+      try:
+        sent = self.connection.send(data)
+      except socket.error as exception:
+        if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      self._output_offset += sent
+      METRICS.increment('network.bytes_sent', sent)
+      if self._output_offset == len(self._output[0]):
+        self._output.pop(0)
+        self._output_offset = 0
+
+  def close(self):
+    self.closed = True
+    self.connection.close()
+
+
+class SessionLoop(object):
+  """ Serves many client connections from a single select() loop.
+
+  The loop only moves bytes. Requests are handled off-loop by [workers]
+  threads, one request per session at a time so uploads stay in order.
+  When workers free up the ready session of the client that has been
+  served the fewest request bytes goes first, so one client streaming a
+  large upload does not starve the small requests of others. A session
+  stops being read while [window] of its requests are queued or while
+  reading more would exceed [max_kb_per_sec] across all sessions or
+  [max_session_kb_per_sec] of its own. Connections announcing a message
+  body over [max_body_bytes] are closed.
+  """
+  def __init__(self, token, monitor, workers, window, writer=None,
+      max_kb_per_sec=0, max_session_kb_per_sec=0, max_body_bytes=None):
+    self.log = Logger(type(self).__name__)
+    self._token = token
+    self._max_body_bytes = max_body_bytes
+    self._monitor = monitor
+    self._writer = writer
+    self._workers = workers
+    self._window = window
+    self._bucket = TokenBucket.create('all_sessions', max_kb_per_sec)
+    self._max_session_kb_per_sec = max_session_kb_per_sec
+    self._pool = multiprocessing.pool.ThreadPool(workers)
+    self._listeners = []
+    self._sessions = []
+    self._served_bytes = {}
+    self._busy_workers = 0
+    self._done = Queue.Queue()
+    self._wakeup_read, self._wakeup_write = os.pipe()
+    self._running = True
+
+  def add_listener(self, listener):
+    listener.setblocking(0)
+    self._listeners.append(listener)
+
+  def add_connection(self, connection, address):
+    self.log.info('Accepted connection from address: [{}]'.format(
+        str(address)))
+    connection.setblocking(0)
+    session = RemoteSession(self._token, self._monitor, connection, address,
+        self._writer, self._max_body_bytes)
+    session.bucket = TokenBucket.create(
+        'session_{}'.format(address), self._max_session_kb_per_sec)
+    if session.client not in self._served_bytes:
+      # Newcomers start level with the least served client.
+      self._served_bytes[session.client] = \
+          min(self._served_bytes.values()) if self._served_bytes else 0
+    self._sessions.append(session)
+    return session
+
+  def run(self):
+    '''Serves all connections until stop() is called.'''
+    try:
+      while self._running:
+        self._poll()
+        self._finish_requests()
+        self._dispatch_requests()
+        self._close_idle_sessions()
+    finally:
+      for session in list(self._sessions):
+        self._close(session)
+      self._pool.close()
+      self._pool.join()
+      os.close(self._wakeup_read)
+      os.close(self._wakeup_write)
+
+  def stop(self):
+    self._running = False
+    self._wakeup()
+
+  def _poll(self):
+    readers = self._listeners + [self._wakeup_read]
+    timeout = SESSION_LOOP_TICK_SECS
+    for session in self._sessions:
+      if len(session.requests) >= self._window:
+        continue
+      delay = max([bucket.delay() for bucket in self._buckets(session)] + [0])
+      if delay > 0:
+        timeout = min(timeout, delay)
+      else:
+        readers.append(session)
+    writers = [session for session in self._sessions if session.wants_write()]
+    try:
+      readable, writable, unused = select.select(
+          readers, writers, [], timeout)
+    except select.error as exception:
+      if exception.args[0] == errno.EINTR:
+        return
+      raise
+    for ready in readable:
+      if ready in self._listeners:
+        self._accept(ready)
+      elif ready == self._wakeup_read:
+        os.read(self._wakeup_read, WAKEUP_READ_BYTES)
+      elif not ready.closed:
+        self._safely(ready, lambda: self._read(ready))
+    for session in writable:
+      if not session.closed:
+        self._safely(session, session.write)
+
+  def _read(self, session):
+    buckets = self._buckets(session)
+    received = session.read(
+        min([BUFFER_SIZE_BYTES] + [bucket.burst for bucket in buckets]))
+    METRICS.increment('network.bytes_received', received)
+    for bucket in buckets:
+      bucket.take(received)
+
+  def _buckets(self, session):
+    return [bucket for bucket in (self._bucket, session.bucket) if bucket]
+
+  def _accept(self, listener):
+    try:
+      connection, address = listener.accept()
+    except socket.error as exception:
+      if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      raise
+    self.add_connection(connection, address)
+
+  def _safely(self, session, method):
+    try:
+      method()
+    except socket.error:
+      self.log.warn('Remote client disconneded. Closing the connection.')
+      self._close(session)
+    except HumaReadbleException as exception:
+      self.log.error('Closing the connection from [{}]: [{}].'.format(
+          session.address, exception.msg))
+      self._close(session)
+
+  def _dispatch_requests(self):
+    while self._busy_workers < self._workers:
+      ready = [session for session in self._sessions \
+          if session.requests and not session.busy]
+      if not ready:
+        return
+      session = min(ready, key=lambda s: self._served_bytes[s.client])
+      request, body_bytes = session.requests.pop(0)
+      self._served_bytes[session.client] += body_bytes
+      session.busy = True
+      self._busy_workers += 1
+      self._pool.apply_async(self._handle, (session, request))
+
+  def _handle(self, session, request):
+    '''Runs on a worker thread and hands the response back to the loop.'''
+    try:
+      response = session.handler.handle_message(request)
+      assert response.type % 2 == 1, \
+          ('All responses must be of an odd type. '
+              'Found type [{}] instead.').format(response.type_str())
+      response.request_id = request.request_id
+      self._done.put((session, response))
+    except Exception as exception:
+      self._done.put((session, exception))
+    self._wakeup()
+
+  def _finish_requests(self):
+    while True:
+      try:
+        session, response = self._done.get_nowait()
+      except Queue.Empty:
+        return
+      self._busy_workers -= 1
+      session.busy = False
+      session.last_active = time.time()
+      if session.closed:
+        session.handler.close()
+        continue
+      if isinstance(response, Exception):
+        self.log.error('Failed to handle a request from [{}]: [{}].'.format(
+            session.address, response))
+        self._close(session)
+      else:
+        session.respond(response)
+
+  def _close_idle_sessions(self):
+    now = time.time()
+    for session in list(self._sessions):
+      if not session.busy and not session.requests and \
+          not session.wants_write() and \
+          now - session.last_active > SOCKET_TIMEOUT_SECS:
+        self.log.warn('Socket timed out. Closing the connection.')
+        self._close(session)
+
+  def _close(self, session):
+    if session in self._sessions:
+      self._sessions.remove(session)
+      session.close()
+      # Otherwise the worker handling its request closes it when done.
+      if not session.busy:
+        session.handler.close()
+      for bucket in self._buckets(session):
+        bucket.log_stats()
+    clients = set([other.client for other in self._sessions])
+    for client in self._served_bytes.keys():
+      if client not in clients:
+        del self._served_bytes[client]
+
+  def _wakeup(self):
+    os.write(self._wakeup_write, 'x')
+
+
+class FileCopier(object):
+  """ Copies file contents inside the kernel where possible.
+
+  copy_file_range(2) lets filesystems that support it share the blocks of
+  both files (a reflink) and the rest copy without the data ever reaching
+  user space. Platforms or filesystems without it fall back to plain reads
+  and writes.
+  """
+  _libc = None
+
+  @staticmethod
+  def _load_libc():
+    if FileCopier._libc == None and sys.platform.startswith('linux'):
+      try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        libc.copy_file_range.restype = ctypes.c_ssize_t
+        FileCopier._libc = libc
+      except (OSError, AttributeError):
+        pass
+    return FileCopier._libc
+
+  @staticmethod
+  def copy(src_fp, dst_fp):
+    '''Appends all of [src_fp] to [dst_fp] and returns the bytes copied.'''
+    libc = FileCopier._load_libc()
+    dst_fp.flush()
+    offset = ctypes.c_int64(0)
+    while libc != None:
+      count = libc.copy_file_range(src_fp.fileno(), ctypes.byref(offset),
+          dst_fp.fileno(), None, BUFFER_SIZE_BYTES * 16, 0)
+      if count == 0:
+        return offset.value
+      if count > 0:
+        continue
+      error_number = ctypes.get_errno()
+      if offset.value > 0 or \
+          error_number not in COPY_FILE_RANGE_FALLBACK_ERRNOS:
+        raise OSError(error_number, os.strerror(error_number))
+      break
+    src_fp.seek(0)
+    copied = 0
+    for fragment in iter(lambda: src_fp.read(BUFFER_SIZE_BYTES), b''):
+      dst_fp.write(fragment)
+      copied += len(fragment)
+    return copied
+
+
 class FileWriter(object):
-  def __init__(self, dirs):
+  """ Applies uploaded chunks to the remote dirs.
+
+  Files are written next to their destination and renamed into place once
+  complete so readers never see them half-written. The files of a batch
+  are applied concurrently by [workers] threads and directories already
+  known to exist are not checked again. [durability] picks what is
+  fsynced before a batch is acknowledged: nothing, every file of the
+  batch and then each parent dir once, or each file and its dir in turn.
+  Every session writing through the same FileWriter gets its own
+  temporary files, so concurrent uploads or copies of the same path never
+  mix their data and the last one renamed into place wins.
+  """
+  def __init__(self, dirs, workers=1, durability=None):
+    # Constants are defined after the classes that use them.
+    if durability == None:
+      durability = DURABILITY_NONE
+    assert durability in DURABILITY_MODES, durability
     self.log = Logger(type(self).__name__)
     self._dirs = dirs
+    self._durability = durability
+    self._pool = None
+    if workers > 1:
+      self._pool = multiprocessing.pool.ThreadPool(workers)
+    self._lock = threading.Lock()
+    self._known_dirs = set()
+    self._decompress_secs = 0.0
+    # session => set(tmp_path) of the files it has not finished yet.
+    self._partial = {}
 
-  def write(self, files):
+  def close(self):
+    if self._pool != None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+  def abandon(self, session):
+    '''Deletes the unfinished files of a [session] that went away.'''
+    with self._lock:
+      tmp_paths = self._partial.pop(session, set())
+    for tmp_path in tmp_paths:
+      if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    if tmp_paths:
+      self.log.info('Deleted [{}] files left unfinished by [{}].'.format(
+          len(tmp_paths), session))
+
+  def write(self, files, session=None):
+    '''Applies one chunk per uploaded file, [files] has one dict per dir.
+
+    Chunks are appended to a temporary file next to the destination which
+    is renamed into place once the last chunk arrives. A chunk either
+    carries raw 'data' or delta 'ops' against the current remote copy,
+    with the data and literal ops compressed if it names a 'compression'. A
+    rebuilt file whose MD5 does not match the local one is deleted together
+    with the stale copy so the next sync uploads it whole.
+    All chunks of a file must be written by the same [session].
+    Returns one dict per dir mapping the files renamed into place to the
+    'fingerprint' their last chunk carried, if any.
+    '''
+    tasks = []
+    for i in range(len(files)):
+      for rel_path, chunk in files[i].iteritems():
+        tasks.append((i, rel_path, chunk, session))
+    fingerprints = [dict() for i in range(len(files))]
     total_files = 0
     total_bytes = 0
+    finished_dirs = set()
+    start = time.time()
     try:
-      for i in range(len(files)):
-        root = self._dirs[i]
-        for rel_path, b64contents in files[i].items():
-          contents = base64.b64decode(b64contents)
-          self.log.debug('Writing [{}] bytes to root=[{}] file=[{}]...'\
-              .format(len(contents), root, rel_path))
-          path = os.path.join(root, rel_path)
-          dirname = os.path.dirname(path)
-          if not os.path.isdir(dirname):
-            os.makedirs(dirname)
-          with open(path, 'wb') as fp:
-            fp.write(contents)
+      if self._pool == None or len(tasks) < 2:
+        results = map(self._apply, tasks)
+      else:
+        results = self._pool.imap_unordered(self._apply, tasks)
+      for (i, rel_path, chunk, unused), written, finished in results:
+        if written is None:
+          continue
+        self.log.debug('Wrote [{}] bytes to root=[{}] file=[{}]...'.format(
+            written, self._dirs[i], rel_path))
+        total_bytes += written
+        if finished:
           total_files += 1
-          total_bytes += len(contents)
+          finished_dirs.add(os.path.dirname(
+              os.path.join(self._dirs[i], rel_path)))
+          if chunk.get('fingerprint'):
+            fingerprints[i][rel_path] = chunk['fingerprint']
+      if self._durability == DURABILITY_BATCH:
+        for dirname in finished_dirs:
+          FileWriter._fsync_dir(dirname)
+    finally:
+      METRICS.record('writer.write_secs', time.time() - start)
+      METRICS.increment('writer.files', total_files)
+      METRICS.increment('writer.bytes', total_bytes)
+      self.log.info(('Wrote a total of [{}] files and [{}] bytes after '
+          'spending [{:.3f}] CPU secs summed over threads decompressing.')\
+              .format(total_files, total_bytes, self._decompress_secs))
+    return fingerprints
+
+  def copy(self, copies, session=None):
+    '''Copies files the remote already has, [copies] has one dict per dir.
+
+    Each dict maps the relative path to write to a tuple (source_path,
+    mtime, fingerprint). Files that fail to copy are skipped and logged.
+    Returns the same as write() for the copies that were renamed into place.
+    '''
+    fingerprints = [dict() for i in range(len(copies))]
+    finished_dirs = set()
+    for i in range(len(copies)):
+      for rel_path, (source_path, mtime, fingerprint) in \
+          copies[i].iteritems():
+        path = os.path.join(self._dirs[i], rel_path)
+        tmp_path = self._tmp_path(path, session)
+        try:
+          self._makedirs(os.path.dirname(path))
+          with open(source_path, 'rb') as src_fp, \
+              self._open(tmp_path, 'wb') as out_fp:
+            FileCopier.copy(src_fp, out_fp)
+            if self._durability != DURABILITY_NONE:
+              os.fsync(out_fp.fileno())
+          if self._finish(path, tmp_path, None, mtime):
+            fingerprints[i][rel_path] = fingerprint
+            finished_dirs.add(os.path.dirname(path))
+        except (IOError, OSError) as exception:
+          self.log.warn('Failed to copy [{}] into [{}]: [{}].'.format(
+              source_path, path, exception))
+          if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    if self._durability == DURABILITY_BATCH:
+      for dirname in finished_dirs:
+        FileWriter._fsync_dir(dirname)
+    self.log.info('Copied a total of [{}] files already in the remote.'\
+        .format(sum([len(copied) for copied in fingerprints])))
+    return fingerprints
+
+  def _apply(self, task):
+    '''Returns a tuple (task, written_bytes, finished) for one chunk.'''
+    i, rel_path, chunk, session = task
+    path = os.path.join(self._dirs[i], rel_path)
+    tmp_path = self._tmp_path(path, session)
+    written = self._write_chunk(path, tmp_path, session, chunk)
+    finished = written is not None and chunk['last'] and \
+        self._finish(path, tmp_path, chunk.get('md5'), chunk.get('mtime'))
+    if finished or written is None:
+      with self._lock:
+        self._partial.get(session, set()).discard(tmp_path)
+    return (task, written, finished)
+
+  def _tmp_path(self, path, session):
+    return '{}.{}{}'.format(path, session or os.getpid(), TMP_SUFFIX)
+
+  def _write_chunk(self, path, tmp_path, session, chunk):
+    '''Returns the bytes written or None if the chunk was out of sequence
+    or its raw frame was discarded.
+    '''
+    offset = chunk['offset']
+    if 'data' in chunk and chunk['data'].data is None:
+      self.log.warn('Chunk at offset [{}] of file [{}] was discarded.'.format(
+          offset, path))
+      if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+      return None
+    if offset == 0:
+      self._makedirs(os.path.dirname(path))
+      mode = 'wb'
+      with self._lock:
+        self._partial.setdefault(session, set()).add(tmp_path)
+    elif os.path.isfile(tmp_path) and os.path.getsize(tmp_path) == offset:
+      mode = 'ab'
+    else:
+      self.log.error('Chunk at offset [{}] of file [{}] is out of sequence.'\
+          .format(offset, path))
+      if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+      return None
+    with self._open(tmp_path, mode) as out_fp:
+      if 'ops' in chunk:
+        with open(path, 'rb') as old_fp:
+          written = DeltaCodec.patch(old_fp, self._decompress_ops(chunk),
+              chunk['block_size'], out_fp)
+      else:
+        data = self._decompress(chunk, chunk['data'].data)
+        out_fp.write(data)
+        written = len(data)
+      if chunk['last'] and self._durability != DURABILITY_NONE:
+        out_fp.flush()
+        os.fsync(out_fp.fileno())
+      return written
+
+  def _open(self, tmp_path, mode):
+    try:
+      return open(tmp_path, mode)
+    except IOError as exception:
+      dirname = os.path.dirname(tmp_path)
+      if exception.errno != errno.ENOENT or dirname not in self._known_dirs:
+        raise
+      # The dir was removed behind our back since we cached it.
+      self._known_dirs.discard(dirname)
+      self._makedirs(dirname)
+      return open(tmp_path, mode)
+
+  def _makedirs(self, dirname):
+    if dirname in self._known_dirs:
+      return
+    # Other connections may be creating the same dirs concurrently.
+    try:
+      os.makedirs(dirname)
+    except OSError as exception:
+      if exception.errno != errno.EEXIST or not os.path.isdir(dirname):
+        raise
+    self._known_dirs.add(dirname)
+
+  @staticmethod
+  def _fsync_dir(dirname):
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+      os.fsync(dir_fd)
     finally:
-      self.log.info('Wrote a total of [{}] files and [{}] bytes.'\
-          .format(total_files, total_bytes))
+      os.close(dir_fd)
+
+  def _decompress_ops(self, chunk):
+    if not chunk.get('compression'):
+      return chunk['ops']
+    return [op if type(op) == list else Blob(self._decompress(chunk, op.data)) \
+        for op in chunk['ops']]
+
+  def _decompress(self, chunk, data):
+    compression = chunk.get('compression')
+    if not compression:
+      return data
+    start = Compressor.thread_cpu_secs()
+    data = Compressor.decompress(compression, data)
+    with self._lock:
+      self._decompress_secs += Compressor.thread_cpu_secs() - start
+    return data
+
+  def _finish(self, path, tmp_path, expected_md5, mtime=None):
+    if expected_md5 and DirCrawler.md5_hash(tmp_path) != expected_md5:
+      self.log.error(('Rebuilt file [{}] did not match the expected md5. '
+          'Discarding it.').format(path))
+      os.remove(tmp_path)
+      if os.path.isfile(path):
+        os.remove(path)
+      return False
+    if mtime != None:
+      # Stat fingerprints only match if the remote keeps the local mtime.
+      Fingerprint.set_mtime(tmp_path, mtime)
+    os.rename(tmp_path, path)
+    if self._durability == DURABILITY_FILE:
+      FileWriter._fsync_dir(os.path.dirname(path))
+    return True
+
+
+class ClientIndex(object):
+  """ The remote's copy of a client index kept between DIFF_REQUESTs.
+
+  Clients send their whole index once per connection and from then on only
+  the entries that changed since the generation we last acknowledged. The
+  whole index may leave out the dirs whose MerkleTree hash matched ours in
+  earlier TREE_REQUESTs, their entries are then taken from our own index.
+  Diffs only descend into the dirs whose hashes differ so they cost in
+  proportion to the differences rather than to the number of files.
+  """
+  def __init__(self):
+    self.log = Logger(type(self).__name__)
+    self._generation = None
+    self._trees = None
+
+  def apply(self, body, dst_trees):
+    '''Returns False if [body] is based on something we do not have.'''
+    base_generation = body.get('base_generation')
+    if base_generation == None:
+      trees = [MerkleTree(files) for files in body['files']]
+      matched_dirs = body.get('matched_dirs', [{} for tree in trees])
+      for i in range(len(trees)):
+        for rel_dir, dir_hash in matched_dirs[i].iteritems():
+          if dst_trees[i].hash(rel_dir) != dir_hash:
+            self.log.warn(('Dir [{}] changed since the client compared it. '
+                'Asking for a full resync.').format(rel_dir))
+            return False
+          trees[i].update(dict((rel_path, entry[:2]) \
+              for rel_path, entry in dst_trees[i].entries(rel_dir)), [])
+      self._trees = trees
+    elif self._trees == None or base_generation != self._generation:
+      self.log.warn(('Client index delta is based on generation [{}] but we '
+          'have [{}]. Asking for a full resync.').format(
+              base_generation, self._generation))
+      return False
+    else:
+      for i in range(len(self._trees)):
+        self._trees[i].update(
+            body['changed_files'][i], body['removed_files'][i])
+    self._generation = body['generation']
+    return True
+
+  def get(self, dir_index, rel_path):
+    '''Returns the client's (mtime, fingerprint) of a file or None.'''
+    return self._trees[dir_index].get(rel_path)
+
+  def diff(self, dst_trees):
+    '''Returns the client files that need to be uploaded to [dst_trees].'''
+    assert len(self._trees) == len(dst_trees), \
+        ('Both local and remote need to be monitoring the same amount of '
+            'dirs. local_dirs=[{}] remote_dirs=[{}]').format(
+                len(self._trees), len(dst_trees))
+    return [self._trees[i].diff(dst_trees[i]) for i in range(len(dst_trees))]
 
 
 class RemoteMessageHandler(object):
-  def __init__(self, monitor):
+  def __init__(self, monitor, writer=None):
     self.log = Logger(type(self).__name__)
     self._monitor = monitor
-    self._differ = StateDiffer()
-    self._writer = FileWriter(self._monitor.get_dirs())
+    self._client_index = ClientIndex()
+    self._writer = writer if writer else FileWriter(self._monitor.get_dirs())
+    # Tells our files apart from those of other sessions sharing [writer].
+    self._session = '{}.{:x}'.format(os.getpid(), id(self))
+
+  def close(self):
+    self._writer.abandon(self._session)
 
   def handle_message(self, req):
     resp = None
     self.log.info('RemoteMessageHandler received message of type [{}].'\
         .format(req.type_str()))
+    METRICS.increment('remote.requests.{}'.format(
+        MessageType.to_str(req.type).lower()))
     # MessageType.PING_REQUEST
     if req.type == MessageType.PING_REQUEST:
       resp = Message(MessageType.PING_RESPONSE)
+      resp.body['wire_format'] = self._negotiate_wire_format(
+          req.body.get('wire_formats', [WIRE_FORMAT_JSON]))
+      resp.body['fingerprint'] = self._monitor.get_fingerprint()
+      resp.body['compression'] = self._negotiate_compression(
+          req.body.get('compressions', [Compressor.NONE]))
+      resp.body['raw_frames'] = bool(req.body.get('raw_frames')) and \
+          resp.body['wire_format'] == WIRE_FORMAT_BINARY
     # MessageType.DIFF_REQUEST
     elif req.type == MessageType.DIFF_REQUEST:
       resp = Message(MessageType.DIFF_RESPONSE)
-      diff = self._differ.diff(req.body['files'], self._monitor.get_files())
-      resp.body['diff'] = diff
+      diff = None
+      with METRICS.timed('diff.secs'):
+        with self._monitor.locked_trees() as trees:
+          if self._client_index.apply(req.body, trees):
+            diff = self._client_index.diff(trees)
+      if diff != None:
+        resp.body['diff'], resp.body['copied'] = self._deduplicate(diff)
+        resp.body['generation'] = req.body['generation']
+        METRICS.increment('diff.files', sum([len(files) for files in diff]))
+        METRICS.increment('diff.copied_files', resp.body['copied'])
+      else:
+        resp.body['diff'] = [list() for i in self._monitor.get_dirs()]
+        resp.body['resync'] = True
+    # MessageType.TREE_REQUEST
+    elif req.type == MessageType.TREE_REQUEST:
+      resp = Message(MessageType.TREE_RESPONSE)
+      with self._monitor.locked_trees() as trees:
+        resp.body['differ'] = [[rel_dir \
+            for rel_dir, dir_hash in req.body['dirs'][i].iteritems() \
+                if trees[i].hash(rel_dir) != dir_hash] \
+            for i in range(len(trees))]
+    # MessageType.SIGNATURE_REQUEST
+    elif req.type == MessageType.SIGNATURE_REQUEST:
+      resp = Message(MessageType.SIGNATURE_RESPONSE)
+      resp.body['signatures'] = self._signatures(req.body['files'])
+    # MessageType.STATS_REQUEST
+    elif req.type == MessageType.STATS_REQUEST:
+      resp = Message(MessageType.STATS_RESPONSE)
+      resp.body['metrics'] = METRICS.snapshot()
     # MessageType.UPLOAD_REQUEST
     elif req.type == MessageType.UPLOAD_REQUEST:
       uploaded_files = req.body['uploaded_files']
-      self._writer.write(uploaded_files)
+      # The client already hashed these so there is no need to read them.
+      self._monitor.record(
+          self._writer.write(uploaded_files, self._session))
       resp = Message(MessageType.UPLOAD_RESPONSE)
     else:
       err = ('No idea how to handle MessageType=[{}] so '
@@ -606,6 +4096,58 @@ class RemoteMessageHandler(object):
     self.log.info('Responding with MessageType=[{}].'.format(resp.type_str()))
     return resp
 
+  def _deduplicate(self, diff):
+    '''Returns a tuple (diff, copied_files) without the files we copied.
+
+    Files in [diff] whose content the remote already holds under another
+    path are copied from there instead of being uploaded.
+    '''
+    copies = [dict() for i in range(len(diff))]
+    for i in range(len(diff)):
+      for rel_path in diff[i]:
+        mtime, fingerprint = self._client_index.get(i, rel_path)
+        source_path = self._monitor.find_by_fingerprint(fingerprint)
+        if source_path != None:
+          copies[i][rel_path] = (source_path, mtime, fingerprint)
+    if not any(copies):
+      return (diff, 0)
+    copied = self._writer.copy(copies, self._session)
+    self._monitor.record(copied)
+    return ([[rel_path for rel_path in diff[i] if rel_path not in copied[i]] \
+        for i in range(len(diff))], sum([len(files) for files in copied]))
+
+  def _negotiate_wire_format(self, offered):
+    '''Picks the first wire format offered by the client that we support.'''
+    for wire_format in offered:
+      if wire_format in WIRE_FORMATS:
+        return wire_format
+    return WIRE_FORMAT_JSON
+
+  def _negotiate_compression(self, offered):
+    '''Picks the first compression offered by the client that we support.'''
+    for compression in offered:
+      if compression in Compressor.available():
+        return compression
+    return Compressor.NONE
+
+  def _signatures(self, files):
+    '''Returns the block signatures of the remote copies of [files].
+
+    Files that do not exist remotely are left out so they get uploaded
+    whole.
+    '''
+    results = []
+    dirs = self._monitor.get_dirs()
+    for dir_index in range(len(files)):
+      current = {}
+      results.append(current)
+      for rel_path in files[dir_index]:
+        assert not os.path.isabs(rel_path), rel_path
+        abs_path = os.path.join(dirs[dir_index], rel_path)
+        if os.path.isfile(abs_path):
+          current[rel_path] = DeltaCodec.signature(abs_path)
+    return results
+
 
 #########################################################
 # Local Client Classes
@@ -616,10 +4158,17 @@ class LocalClient(object):
     self.log.debug('Initializing...')
     self._args = args
     self._socket = None
+    self._data_sockets = []
+    # Shared by all connections, even across reconnects.
+    self._bucket = TokenBucket.create('all_connections', args.max_kb_per_sec)
 
   def __enter__(self):
     self.log.debug('Entering...')
-    self._monitor = DirMonitor(self._args.dirs)
+    self._monitor = DirMonitor(self._args.dirs, self._args.inotify,
+        HashPool(self._args.hash_workers, self._args.hash_processes),
+        self._args.index_cache_dir, self._args.fingerprint,
+        self._args.exclude, self._args.ignore_files,
+        self._args.crawl_workers)
     self._monitor.start_monitoring()
     return self
 
@@ -646,69 +4195,890 @@ class LocalClient(object):
       time.sleep(1.0)
 
   def _connect(self):
-    self._socket = create_socket(self._args.ip_version)
-    self._socket.settimeout(SOCKET_TIMEOUT_SECS)
+    self._socket = self._connect_socket()
+    for i in range(self._args.streams):
+      self._data_sockets.append(self._connect_socket())
+
+  def _connect_socket(self):
+    connection = create_socket(self._args.ip_version)
+    connection.settimeout(SOCKET_TIMEOUT_SECS)
     remote = self._args.remote
     port = self._args.port
     self.log.info('Trying to connect to [{}:{}]'.format(remote, port))
     if self._args.ip_version == 4:
-      self._socket.connect((remote, port))
+      connection.connect((remote, port))
     elif self._args.ip_version == 6:
-      self._socket.connect((remote, port, 0, 0))
+      connection.connect((remote, port, 0, 0))
     else:
       raise Exception('Unknown IP version: [{}].'.format(ip_version))
     self.log.info('Successfully connected to [{}:{}]'.format(remote, port))
+    return connection
 
   def _process_messages(self):
-    with StreamHandler(self._args.token, self._socket) as stream_handler:
-      uploader = FileUploader(self._monitor, stream_handler)
+    buckets = [self._session_bucket('control')]
+    max_body_bytes = MessageSerde.max_body_bytes(self._args.max_upload_bytes)
+    with StreamHandler(self._args.token, self._socket,
+        [self._bucket, buckets[0]], max_body_bytes) as stream_handler:
+      compression, raw_frames = self._handshake(stream_handler)
+      data_windows = []
+      for i in range(len(self._data_sockets)):
+        buckets.append(self._session_bucket('stream_{}'.format(i)))
+        data_handler = StreamHandler(self._args.token, self._data_sockets[i],
+            [self._bucket, buckets[-1]], max_body_bytes)
+        self._handshake(data_handler)
+        data_windows.append(RequestWindow(data_handler, self._args.window))
+      uploader = FileUploader(self._monitor,
+          RequestWindow(stream_handler, self._args.window),
+          self._args.delta_min_bytes, self._args.max_upload_bytes,
+          compression, data_windows, self._args.large_file_bytes, raw_frames)
+      buckets = [bucket for bucket in [self._bucket] + buckets if bucket]
       while True:
         uploader.upload_files()
-        time.sleep(3.0)
+        for bucket in buckets:
+          bucket.log_stats()
+        if self._monitor.wait_for_change(CLIENT_POLL_SECS):
+          self._debounce()
+
+  def fetch_stats(self):
+    '''Returns the metrics of the remote without syncing anything.'''
+    connection = self._connect_socket()
+    with StreamHandler(self._args.token, connection) as stream_handler:
+      stream_handler.sendMessage(Message(MessageType.STATS_REQUEST))
+      return stream_handler.recvMessage().body['metrics']
+
+  def _session_bucket(self, name):
+    return TokenBucket.create(name, self._args.max_session_kb_per_sec)
+
+  def _debounce(self):
+    '''Waits until no change was seen for [debounce_ms] or for at most
+    DEBOUNCE_MAX_SECS so a burst of changes is uploaded in one go.
+    '''
+    deadline = time.time() + DEBOUNCE_MAX_SECS
+    while time.time() < deadline and \
+        self._monitor.wait_for_change(self._args.debounce_ms / 1000.0):
+      pass
+
+  def _handshake(self, stream_handler):
+    ping_request = Message(MessageType.PING_REQUEST)
+    ping_request.body['wire_formats'] = [self._args.wire_format]
+    if self._args.wire_format != WIRE_FORMAT_JSON:
+      ping_request.body['wire_formats'].append(WIRE_FORMAT_JSON)
+    ping_request.body['compressions'] = [self._args.compression]
+    if self._args.compression != Compressor.NONE:
+      ping_request.body['compressions'].append(Compressor.NONE)
+    ping_request.body['raw_frames'] = True
+    stream_handler.sendMessage(ping_request)
+    ping_response = stream_handler.recvMessage()
+    wire_format = ping_response.body.get('wire_format', WIRE_FORMAT_JSON)
+    stream_handler.set_wire_format(wire_format)
+    self.log.info('Negotiated wire_format=[{}].'.format(wire_format))
+    # The remote's fingerprints are the ones diffed so it gets to choose.
+    fingerprint = ping_response.body.get('fingerprint', Fingerprint.MD5)
+    if fingerprint not in Fingerprint.available():
+      raise HumaReadbleException(
+          'The remote uses unsupported fingerprint [{}].'.format(fingerprint))
+    self._monitor.set_fingerprint(fingerprint)
+    compression = ping_response.body.get('compression', Compressor.NONE)
+    self.log.info('Negotiated compression=[{}].'.format(compression))
+    raw_frames = ping_response.body.get('raw_frames', False)
+    self.log.info('Negotiated raw_frames=[{}].'.format(raw_frames))
+    return (compression, raw_frames)
 
   def _disconnect(self):
     if self._socket:
       self._socket.close()
       self._socket = None
+    for data_socket in self._data_sockets:
+      data_socket.close()
+    self._data_sockets = []
+
+
+class RequestWindow(object):
+  """ Keeps up to [size] requests in flight over a StreamHandler.
+
+  Requests are numbered and responses are matched back by request_id so the
+  remote is free to answer them in any order.
+  """
+  def __init__(self, stream_handler, size):
+    assert size > 0, size
+    self.log = Logger(type(self).__name__)
+    self._handler = stream_handler
+    self._size = size
+    self._next_request_id = 1
+    self._in_flight = set()
+    self._responses = {}
+    self._callbacks = {}
+
+  def send(self, message, on_response=None):
+    '''Sends a request once the window has room and returns its request_id.
+
+    [on_response] is called with the response as soon as it arrives.
+    '''
+    while len(self._in_flight) >= self._size:
+      self._recv_one()
+    message.request_id = self._next_request_id
+    self._next_request_id += 1
+    self._handler.sendMessage(message)
+    self._in_flight.add(message.request_id)
+    if on_response:
+      self._callbacks[message.request_id] = on_response
+    return message.request_id
+
+  def recv(self, request_id):
+    '''Returns the response to [request_id] waiting for it if needed.'''
+    while request_id not in self._responses:
+      self._recv_one()
+    return self._responses.pop(request_id)
+
+  def request(self, message):
+    return self.recv(self.send(message))
+
+  def drain(self):
+    '''Waits for all requests in flight and returns the unclaimed responses.'''
+    while self._in_flight:
+      self._recv_one()
+    responses = self._responses
+    self._responses = {}
+    return responses
+
+  def _recv_one(self):
+    response = self._handler.recvMessage()
+    if response.request_id not in self._in_flight:
+      raise HumaReadbleException(
+          'Received a response to unknown request_id [{}].'.format(
+              response.request_id))
+    self._in_flight.remove(response.request_id)
+    self._responses[response.request_id] = response
+    callback = self._callbacks.pop(response.request_id, None)
+    if callback:
+      callback(response)
+
+
+class TokenBucket(object):
+  """ Caps the rate bytes go through at [rate] per sec.
+
+  Up to [burst] bytes go through at once. Taking more than is left runs the
+  bucket into debt that the caller, and whoever takes next, waits out, so
+  any amount of bytes can go through at the capped rate.
+  """
+  def __init__(self, name, rate, burst=None):
+    assert rate > 0, rate
+    self.log = Logger(type(self).__name__)
+    self.name = name
+    self.rate = float(rate)
+    self.burst = burst if burst != None else max(
+        int(rate * BANDWIDTH_BURST_SECS), BANDWIDTH_MIN_BURST_BYTES)
+    self._lock = threading.Lock()
+    self._tokens = float(self.burst)
+    self._last = time.time()
+    self._waited_secs = 0.0
+    self._waits = 0
+
+  @staticmethod
+  def create(name, kb_per_sec):
+    '''Returns a TokenBucket for [kb_per_sec] or None if it is no cap.'''
+    if not kb_per_sec or kb_per_sec <= 0:
+      return None
+    return TokenBucket(name, kb_per_sec * 1024)
+
+  @staticmethod
+  def consume(buckets, count):
+    '''Takes [count] bytes from all [buckets], sleeping until every one of
+    them lets them through, and returns the secs slept.
+    '''
+    secs = max([bucket.take(count) for bucket in buckets] + [0])
+    if secs > 0:
+      time.sleep(secs)
+    return secs
+
+  def take(self, count):
+    '''Takes [count] bytes and returns the secs to wait before using them.'''
+    with self._lock:
+      self._refill()
+      self._tokens -= count
+      secs = max(0.0, -self._tokens / self.rate)
+      if secs > 0:
+        self._waited_secs += secs
+        self._waits += 1
+        METRICS.increment('bandwidth.held_secs', secs)
+      return secs
+
+  def delay(self):
+    '''Returns the secs until bytes can be taken without waiting.'''
+    with self._lock:
+      self._refill()
+      return max(0.0, -self._tokens / self.rate)
+
+  def _refill(self):
+    now = time.time()
+    self._tokens = min(float(self.burst),
+        self._tokens + (now - self._last) * self.rate)
+    self._last = now
+
+  def log_stats(self):
+    '''Logs how long the cap held bytes back since the last call.'''
+    with self._lock:
+      secs, waits = self._waited_secs, self._waits
+      self._waited_secs = 0.0
+      self._waits = 0
+    if waits:
+      self.log.info(('Held [{}] back [{}] times for [{:.3f}] secs to stay '
+          'under [{:.0f}] KB/sec.').format(self.name, waits, secs,
+              self.rate / 1024))
+
+
+class TransferStats(object):
+  """ Throughput of the uploads sent over one connection. """
+  def __init__(self, name):
+    self.log = Logger(type(self).__name__)
+    self.name = name
+    self.files = 0
+    self.messages = 0
+    self.bytes = 0
+    self._start = time.time()
+    self.secs = 0.0
+
+  def finish(self):
+    self.secs = time.time() - self._start
+
+  def mb_per_sec(self):
+    return self.bytes / (1024.0 * 1024.0 * max(self.secs, 0.001))
+
+  def log_stats(self):
+    self.log.info(('Uploaded [{}] files over [{}] in [{}] messages totalling '
+        '[{}] bytes at [{:.1f}] MB/sec.').format(self.files, self.name,
+            self.messages, self.bytes, self.mb_per_sec()))
+
+
+class LatencyHistogram(object):
+  """ Counts latencies in buckets of exponentially growing milliseconds. """
+  def __init__(self, name):
+    self.log = Logger(type(self).__name__)
+    self.name = name
+    self._lock = threading.Lock()
+    self._counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    self._total_secs = 0.0
+
+  def record(self, secs):
+    millis = secs * 1000.0
+    bucket = 0
+    while bucket < len(LATENCY_BUCKETS_MS) and \
+        millis > LATENCY_BUCKETS_MS[bucket]:
+      bucket += 1
+    with self._lock:
+      self._counts[bucket] += 1
+      self._total_secs += secs
+
+  def count(self):
+    return sum(self._counts)
+
+  def percentile(self, fraction):
+    '''Returns the upper bound in ms of the bucket holding [fraction].
+
+    Latencies beyond the last bucket are reported as None.
+    '''
+    counts = list(self._counts)
+    target = fraction * sum(counts)
+    seen = 0
+    for bucket in range(len(LATENCY_BUCKETS_MS)):
+      seen += counts[bucket]
+      if seen >= target:
+        return LATENCY_BUCKETS_MS[bucket]
+    return None
+
+  def to_dict(self):
+    '''Returns the histogram as a dict of JSON types.'''
+    counts = list(self._counts)
+    buckets = dict([('<={}ms'.format(LATENCY_BUCKETS_MS[i]), counts[i]) \
+        for i in range(len(LATENCY_BUCKETS_MS))])
+    buckets['>{}ms'.format(LATENCY_BUCKETS_MS[-1])] = counts[-1]
+    return {
+        'count': sum(counts),
+        'total_secs': self._total_secs,
+        'p50_ms': self.percentile(0.5),
+        'p90_ms': self.percentile(0.9),
+        'p99_ms': self.percentile(0.99),
+        'buckets': buckets,
+    }
+
+  def log_stats(self):
+    counts = list(self._counts)
+    buckets = ['<={}ms:{}'.format(LATENCY_BUCKETS_MS[i], counts[i]) \
+        for i in range(len(LATENCY_BUCKETS_MS)) if counts[i]]
+    if counts[-1]:
+      buckets.append('>{}ms:{}'.format(LATENCY_BUCKETS_MS[-1], counts[-1]))
+    self.log.info(('Latency [{}] of [{}] files p50=[{}ms] p90=[{}ms] '
+        'p99=[{}ms] buckets=[{}].').format(self.name, sum(counts),
+            self.percentile(0.5), self.percentile(0.9),
+            self.percentile(0.99), ' '.join(buckets)))
+
+
+class UploadScheduler(object):
+  """ Decides the order files get uploaded in.
+
+  Someone is usually waiting on the small file that was just edited, so
+  files under [large_file_bytes] go first, the most recently modified
+  ahead, and larger files follow, the smallest first. While large files
+  upload, the small files changed meanwhile are handed out between their
+  chunks, so large files proceed in the background of the small edits.
+  """
+  def __init__(self, dirs, large_file_bytes, express_max_bytes):
+    self.log = Logger(type(self).__name__)
+    self._dirs = dirs
+    self._large_file_bytes = large_file_bytes
+    self._express_max_bytes = express_max_bytes
+    self._lock = threading.Lock()
+    self._queued = set()
+    self._indexes = None
+    self._start = time.time()
+    self._large_queued = 0
+    self._expressed = 0
+    self._small_wait = LatencyHistogram('small_file_wait')
+    self._large_wait = LatencyHistogram('large_file_wait')
+
+  def start(self, files, indexes):
+    '''Queues the [files] the remote asked for out of [indexes].'''
+    with self._lock:
+      self._queued = set([(dir_index, rel_path) \
+          for dir_index in range(len(files)) \
+              for rel_path in files[dir_index]])
+      self._indexes = indexes
+      self._start = time.time()
+      self._expressed = 0
+      self._small_wait = LatencyHistogram('small_file_wait')
+      self._large_wait = LatencyHistogram('large_file_wait')
+    sizes = [self._size(indexes, dir_index, rel_path) \
+        for dir_index, rel_path in self._queued]
+    large = [size for size in sizes if size >= self._large_file_bytes]
+    self._large_queued = len(large)
+    if sizes:
+      self.log.info(('Queued [{}] small files totalling [{}] bytes ahead of '
+          '[{}] large files totalling [{}] bytes.').format(
+              len(sizes) - len(large), sum(sizes) - sum(large), len(large),
+              sum(large)))
+
+  def order(self, files, indexes):
+    '''Returns a list of (dir_index, rel_path, large) in upload order.'''
+    small = []
+    large = []
+    for dir_index in range(len(files)):
+      for rel_path in files[dir_index]:
+        size = self._size(indexes, dir_index, rel_path)
+        if size >= self._large_file_bytes:
+          large.append((size, dir_index, rel_path))
+        else:
+          entry = indexes[dir_index].get(rel_path)
+          small.append((-entry[0] if entry else 0, dir_index, rel_path))
+    small.sort()
+    large.sort()
+    return [(dir_index, rel_path, False) \
+        for unused, dir_index, rel_path in small] + \
+        [(dir_index, rel_path, True) for unused, dir_index, rel_path in large]
+
+  def sending(self, dir_index, rel_path, large):
+    '''Records how long a file waited in the queue once it starts going.'''
+    if large:
+      self._large_wait.record(time.time() - self._start)
+      with self._lock:
+        self._large_queued -= 1
+    else:
+      self._small_wait.record(time.time() - self._start)
+
+  def express(self, indexes):
+    '''Returns a list of (dir_index, rel_path) of the small files changed
+    in [indexes] since the last call that were not queued.
+    '''
+    with self._lock:
+      seen = self._indexes
+      if seen is None or all([seen[i] is indexes[i] \
+          for i in range(len(indexes))]):
+        return []
+      self._indexes = indexes
+      files = []
+      for i in range(len(indexes)):
+        for rel_path in CompactIndex.changed_keys(seen[i], indexes[i]):
+          entry = indexes[i].get(rel_path)
+          if entry and (i, rel_path) not in self._queued and \
+              entry[2] < self._express_max_bytes:
+            files.append((i, rel_path))
+      self._expressed += len(files)
+      large_queued = self._large_queued
+    if files:
+      self.log.info(('Cutting [{}] files changed meanwhile into the upload of '
+          'large files with [{}] more still queued.').format(
+              len(files), large_queued))
+    return files
+
+  def log_stats(self):
+    for histogram in (self._small_wait, self._large_wait):
+      if histogram.count() > 0:
+        histogram.log_stats()
+    if self._expressed:
+      self.log.info('Sent [{}] files changed during the upload.'.format(
+          self._expressed))
+
+  def _size(self, indexes, dir_index, rel_path):
+    entry = indexes[dir_index].get(rel_path)
+    if entry and entry[2] != None:
+      return entry[2]
+    try:
+      return os.path.getsize(os.path.join(self._dirs[dir_index], rel_path))
+    except OSError:
+      return 0
 
 
 class FileUploader(object):
-  def __init__(self, monitor, stream_handler):
+  def __init__(self, monitor, request_window, delta_min_bytes,
+      max_upload_bytes, compression=Compressor.NONE, data_windows=[],
+      large_file_bytes=None, raw_frames=False):
     self.log = Logger(type(self).__name__)
+    if large_file_bytes == None:
+      large_file_bytes = UPLOAD_LARGE_FILE_BYTES
     self._monitor = monitor
-    self._handler = stream_handler
+    self._window = request_window
+    self._data_windows = data_windows
+    self._delta_min_bytes = delta_min_bytes
+    self._max_upload_bytes = max_upload_bytes
+    self._compressor = Compressor(compression)
+    self._raw_frames = raw_frames
+    # Files changed during an upload skip the queue if they take a single
+    # chunk and would not be sent as a delta anyway.
+    self._scheduler = UploadScheduler(monitor.get_dirs(), large_file_bytes,
+        min(delta_min_bytes, max_upload_bytes, large_file_bytes))
+    # Only edits made while running tell how fast changes reach the remote.
+    self._start_time = time.time()
+    self._latency = LatencyHistogram('edit_to_remote_write')
+    self._generation = 0
+    # The index last acknowledged by the remote and its generation.
+    self._acked_files = None
+    self._acked_generation = None
 
   def upload_files(self):
+    with METRICS.timed('upload.cycle_secs'):
+      self._upload_files()
+
+  def _upload_files(self):
     # DIFF_REQUEST
-    diff_request = Message(MessageType.DIFF_REQUEST)
-    diff_request.body['files'] = self._monitor.files
-    self._handler.sendMessage(diff_request)
-    diff_response = self._handler.recvMessage()
+    diff_request, local_files = self._diff_request(
+        self._acked_files, compare_trees=True)
+    diff_response = self._window.request(diff_request)
+    if diff_response.body.get('resync'):
+      diff_request, local_files = self._diff_request(None)
+      diff_response = self._window.request(diff_request)
+    self._acked_files = local_files
+    self._acked_generation = diff_response.body['generation']
     files = diff_response.body['diff']
+    if diff_response.body.get('copied'):
+      self.log.info('The remote copied [{}] files it already had.'.format(
+          diff_response.body['copied']))
     self.log.info('A total of [{0}] files need to be uploaded.'\
         .format(len(files[0])))
+    METRICS.increment('upload.files', sum([len(paths) for paths in files]))
+    # SIGNATURE_REQUEST
+    signatures = self._request_signatures(files)
     # UPLOAD_REQUEST
-    upload_request = Message(MessageType.UPLOAD_REQUEST)
-    upload_request.body['uploaded_files'] = self._files_to_upload(files)
-    self._handler.sendMessage(upload_request)
-    upload_response = self._handler.recvMessage()
+    files_uploaded = any(files)
+    self._scheduler.start(files, local_files)
+    if self._data_windows:
+      self._upload_striped(files, signatures)
+    else:
+      stats = TransferStats('control')
+      self._upload(self._window, files, signatures, stats)
+      stats.log_stats()
+    if files_uploaded:
+      self._scheduler.log_stats()
+      self._compressor.log_stats()
+      if self._latency.count() > 0:
+        self._latency.log_stats()
 
-  def _files_to_upload(self, files):
-    results = []
+  def get_latency_histogram(self):
+    return self._latency
+
+  def _upload(self, window, files, signatures, stats):
+    for uploaded_files in self._upload_batches(files, signatures, stats):
+      upload_request = Message(MessageType.UPLOAD_REQUEST)
+      upload_request.body['uploaded_files'] = uploaded_files
+      window.send(upload_request, self._latency_recorder(uploaded_files))
+    window.drain()
+    stats.finish()
+
+  def _latency_recorder(self, uploaded_files):
+    '''Returns a callback recording the latency of the edits in a batch.'''
+    mtimes = [chunk['mtime'] for dir_files in uploaded_files \
+        for chunk in dir_files.values() \
+            if chunk['last'] and chunk['mtime'] >= self._start_time]
+    if not mtimes:
+      return None
+    def record(response):
+      now = time.time()
+      for mtime in mtimes:
+        self._latency.record(now - mtime)
+    return record
+
+  def _upload_striped(self, files, signatures):
+    '''Uploads [files] concurrently over all data connections.
+
+    Whole files are assigned to connections, as the chunks of a file must
+    arrive in order, balancing the bytes each one sends.
+    '''
+    start = time.time()
+    stripes = self._stripe(files, len(self._data_windows))
+    all_stats = []
+    errors = []
+    threads = []
+    for i in range(len(self._data_windows)):
+      stats = TransferStats('stream_{}'.format(i))
+      all_stats.append(stats)
+      thread = threading.Thread(target=self._upload_stripe,
+          args=(self._data_windows[i], stripes[i], signatures, stats, errors),
+          name='UploadThread-{}'.format(i))
+      thread.start()
+      threads.append(thread)
+    self._keep_alive_until_done(threads, errors)
+    if errors:
+      raise errors[0]
+    secs = time.time() - start
+    total_bytes = sum([stats.bytes for stats in all_stats])
+    for stats in all_stats:
+      stats.log_stats()
+    self.log.info(('Uploaded [{}] bytes over [{}] streams in [{:.3f}] secs '
+        'at [{:.1f}] MB/sec.').format(total_bytes, len(all_stats), secs,
+            total_bytes / (1024.0 * 1024.0 * max(secs, 0.001))))
+
+  def _upload_stripe(self, window, files, signatures, stats, errors):
+    try:
+      if any(files):
+        self._upload(window, files, signatures, stats)
+      else:
+        # Keeps the idle connection from timing out on the remote.
+        self._send_keep_alive(window)
+        window.drain()
+        stats.finish()
+    except Exception as exception:
+      errors.append(exception)
+
+  def _keep_alive_until_done(self, threads, errors):
+    '''Waits for the upload [threads] of the data windows at the same index.
+
+    The remote closes connections idle for SOCKET_TIMEOUT_SECS, so every
+    KEEP_ALIVE_SECS the control connection and the data connections done
+    with their stripe get an empty UPLOAD_REQUEST until all are done. Once a
+    thread failed the rest are only waited for.
+    '''
+    windows = [self._window]
+    while True:
+      deadline = time.time() + KEEP_ALIVE_SECS
+      for thread in threads:
+        thread.join(max(0.0, deadline - time.time()))
+      if not any([thread.is_alive() for thread in threads]):
+        break
+      if errors:
+        continue
+      for i in range(len(threads)):
+        if not threads[i].is_alive() and \
+            self._data_windows[i] not in windows:
+          windows.append(self._data_windows[i])
+      for window in windows:
+        self._send_keep_alive(window)
+    if not errors:
+      for window in windows:
+        window.drain()
+
+  def _send_keep_alive(self, window):
+    keep_alive = Message(MessageType.UPLOAD_REQUEST)
+    keep_alive.body['uploaded_files'] = [
+        dict() for path in self._monitor.get_dirs()]
+    window.send(keep_alive)
+
+  def _stripe(self, files, count):
+    '''Splits [files] into [count] lists of files with similar total bytes.'''
     dirs = self._monitor.get_dirs()
+    sized_files = []
     for dir_index in range(len(files)):
-      local_root = dirs[dir_index]
-      files_per_dir = files[dir_index]
-      current = {}
-      results.append(current)
-      for rel_path in files_per_dir:
-        assert not os.path.isabs(rel_path), rel_path
-        abs_path = os.path.join(local_root, rel_path)
-        with open(abs_path, 'r') as fp:
-          content = fp.read()
-        content = base64.b64encode(content)
-        current[rel_path] = content
-    return results
+      for rel_path in files[dir_index]:
+        try:
+          size = os.path.getsize(os.path.join(dirs[dir_index], rel_path))
+        except OSError:
+          size = 0
+        sized_files.append((size, dir_index, rel_path))
+    sized_files.sort(reverse=True)
+    stripes = [[list() for i in range(len(files))] for j in range(count)]
+    stripe_bytes = [0] * count
+    for size, dir_index, rel_path in sized_files:
+      smallest = stripe_bytes.index(min(stripe_bytes))
+      stripes[smallest][dir_index].append(rel_path)
+      stripe_bytes[smallest] += size
+    return stripes
+
+  def get_compressor(self):
+    return self._compressor
+
+  def _diff_request(self, acked_files, compare_trees=False):
+    '''Returns a tuple (DIFF_REQUEST, local_files) for the current index.
+
+    The request holds the whole index if [acked_files] is None or otherwise
+    only what changed since then. With [compare_trees] the whole index
+    leaves out the dirs the remote already has the same files in.
+    '''
+    local_files = self._monitor.get_files()
+    self._generation += 1
+    diff_request = Message(MessageType.DIFF_REQUEST)
+    diff_request.body['generation'] = self._generation
+    if acked_files == None and compare_trees:
+      diff_request.body['base_generation'] = None
+      diff_request.body['files'], diff_request.body['matched_dirs'] = \
+          self._compare_trees(local_files)
+    elif acked_files == None:
+      diff_request.body['base_generation'] = None
+      diff_request.body['files'] = [dict((path, entry[:2]) \
+          for path, entry in files.iteritems()) for files in local_files]
+      self.log.info('Sending the whole index as generation [{}].'.format(
+          self._generation))
+    else:
+      diff_request.body['base_generation'] = self._acked_generation
+      changed_files = []
+      removed_files = []
+      for i in range(len(local_files)):
+        changed, removed = FileUploader._index_delta(
+            acked_files[i], local_files[i])
+        changed_files.append(changed)
+        removed_files.append(removed)
+      diff_request.body['changed_files'] = changed_files
+      diff_request.body['removed_files'] = removed_files
+      self.log.info(('Sending index generation [{}] with [{}] changed and '
+          '[{}] removed entries.').format(self._generation,
+              sum([len(changed) for changed in changed_files]),
+              sum([len(removed) for removed in removed_files])))
+    return (diff_request, local_files)
+
+  def _compare_trees(self, local_files):
+    '''Returns a tuple (files, matched_dirs) describing [local_files].
+
+    Starting at the roots, asks the remote which dirs have a MerkleTree hash
+    other than ours and only descends into those, one round trip per level.
+    The files right inside dirs that differ are returned as index entries and
+    the dirs that match as their hash.
+    '''
+    trees = [MerkleTree(files) for files in local_files]
+    files = [dict() for tree in trees]
+    matched_dirs = [dict() for tree in trees]
+    probes = [{'': tree.hash()} for tree in trees]
+    rounds = 0
+    while any(probes):
+      tree_request = Message(MessageType.TREE_REQUEST)
+      tree_request.body['dirs'] = probes
+      differ = self._window.request(tree_request).body['differ']
+      rounds += 1
+      next_probes = [dict() for tree in trees]
+      for i in range(len(trees)):
+        differing = set(differ[i])
+        for rel_dir, dir_hash in probes[i].iteritems():
+          if rel_dir not in differing:
+            matched_dirs[i][rel_dir] = dir_hash
+            continue
+          for rel_path, entry in trees[i].files(rel_dir).iteritems():
+            files[i][rel_path] = entry[:2]
+          for subdir in trees[i].subdirs(rel_dir):
+            next_probes[i][subdir] = trees[i].hash(subdir)
+      probes = next_probes
+    self.log.info(('Sending [{}] index entries and [{}] matching dirs as '
+        'generation [{}] after [{}] tree comparisons.').format(
+            sum([len(entries) for entries in files]),
+            sum([len(dirs) for dirs in matched_dirs]), self._generation,
+            rounds))
+    return (files, matched_dirs)
+
+  @staticmethod
+  def _index_delta(old, new):
+    '''Returns a tuple (changed, removed) between two indexes of one dir.'''
+    if old is new:
+      return ({}, [])
+    changed = {}
+    removed = []
+    for path in CompactIndex.changed_keys(old, new):
+      entry = new.get(path)
+      old_entry = old.get(path)
+      if entry == None:
+        if old_entry != None:
+          removed.append(path)
+      elif old_entry == None or old_entry[:2] != entry[:2]:
+        changed[path] = entry[:2]
+    return (changed, removed)
+
+  def _request_signatures(self, files):
+    dirs = self._monitor.get_dirs()
+    large_files = [list() for dir_files in files]
+    for dir_index in range(len(files)):
+      for rel_path in files[dir_index]:
+        try:
+          size = os.path.getsize(os.path.join(dirs[dir_index], rel_path))
+        except OSError:
+          # Gone since the diff, so it is skipped when uploading too.
+          continue
+        if size >= self._delta_min_bytes:
+          large_files[dir_index].append(rel_path)
+    if not any(large_files):
+      return [dict() for i in range(len(files))]
+    signature_request = Message(MessageType.SIGNATURE_REQUEST)
+    signature_request.body['files'] = large_files
+    signature_response = self._window.request(signature_request)
+    return signature_response.body['signatures']
+
+  def _upload_batches(self, files, signatures, stats):
+    '''Yields the 'uploaded_files' body of each UPLOAD_REQUEST.
+
+    A batch holds at most one chunk per file and about [max_upload_bytes]
+    of content, so memory on both ends stays flat whatever the diff size.
+    '''
+    batch = None
+    batch_bytes = 0
+    for dir_index, rel_path, chunk, chunk_bytes in \
+        self._chunks(files, signatures):
+      if batch is None or rel_path in batch[dir_index] or \
+          (batch_bytes > 0 and \
+              batch_bytes + chunk_bytes > self._max_upload_bytes):
+        if batch is not None:
+          stats.messages += 1
+          yield batch
+        batch = [dict() for i in range(len(files))]
+        batch_bytes = 0
+      batch[dir_index][rel_path] = chunk
+      batch_bytes += chunk_bytes
+      stats.bytes += chunk_bytes
+      if chunk['last']:
+        stats.files += 1
+    if batch is not None:
+      stats.messages += 1
+      yield batch
+
+  def _chunks(self, files, signatures):
+    '''Yields (dir_index, rel_path, chunk, chunk_bytes) for all files in
+    the order of the UploadScheduler.
+
+    Between the chunks of large files go the small files changed since.
+    '''
+    indexes = self._monitor.get_files()
+    for dir_index, rel_path, large in self._scheduler.order(files, indexes):
+      self._scheduler.sending(dir_index, rel_path, large)
+      signature = signatures[dir_index].get(rel_path)
+      try:
+        for chunk in self._file_chunks(
+            indexes, dir_index, rel_path, signature):
+          yield chunk
+          if large and not chunk[2]['last']:
+            for express_chunk in self._express_chunks():
+              yield express_chunk
+      except (IOError, OSError) as exception:
+        # Gone since the diff, which the next diff will tell the remote about.
+        self.log.debug('Skipping [{}]: [{}].'.format(rel_path, exception))
+
+  def _express_chunks(self):
+    indexes = self._monitor.get_files()
+    for dir_index, rel_path in self._scheduler.express(indexes):
+      try:
+        for chunk in self._file_chunks(indexes, dir_index, rel_path, None):
+          yield chunk
+      except IOError as exception:
+        # Gone again, which the next diff will tell the remote about.
+        self.log.debug('Skipping [{}]: [{}].'.format(rel_path, exception))
+
+  def _file_chunks(self, indexes, dir_index, rel_path, signature):
+    '''Yields (dir_index, rel_path, chunk, chunk_bytes) for one file.
+
+    The last chunk of a file carries its indexed fingerprint, so the remote
+    need not hash it again, if the file still looks like it did when it was
+    indexed after all of it has been read.
+    '''
+    assert not os.path.isabs(rel_path), rel_path
+    abs_path = os.path.join(self._monitor.get_dirs()[dir_index], rel_path)
+    with open(abs_path, 'rb') as fp:
+      mtime = os.fstat(fp.fileno()).st_mtime
+      compression = self._compressor.for_file(fp, abs_path)
+      if signature:
+        chunks = self._delta_chunks(fp, signature, compression)
+      else:
+        chunks = self._whole_chunks(fp, compression)
+      for chunk, chunk_bytes in chunks:
+        if chunk['last']:
+          chunk['mtime'] = mtime
+          entry = indexes[dir_index].get(rel_path)
+          if entry and DirCrawler._is_unchanged(
+              entry, os.fstat(fp.fileno())):
+            chunk['fingerprint'] = entry[1]
+        yield (dir_index, rel_path, chunk, chunk_bytes + len(rel_path))
+
+  def _whole_chunks(self, fp, compression):
+    size = os.fstat(fp.fileno()).st_size
+    if self._raw_frames and compression == Compressor.NONE and \
+        size >= RAW_FRAME_MIN_BYTES:
+      return self._frame_chunks(fp, size)
+    return self._read_chunks(fp, compression)
+
+  def _frame_chunks(self, fp, size):
+    '''Yields chunks whose data is sent straight from [fp] as raw frames.'''
+    offset = 0
+    while True:
+      count = min(self._max_upload_bytes, max(0, size - offset))
+      last = count < self._max_upload_bytes
+      chunk = {'offset': offset, 'data': FileRange(fp, offset, count),
+          'last': last}
+      yield (chunk, count)
+      offset += count
+      if last:
+        return
+
+  def _read_chunks(self, fp, compression):
+    offset = 0
+    while True:
+      data = fp.read(self._max_upload_bytes)
+      last = len(data) < self._max_upload_bytes
+      chunk = {'offset': offset, 'data': Blob(data), 'last': last}
+      if compression != Compressor.NONE:
+        chunk['data'] = Blob(self._compressor.compress(data))
+        chunk['compression'] = compression
+      yield (chunk, len(chunk['data']))
+      offset += len(data)
+      if last:
+        return
+
+  def _delta_chunks(self, fp, signature, compression):
+    reader = HashingReader(fp)
+    offset = 0
+    chunk = None
+    chunk_bytes = 0
+    for op in DeltaCodec.delta(reader, signature, self._max_upload_bytes):
+      offset_bytes = DeltaCodec.op_bytes(op, signature)
+      if type(op) != list and compression != Compressor.NONE:
+        op = Blob(self._compressor.compress(op.data))
+      op_bytes = 0 if type(op) == list else len(op)
+      if chunk is not None and \
+          (chunk_bytes + op_bytes > self._max_upload_bytes or \
+              len(chunk['ops']) >= DELTA_MAX_OPS_PER_CHUNK):
+        yield (chunk, chunk_bytes)
+        chunk = None
+      if chunk is None:
+        chunk = self._delta_chunk(offset, signature, compression)
+        chunk_bytes = 0
+      chunk['ops'].append(op)
+      chunk_bytes += op_bytes
+      offset += offset_bytes
+    if chunk is None:
+      chunk = self._delta_chunk(offset, signature, compression)
+      chunk_bytes = 0
+    chunk['last'] = True
+    chunk['md5'] = reader.hexdigest()
+    yield (chunk, chunk_bytes)
+
+  def _delta_chunk(self, offset, signature, compression):
+    chunk = {
+        'offset': offset,
+        'block_size': signature['block_size'],
+        'ops': [],
+        'last': False,
+    }
+    if compression != Compressor.NONE:
+      chunk['compression'] = compression
+    return chunk
 
 
 
@@ -716,9 +5086,71 @@ class FileUploader(object):
 # Constants
 #########################################################
 SOCKET_TIMEOUT_SECS = 5.0
+KEEP_ALIVE_SECS = 2.0
 BUFFER_SIZE_BYTES = 1024 * 1024
 LOG_LEVELS = ('error', 'warn', 'info', 'debug')
+DELTA_MIN_FILE_BYTES = 512 * 1024
+DELTA_MIN_BLOCK_BYTES = 1024
+DELTA_MAX_BLOCK_BYTES = 128 * 1024
+DELTA_MAX_OPS_PER_CHUNK = 64 * 1024
+TMP_SUFFIX = '.sync_dir_remotely.tmp'
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+MESSAGE_OVERHEAD_BYTES = 64 * 1024 * 1024
+UPLOAD_LARGE_FILE_BYTES = 4 * 1024 * 1024
+BANDWIDTH_BURST_SECS = 0.1
+BANDWIDTH_MIN_BURST_BYTES = 16 * 1024
+RAW_FRAME_MIN_BYTES = 1024 * 1024
+REQUEST_WINDOW = 4
+DATA_STREAMS = 0
+CLIENT_POLL_SECS = 3.0
+DEBOUNCE_MS = 20
+DEBOUNCE_MAX_SECS = 1.0
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LISTEN_BACKLOG = 16
+SERVER_WORKERS = 4
+WRITER_WORKERS = 4
+DURABILITY_NONE = 'none'
+DURABILITY_BATCH = 'batch'
+DURABILITY_FILE = 'file'
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_FILE)
+SESSION_LOOP_TICK_SECS = 0.5
+METRICS_DUMP_SECS = 60.0
+WAKEUP_READ_BYTES = 4096
+MONITOR_CRAWL_SECS = 5.0
+HASH_WORKERS = 4
+CRAWL_WORKERS = 1
+WALK_LISTINGS_PER_WORKER = 4
+INDEX_CACHE_DIR = os.path.join('~', '.cache', 'sync_dir_remotely')
+INDEX_CACHE_SAVE_SECS = 60.0
+HASH_PROCESS_CHUNKSIZE = 16
+FINGERPRINT_RACY_SECS = 2.0
+WRITE_THROUGH_VERIFY_EVERY = 100
+COMPACT_INDEX_MIN_OVERLAY = 4096
+COPY_FILE_RANGE_FALLBACK_ERRNOS = frozenset(
+    [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF])
+SENDFILE_FALLBACK_ERRNOS = frozenset(
+    [errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP])
+IGNORE_FILES = ('.gitignore', '.syncignore')
+INOTIFY_CRAWL_SECS = 10 * 60.0
+INOTIFY_WAIT_SECS = 1.0
+INOTIFY_SETTLE_SECS = 0.01
+INOTIFY_MAX_BATCH_SECS = 1.0
+INOTIFY_READ_BYTES = 64 * 1024
+WIRE_FORMAT_JSON = 'json'
+WIRE_FORMAT_BINARY = 'binary/1'
+WIRE_FORMATS = (WIRE_FORMAT_BINARY, WIRE_FORMAT_JSON)
+JSON_BLOB_KEY = '__blob__'
+COMPRESSION_DEFAULT = 'zlib/6'
+# From <time.h> on Linux.
+CLOCK_THREAD_CPUTIME_ID = 3
+COMPRESSION_SAMPLE_BYTES = 64 * 1024
+COMPRESSION_MAX_RATIO = 0.9
+COMPRESSED_EXTENSIONS = frozenset([
+    '.7z', '.bz2', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.lz4', '.mkv',
+    '.mov', '.mp3', '.mp4', '.png', '.rar', '.tgz', '.webp', '.whl', '.xz',
+    '.zip', '.zst'])
 LOG = Logger('main')
+METRICS = Metrics()
 
 
 
@@ -728,13 +5160,17 @@ LOG = Logger('main')
 def main():
   try:
     args = parse_args()
-    with  AutoShutdown(args.shutdown_secs) as shutdown:
+    with  AutoShutdown(args.shutdown_secs) as shutdown, \
+        MetricsDumper(METRICS, args.metrics_file, args.metrics_secs):
       args.token = read_token(args.token)
       Logger.LEVEL = args.verbosity
       LOG.info('Mode: [{}]'.format(args.mode))
       if args.mode == 'remote':
         with RemoteServer(args) as server:
           server.run()
+      elif args.mode == 'stats':
+        print(json.dumps(LocalClient(args).fetch_stats(), indent=2,
+            sort_keys=True))
       else:
         with LocalClient(args) as client:
           client.run()
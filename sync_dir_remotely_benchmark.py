@@ -0,0 +1,1164 @@
+#!/usr/bin/python2.7
+#
+# Benchmarks for the hot paths of sync_dir_remotely.py.
+#
+# Usage:
+#
+#   ./sync_dir_remotely_benchmark.py serde --index_files 100000
+#
+# Every benchmark can save its results as JSON and compare them with the
+# results saved by an earlier run, exiting with 1 if any got worse:
+#
+#   ./sync_dir_remotely_benchmark.py suite --json baseline.json
+#   ./sync_dir_remotely_benchmark.py suite --baseline baseline.json
+#
+
+#########################################################
+# Imports
+#########################################################
+import argparse
+import gc
+import json
+import marshal
+import multiprocessing
+import os
+import platform
+import Queue
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sync_dir_remotely import *
+
+
+
+#########################################################
+# Functions
+#########################################################
+def parse_args():
+  parser = argparse.ArgumentParser(
+      description='Benchmark sync_dir_remotely.py.')
+  parser.add_argument(
+      'benchmark',
+      type=str,
+      choices=sorted(BENCHMARKS.keys()),
+      help='Benchmark to run.',
+  )
+
+  parser.add_argument(
+      '--index_files',
+      type=int,
+      default=100 * 1000,
+      help='Number of entries in the synthetic file index.',
+  )
+
+  parser.add_argument(
+      '--upload_bytes',
+      type=int,
+      default=1024 * 1024 * 1024,
+      help='Total bytes of file contents in the synthetic upload.',
+  )
+
+  parser.add_argument(
+      '--recv_mb',
+      type=int,
+      nargs='+',
+      default=[1, 4, 16, 64, 256],
+      help='Message sizes in MB received over loopback.',
+  )
+
+  parser.add_argument(
+      '--legacy_max_mb',
+      type=int,
+      default=16,
+      help='Largest message size also timed with the legacy receive loop.',
+  )
+
+  parser.add_argument(
+      '--rtt_ms',
+      type=int,
+      default=100,
+      help='Simulated round trip time of the pipeline benchmark link.',
+  )
+
+  parser.add_argument(
+      '--windows',
+      type=int,
+      nargs='+',
+      default=[1, 4, 16],
+      help='Request windows compared by the pipeline benchmark.',
+  )
+
+  parser.add_argument(
+      '--pipeline_files',
+      type=int,
+      default=32,
+      help='Number of files uploaded by the pipeline benchmark.',
+  )
+
+  parser.add_argument(
+      '--pipeline_file_bytes',
+      type=int,
+      default=256 * 1024,
+      help='Size of each file uploaded by the pipeline benchmark.',
+  )
+
+  parser.add_argument(
+      '--writer_files',
+      type=int,
+      default=50 * 1000,
+      help='Number of small files written by the writer benchmark.',
+  )
+
+  parser.add_argument(
+      '--writer_workers',
+      type=int,
+      nargs='+',
+      default=[1, 4, 16],
+      help='FileWriter thread counts compared by the writer benchmark.',
+  )
+
+  parser.add_argument(
+      '--crawl_files',
+      type=int,
+      default=200 * 1000,
+      help='Number of files in the synthetic tree crawled.',
+  )
+
+  parser.add_argument(
+      '--crawl_workers',
+      type=int,
+      nargs='+',
+      default=[1, 4, 16],
+      help='DirCrawler walk thread counts compared by the crawl benchmark.',
+  )
+
+  parser.add_argument(
+      '--memory_files',
+      type=int,
+      nargs='+',
+      default=[1000 * 1000, 5 * 1000 * 1000],
+      help='Index sizes whose memory use is measured.',
+  )
+
+  parser.add_argument(
+      '--frame_file_mb',
+      type=int,
+      default=512,
+      help='Size of the file uploaded with and without raw frames.',
+  )
+
+  parser.add_argument(
+      '--trees',
+      type=str,
+      nargs='+',
+      default=sorted(SUITE_TREES.keys()),
+      choices=sorted(SUITE_TREES.keys()),
+      help='Synthetic trees measured by the suite benchmark.',
+  )
+
+  parser.add_argument(
+      '--steps',
+      type=str,
+      nargs='+',
+      default=SUITE_STEPS,
+      choices=SUITE_STEPS,
+      help='What the suite benchmark measures besides crawling each tree.',
+  )
+
+  parser.add_argument(
+      '--seed',
+      type=int,
+      default=0,
+      help='Seed of the contents and sizes of the suite trees.',
+  )
+
+  parser.add_argument(
+      '--repeat',
+      type=int,
+      default=3,
+      help='Times each suite step runs, only the fastest run counts.',
+  )
+
+  parser.add_argument(
+      '--tiny_files',
+      type=int,
+      default=100 * 1000,
+      help='Number of files in the tiny tree.',
+  )
+
+  parser.add_argument(
+      '--deep_chains',
+      type=int,
+      default=100,
+      help='Number of nested dir chains in the deep tree.',
+  )
+
+  parser.add_argument(
+      '--deep_levels',
+      type=int,
+      default=50,
+      help='Levels of each chain in the deep tree, one file per level.',
+  )
+
+  parser.add_argument(
+      '--huge_files',
+      type=int,
+      default=2,
+      help='Number of files in the huge tree.',
+  )
+
+  parser.add_argument(
+      '--huge_file_mb',
+      type=int,
+      default=2 * 1024,
+      help='Size of each file in the huge tree.',
+  )
+
+  parser.add_argument(
+      '--repo_files',
+      type=int,
+      default=20 * 1000,
+      help='Number of files in the tree mixing sources and binaries.',
+  )
+
+  parser.add_argument(
+      '--sync_timeout_secs',
+      type=int,
+      default=60 * 60,
+      help='Seconds a full sync of a suite tree may take.',
+  )
+
+  parser.add_argument(
+      '--json',
+      type=str,
+      default=None,
+      help='File the results are saved to as JSON.',
+  )
+
+  parser.add_argument(
+      '--baseline',
+      type=str,
+      default=None,
+      help='JSON results saved earlier to compare these results with.',
+  )
+
+  parser.add_argument(
+      '--tolerance',
+      type=float,
+      default=0.1,
+      help='Fraction by which a result may get worse before it regressed.',
+  )
+
+  return parser.parse_args()
+
+
+def timed(function, *args):
+  '''Returns a tuple (result, elapsed_secs) of calling [function].'''
+  gc.collect()
+  start = time.time()
+  result = function(*args)
+  return (result, time.time() - start)
+
+
+def report(name, **values):
+  '''Prints the numbers [values] and keeps them unrounded in RESULTS.'''
+  print('{:<40} {}'.format(name, ' '.join(['{}=[{}]'.format(
+      k, format_value(k, values[k])) for k in sorted(values.keys())])))
+  RESULTS[name] = dict(
+      (key, float(value)) for key, value in values.iteritems())
+
+
+def format_value(key, value):
+  if type(value) != float:
+    return str(value)
+  if key.startswith('files'):
+    return '{:.0f}'.format(value)
+  if key == 'secs_per_mb':
+    return '{:.4f}'.format(value)
+  if key.endswith('secs'):
+    return '{:.3f}'.format(value)
+  return '{:.1f}'.format(value)
+
+
+def synthetic_index(file_count):
+  index = {}
+  for i in xrange(file_count):
+    rel_path = 'dir_{}/sub_{}/file_{}.txt'.format(i % 97, i % 13, i)
+    index[rel_path] = (1500000000.0 + i, md5(str(i)))
+  return index
+
+
+def synthetic_upload(total_bytes):
+  '''Returns upload_files sharing a single 16MB buffer between files.'''
+  chunk = os.urandom(min(total_bytes, 16 * 1024 * 1024))
+  files = {}
+  remaining = total_bytes
+  while remaining > 0:
+    data = chunk if remaining >= len(chunk) else chunk[:remaining]
+    files['upload/file_{}.bin'.format(len(files))] = Blob(data)
+    remaining -= len(data)
+  return [files]
+
+
+def bench_serde_message(name, message):
+  for wire_format in WIRE_FORMATS:
+    serde = MessageSerde('benchmark')
+    serde.set_wire_format(wire_format)
+    data, serialise_secs = timed(serde.serialise, message)
+    data_bytes = len(data)
+    result, deserialise_secs = timed(serde.deserialise, data)
+    del data, result
+    report('{}[{}]'.format(name, wire_format),
+        bytes=data_bytes,
+        serialise_secs=serialise_secs,
+        deserialise_secs=deserialise_secs)
+
+
+def bench_serde(args):
+  message = Message(MessageType.DIFF_REQUEST)
+  message.body['files'] = [synthetic_index(args.index_files)]
+  bench_serde_message('serde.index_{}'.format(args.index_files), message)
+  message = Message(MessageType.UPLOAD_REQUEST)
+  message.body['uploaded_files'] = synthetic_upload(args.upload_bytes)
+  bench_serde_message('serde.upload_{}'.format(args.upload_bytes), message)
+
+
+def loopback_pair():
+  '''Returns a tuple (client, server) of connected loopback TCP sockets.'''
+  listener = create_socket(4)
+  listener.bind(('127.0.0.1', 0))
+  listener.listen(1)
+  client = create_socket(4)
+  client.connect(listener.getsockname())
+  server, address = listener.accept()
+  listener.close()
+  return (client, server)
+
+
+def bench_recv_message(name, handler_type, data):
+  client, server = loopback_pair()
+  sender = threading.Thread(target=client.sendall, args=(data,))
+  sender.start()
+  with handler_type('benchmark', server) as handler:
+    message, secs = timed(handler.recvMessage)
+  sender.join()
+  client.close()
+  mb = len(data) / float(1024 * 1024)
+  report(name,
+      mb=mb,
+      secs=secs,
+      secs_per_mb=secs / mb,
+      mb_per_sec=mb / secs)
+
+
+def bench_recv(args):
+  serde = MessageSerde('benchmark')
+  serde.set_wire_format(WIRE_FORMAT_BINARY)
+  for size_mb in args.recv_mb:
+    message = Message(MessageType.UPLOAD_REQUEST)
+    message.body['data'] = Blob(os.urandom(size_mb * 1024 * 1024))
+    data = serde.serialise(message)
+    del message
+    bench_recv_message('recv.stream_handler', BinaryStreamHandler, data)
+    if size_mb <= args.legacy_max_mb:
+      bench_recv_message('recv.legacy', LegacyStreamHandler, data)
+    del data
+
+
+
+def delayed_pair(delay_secs):
+  '''Returns a tuple (client, server) of sockets linked with a delay.'''
+  client, proxy_client = loopback_pair()
+  proxy_server, server = loopback_pair()
+  DelayedPump(proxy_client, proxy_server, delay_secs).start()
+  DelayedPump(proxy_server, proxy_client, delay_secs).start()
+  return (client, server)
+
+
+def bench_pipeline(args):
+  src_dir = tempfile.mkdtemp()
+  dst_dir = tempfile.mkdtemp()
+  try:
+    for i in xrange(args.pipeline_files):
+      with open(os.path.join(src_dir, 'file_{}.bin'.format(i)), 'wb') as fp:
+        fp.write(os.urandom(args.pipeline_file_bytes))
+    monitor = DirMonitor([src_dir])
+    for window in args.windows:
+      for name in os.listdir(dst_dir):
+        os.remove(os.path.join(dst_dir, name))
+      session_loop = SessionLoop(
+          'benchmark', DirMonitor([dst_dir]), SERVER_WORKERS, window)
+      client, server_socket = delayed_pair(args.rtt_ms / 2000.0)
+      session_loop.add_connection(server_socket, 'benchmark')
+      serving = threading.Thread(target=session_loop.run)
+      serving.start()
+      with StreamHandler('benchmark', client) as handler:
+        # One file per UPLOAD_REQUEST and no deltas.
+        uploader = FileUploader(monitor, RequestWindow(handler, window),
+            2 * args.pipeline_file_bytes, args.pipeline_file_bytes + 1024)
+        unused, secs = timed(uploader.upload_files)
+      session_loop.stop()
+      serving.join()
+      assert len(os.listdir(dst_dir)) == args.pipeline_files
+      report('pipeline.rtt_{}ms.window_{}'.format(args.rtt_ms, window),
+          files=args.pipeline_files,
+          secs=secs,
+          mb_per_sec=args.pipeline_files * \
+              args.pipeline_file_bytes / (1024 * 1024 * secs))
+  finally:
+    shutil.rmtree(src_dir)
+    shutil.rmtree(dst_dir)
+
+
+
+def writer_batches(file_count, batch_files):
+  '''Returns upload batches of small files spread over a deep tree.'''
+  batches = []
+  for start in xrange(0, file_count, batch_files):
+    files = {}
+    for i in xrange(start, min(file_count, start + batch_files)):
+      rel_path = os.path.join('dir_{}'.format(i % 97),
+          'sub_{}'.format(i % 13), 'file_{}.txt'.format(i))
+      files[rel_path] = {'offset': 0, 'data': Blob(str(i) * 16), 'last': True}
+    batches.append([files])
+  return batches
+
+
+def bench_writer_once(name, writer, batches):
+  # Write back the previous run so it does not slow this one down.
+  subprocess.call(['sync'])
+  def write_all():
+    for files in batches:
+      writer.write(files)
+  unused, secs = timed(write_all)
+  file_count = sum([len(files[0]) for files in batches])
+  report(name,
+      files=file_count,
+      secs=secs,
+      files_per_sec=file_count / secs)
+
+
+def bench_writer(args):
+  batches = writer_batches(args.writer_files, 1000)
+  dst_dir = tempfile.mkdtemp()
+  try:
+    bench_writer_once('writer.legacy', LegacyFileWriter([dst_dir]), batches)
+    for durability in DURABILITY_MODES:
+      for workers in args.writer_workers:
+        shutil.rmtree(dst_dir)
+        os.mkdir(dst_dir)
+        writer = FileWriter([dst_dir], workers, durability)
+        try:
+          bench_writer_once('writer.{}.workers_{}'.format(durability, workers),
+              writer, batches)
+        finally:
+          writer.close()
+  finally:
+    shutil.rmtree(dst_dir)
+
+
+
+def bench_index_cache(args):
+  index = {}
+  for rel_path, (mtime, md5_hash) in \
+      synthetic_index(args.index_files).iteritems():
+    index[rel_path] = (mtime, md5_hash, len(rel_path) * 1000,
+        int(mtime * 1000000000), len(index))
+  index = CompactIndex(index)
+  cache_dir = tempfile.mkdtemp()
+  try:
+    cache = IndexCache(cache_dir, 'benchmark')
+    unused, save_secs = timed(cache.save, index)
+    loaded, load_secs = timed(cache.load)
+    assert loaded == index
+    report('index_cache.{}'.format(args.index_files),
+        bytes=os.path.getsize(cache.get_path()),
+        save_secs=save_secs,
+        load_secs=load_secs)
+  finally:
+    shutil.rmtree(cache_dir)
+
+
+
+def synthetic_tree(root_dir, file_count):
+  '''Creates [file_count] empty files, 100 per dir two levels deep.'''
+  for i in xrange(file_count):
+    rel_dir = os.path.join('dir_{}'.format(i / 10000), 'sub_{}'.format(i / 100))
+    if i % 100 == 0:
+      os.makedirs(os.path.join(root_dir, rel_dir))
+    open(os.path.join(root_dir, rel_dir, 'file_{}.txt'.format(i)), 'wb').close()
+
+
+def bench_crawl(args):
+  root_dir = tempfile.mkdtemp()
+  try:
+    synthetic_tree(root_dir, args.crawl_files)
+    previous = LegacyDirCrawler(root_dir).crawl_and_hash({})
+    previous, secs = timed(LegacyDirCrawler(root_dir).crawl_and_hash,
+        previous)
+    report('crawl.legacy.{}'.format(args.crawl_files),
+        secs=secs,
+        files_per_sec=len(previous) / secs)
+    for workers in args.crawl_workers:
+      crawler = DirCrawler(root_dir, walk_workers=workers)
+      index = crawler.crawl_and_hash()
+      index, secs = timed(crawler.crawl_and_hash, index)
+      assert index == previous
+      report('crawl.workers_{}.{}'.format(workers, args.crawl_files),
+          secs=secs,
+          files_per_sec=len(index) / secs)
+  finally:
+    shutil.rmtree(root_dir)
+
+
+def resident_bytes():
+  with open('/proc/self/statm') as fp:
+    return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def crawled_entries(file_count):
+  '''Yields index items in the order a crawl finds them, dir by dir.'''
+  for i in xrange(file_count):
+    rel_path = 'dir_{}/sub_{}/file_{}.txt'.format(
+        i / 100000, (i / 1000) % 100, i)
+    yield (rel_path, (1500000000.0 + i, md5(str(i)), i % 65536,
+        1500000000000000000 + i * 1000, i))
+
+
+def in_child(function, *args):
+  '''Returns what [function] returns when called in a forked child.
+
+  Every call starts from the same heap so memory measurements are not
+  skewed by what earlier ones left behind.
+  '''
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    os.write(write_fd, marshal.dumps(function(*args)))
+    os._exit(0)
+  os.close(write_fd)
+  fragments = []
+  while True:
+    fragment = os.read(read_fd, BUFFER_SIZE_BYTES)
+    if not fragment:
+      break
+    fragments.append(fragment)
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+  return marshal.loads(''.join(fragments))
+
+
+def build_index(index_type, file_count, cache_path):
+  '''Returns a dict with the memory and speed of building an index.'''
+  gc.collect()
+  before = resident_bytes()
+  index = index_type()
+  start = time.time()
+  for rel_path, entry in crawled_entries(file_count):
+    index[rel_path] = entry
+  build_secs = time.time() - start
+  gc.collect()
+  result = {'bytes': resident_bytes() - before, 'build_secs': build_secs}
+  paths = ['dir_{}/sub_{}/file_{}.txt'.format(i / 100000, (i / 1000) % 100,
+      i) for i in xrange(0, file_count, max(1, file_count / 100000))]
+  start = time.time()
+  for rel_path in paths:
+    assert index.get(rel_path) != None
+  result['get_usecs'] = (time.time() - start) * 1000000 / len(paths)
+  with open(cache_path, 'wb') as fp:
+    marshal.dump(index.to_marshal() if index_type == CompactIndex else index,
+        fp)
+  return result
+
+
+def load_index(index_type, cache_path):
+  '''Returns the resident bytes of an index as loaded from a cache.'''
+  gc.collect()
+  before = resident_bytes()
+  with open(cache_path, 'rb') as fp:
+    index = marshal.load(fp)
+  if index_type == CompactIndex:
+    index = CompactIndex.from_marshal(index)
+  gc.collect()
+  return resident_bytes() - before
+
+
+def bench_index_memory(args):
+  cache_dir = tempfile.mkdtemp()
+  try:
+    cache_path = os.path.join(cache_dir, 'index')
+    for file_count in args.memory_files:
+      for name, index_type in (('dict', dict), ('compact', CompactIndex)):
+        result = in_child(build_index, index_type, file_count, cache_path)
+        loaded_bytes = in_child(load_index, index_type, cache_path)
+        report('index_memory.{}.{}'.format(name, file_count),
+            built_mb=result['bytes'] / (1024.0 * 1024),
+            loaded_mb=loaded_bytes / (1024.0 * 1024),
+            loaded_bytes_per_file=loaded_bytes / float(file_count),
+            build_secs=result['build_secs'],
+            get_usecs=result['get_usecs'])
+  finally:
+    shutil.rmtree(cache_dir)
+
+
+
+def peak_resident_bytes():
+  with open('/proc/self/status') as fp:
+    for line in fp:
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+
+def upload_file(src_dir, dst_dir, raw_frames):
+  '''Returns a dict with the secs and peak memory of syncing [src_dir].'''
+  monitor = DirMonitor([src_dir])
+  for name in os.listdir(dst_dir):
+    os.remove(os.path.join(dst_dir, name))
+  # Only the peak of the upload itself counts.
+  with open('/proc/self/clear_refs', 'w') as fp:
+    fp.write('5')
+  start_bytes = resident_bytes()
+  session_loop = SessionLoop('benchmark', DirMonitor([dst_dir]), 1, 4)
+  client, server_socket = loopback_pair()
+  session = session_loop.add_connection(server_socket, 'benchmark')
+  session._serde.set_wire_format(WIRE_FORMAT_BINARY)
+  serving = threading.Thread(target=session_loop.run)
+  serving.start()
+  with StreamHandler('benchmark', client) as handler:
+    handler.set_wire_format(WIRE_FORMAT_BINARY)
+    uploader = FileUploader(monitor, RequestWindow(handler, 4),
+        sys.maxint, MAX_UPLOAD_BYTES, raw_frames=raw_frames)
+    unused, secs = timed(uploader.upload_files)
+  session_loop.stop()
+  serving.join()
+  return {'secs': secs, 'peak_bytes': peak_resident_bytes() - start_bytes}
+
+
+def bench_frames(args):
+  src_dir = tempfile.mkdtemp()
+  dst_dir = tempfile.mkdtemp()
+  try:
+    with open(os.path.join(src_dir, 'file.bin'), 'wb') as fp:
+      for i in xrange(args.frame_file_mb):
+        fp.write(os.urandom(1024 * 1024))
+    for raw_frames in (False, True):
+      result = in_child(upload_file, src_dir, dst_dir, raw_frames)
+      report('frames.{}'.format('raw' if raw_frames else 'blob'),
+          mb=args.frame_file_mb,
+          secs=result['secs'],
+          mb_per_sec=args.frame_file_mb / result['secs'],
+          peak_mb=result['peak_bytes'] / (1024.0 * 1024))
+  finally:
+    shutil.rmtree(src_dir)
+    shutil.rmtree(dst_dir)
+
+
+
+def best_of(repeat, function, *args):
+  '''Returns the tuple (result, elapsed_secs) of the fastest call.'''
+  best = None
+  for i in xrange(max(1, repeat)):
+    result, secs = timed(function, *args)
+    if best == None or secs < best[1]:
+      best = (result, secs)
+  return best
+
+
+def text_corpus(seed):
+  '''Returns 1MB of source like lines made of seeded random words.'''
+  rng = random.Random(seed)
+  letters = 'abcdefghijklmnopqrstuvwxyz_'
+  words = [''.join([rng.choice(letters) for i in xrange(rng.randint(2, 12))])
+      for i in xrange(1000)]
+  lines = []
+  total_bytes = 0
+  while total_bytes < 1024 * 1024:
+    line = '  ' * rng.randint(0, 4) + ' '.join(
+        [rng.choice(words) for i in xrange(rng.randint(1, 12))]) + '\n'
+    lines.append(line)
+    total_bytes += len(line)
+  return ''.join(lines)[:1024 * 1024]
+
+
+def tiny_tree(files, args):
+  for i in xrange(args.tiny_files):
+    files.text(os.path.join('dir_{}'.format(i / 10000),
+        'sub_{}'.format(i / 100), 'file_{}.txt'.format(i)),
+        files.rng.randint(16, 256))
+
+
+def deep_tree(files, args):
+  for chain in xrange(args.deep_chains):
+    rel_dir = 'chain_{}'.format(chain)
+    for level in xrange(args.deep_levels):
+      rel_dir = os.path.join(rel_dir, 'level_{}'.format(level))
+      files.text(os.path.join(rel_dir, 'file.txt'),
+          files.rng.randint(64, 4096))
+
+
+def huge_tree(files, args):
+  for i in xrange(args.huge_files):
+    files.binary('huge_{}.bin'.format(i), args.huge_file_mb * 1024 * 1024)
+
+
+def repo_tree(files, args):
+  '''Sources of lognormal sizes around 4KB in modules of varying depth,
+  with one file in 20 a binary asset of up to 8MB.'''
+  for i in xrange(args.repo_files):
+    module = files.rng.randint(0, args.repo_files / 200)
+    rel_dir = os.path.join('src', 'module_{}'.format(module), *[
+        'pkg_{}'.format(module % (level + 2))
+            for level in xrange(files.rng.randint(0, 4))])
+    if files.rng.random() < 0.05:
+      files.binary(os.path.join('assets', 'module_{}'.format(module),
+          'asset_{}.bin'.format(i)),
+          files.rng.randint(64 * 1024, 8 * 1024 * 1024))
+    else:
+      files.text(os.path.join(rel_dir, 'source_{}.py'.format(i)),
+          min(1024 * 1024, int(files.rng.lognormvariate(8.3, 1.2))))
+
+
+def diff_indexes(index):
+  '''Returns a tuple (src, dst) of indexes as sent in DIFF_REQUESTs where
+  dst has one file in 10 changed and one in 20 missing.'''
+  src = dict((rel_path, entry[:2]) for rel_path, entry in index.iteritems())
+  dst = {}
+  for i, rel_path in enumerate(sorted(src.keys())):
+    if i % 20 == 19:
+      continue
+    mtime, fingerprint = src[rel_path]
+    dst[rel_path] = (mtime, md5(fingerprint) if i % 10 == 0 else fingerprint)
+  return (src, dst)
+
+
+def total_mb(index):
+  return sum([entry[2] for entry in index.itervalues()]) / (1024.0 * 1024)
+
+
+def bench_suite_crawl(name, root_dir, args):
+  hash_pool = HashPool(HASH_WORKERS)
+  try:
+    crawler = DirCrawler(root_dir, hash_pool=hash_pool,
+        walk_workers=CRAWL_WORKERS)
+    rel_paths, secs = best_of(args.repeat, crawler.crawl)
+    report(name + '.crawl',
+        files=len(rel_paths),
+        secs=secs,
+        files_per_sec=len(rel_paths) / secs)
+    index, secs = best_of(args.repeat, crawler.crawl_and_hash, {})
+    report(name + '.crawl_and_hash.all',
+        files=len(index),
+        secs=secs,
+        mb_per_sec=total_mb(index) / secs)
+    unused, secs = best_of(args.repeat, crawler.crawl_and_hash, index)
+    report(name + '.crawl_and_hash.unchanged',
+        files=len(index),
+        secs=secs,
+        files_per_sec=len(index) / secs)
+    return index
+  finally:
+    hash_pool.close()
+
+
+def bench_suite_diff(name, index, args):
+  src, dst = diff_indexes(index)
+  expected, secs = best_of(args.repeat, StateDiffer().diff, [src], [dst])
+  report(name + '.diff.state_differ',
+      files=len(src),
+      secs=secs,
+      files_per_sec=len(src) / secs)
+  # What the remote does with a whole client index.
+  dst_trees = [MerkleTree(dst)]
+  def apply_and_diff():
+    client_index = ClientIndex()
+    assert client_index.apply({'files': [src], 'generation': 1}, dst_trees)
+    return client_index.diff(dst_trees)
+  result, secs = best_of(args.repeat, apply_and_diff)
+  assert sorted(result[0]) == sorted(expected[0])
+  report(name + '.diff.client_index',
+      files=len(src),
+      secs=secs,
+      files_per_sec=len(src) / secs)
+
+
+def bench_suite_serde(name, index, args):
+  message = Message(MessageType.DIFF_REQUEST)
+  message.body['files'] = [
+      dict((rel_path, entry[:2]) for rel_path, entry in index.iteritems())]
+  bench_serde_message(name + '.serde', message)
+
+
+def free_port():
+  listener = create_socket(4)
+  listener.bind(('127.0.0.1', 0))
+  port = listener.getsockname()[1]
+  listener.close()
+  return port
+
+
+def start_sync_process(mode, root_dir, port, log_path):
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+      'sync_dir_remotely.py')
+  with open(log_path, 'wb') as log:
+    return subprocess.Popen([sys.executable, script, '-m', mode,
+        '-r', '127.0.0.1', '-p', str(port), '-d', root_dir,
+        '-t', SUITE_TOKEN, '-v', '1', '--index_cache_dir', ''],
+        stdout=log, stderr=subprocess.STDOUT)
+
+
+def remote_counters(port):
+  '''Returns the metric counters of the remote, None if it is not up yet.'''
+  args = argparse.Namespace(token=SUITE_TOKEN, ip_version=4,
+      remote='127.0.0.1', port=port, max_kb_per_sec=0,
+      max_session_kb_per_sec=0)
+  try:
+    return LocalClient(args).fetch_stats()['counters']
+  except socket.error:
+    return None
+
+
+def wait_for_files(port, file_count, processes, timeout_secs):
+  '''Polls the remote until it has written [file_count] files.'''
+  deadline = time.time() + timeout_secs
+  while True:
+    counters = remote_counters(port)
+    if counters != None and counters.get('writer.files', 0) >= file_count:
+      return
+    for process in processes:
+      assert process.poll() == None, \
+          'Sync process exited with [{}].'.format(process.returncode)
+    assert time.time() < deadline, \
+        'Sync took over [{}] secs.'.format(timeout_secs)
+    time.sleep(0.1)
+
+
+def bench_suite_sync(name, src_dir, index, args):
+  '''Times a full sync of [src_dir] into an empty dir with the remote and
+  the local client each running in its own process.'''
+  dst_dir = tempfile.mkdtemp()
+  log_dir = tempfile.mkdtemp()
+  port = free_port()
+  processes = []
+  try:
+    processes.append(start_sync_process('remote', dst_dir, port,
+        os.path.join(log_dir, 'remote.log')))
+    wait_for_files(port, 0, processes, 60)
+    start = time.time()
+    processes.append(start_sync_process('local', src_dir, port,
+        os.path.join(log_dir, 'local.log')))
+    wait_for_files(port, len(index), processes, args.sync_timeout_secs)
+    secs = time.time() - start
+    hash_pool = HashPool(HASH_WORKERS)
+    try:
+      synced = DirCrawler(dst_dir, hash_pool=hash_pool).crawl_and_hash()
+    finally:
+      hash_pool.close()
+    fingerprints = lambda entries: dict(
+        (rel_path, entry[1]) for rel_path, entry in entries.iteritems())
+    assert fingerprints(synced) == fingerprints(index), \
+        'Files synced to [{}] differ from [{}].'.format(dst_dir, src_dir)
+    report(name + '.sync',
+        files=len(index),
+        secs=secs,
+        files_per_sec=len(index) / secs,
+        mb_per_sec=total_mb(index) / secs)
+    # Only kept to tell what went wrong.
+    shutil.rmtree(log_dir)
+  finally:
+    for process in processes:
+      if process.poll() == None:
+        process.kill()
+      process.wait()
+    shutil.rmtree(dst_dir)
+
+
+def bench_suite(args):
+  for tree in args.trees:
+    name = 'suite.{}'.format(tree)
+    root_dir = tempfile.mkdtemp()
+    try:
+      files = SyntheticFiles(root_dir, args.seed)
+      SUITE_TREES[tree](files, args)
+      report(name + '.tree',
+          files=files.file_count,
+          mb=files.total_bytes / (1024.0 * 1024))
+      index = bench_suite_crawl(name, root_dir, args)
+      assert len(index) == files.file_count
+      if 'diff' in args.steps:
+        bench_suite_diff(name, index, args)
+      if 'serde' in args.steps:
+        bench_suite_serde(name, index, args)
+      if 'sync' in args.steps:
+        bench_suite_sync(name, root_dir, index, args)
+    finally:
+      shutil.rmtree(root_dir)
+
+
+
+def git_revision():
+  try:
+    with open(os.devnull, 'wb') as devnull:
+      return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+          cwd=os.path.dirname(os.path.abspath(__file__)),
+          stderr=devnull).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def save_results(path, args, regressions):
+  with open(path, 'w') as fp:
+    json.dump({
+        'meta': {
+            'benchmark': args.benchmark,
+            'args': vars(args),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'ts': time.time(),
+        },
+        'results': RESULTS,
+        'regressions': regressions,
+    }, fp, indent=2, sort_keys=True)
+
+
+def better_when(key):
+  '''Returns 1 if a higher [key] is better, -1 if lower is, 0 if neither.'''
+  if key.endswith('per_sec'):
+    return 1
+  if key == 'secs' or key.endswith('_secs') or key.endswith('_mb') or \
+      key == 'bytes':
+    return -1
+  return 0
+
+
+def compare_results(baseline_path, tolerance):
+  '''Prints how each result changed since those saved in [baseline_path].
+
+  Returns the results that got worse by more than [tolerance].
+  '''
+  with open(baseline_path) as fp:
+    baseline = json.load(fp)['results']
+  print('Compared with [{}]:'.format(baseline_path))
+  regressions = []
+  for name in sorted(RESULTS.keys()):
+    for key in sorted(RESULTS[name].keys()):
+      old = baseline.get(name, {}).get(key)
+      new = RESULTS[name][key]
+      if not old or not better_when(key):
+        continue
+      change = (new - old) / old
+      regressed = change * better_when(key) < -tolerance
+      if regressed:
+        regressions.append('{} {}'.format(name, key))
+      print('{:<56} old=[{:g}] new=[{:g}] change=[{:+.1%}]{}'.format(
+          '{} {}'.format(name, key), old, new, change,
+          ' REGRESSED' if regressed else ''))
+  return regressions
+
+
+
+#########################################################
+# Classes
+#########################################################
+class SyntheticFiles(object):
+  """ Writes files whose contents only depend on the seed and their order.
+
+  Text files are slices of a shared corpus, so they compress like sources
+  do. Binary files are built from 1MB blocks of seeded random bytes, each
+  starting with the number of its file and its offset, so they neither
+  compress nor repeat. Every file starts with something unique so no two
+  share a fingerprint.
+  """
+  def __init__(self, root_dir, seed):
+    self.rng = random.Random(seed)
+    self.file_count = 0
+    self.total_bytes = 0
+    self._root_dir = root_dir
+    self._corpus = text_corpus(seed)
+    self._block = ''.join([chr(self.rng.getrandbits(8))
+        for i in xrange(1024 * 1024)])
+
+  def text(self, rel_path, size):
+    header = '# {}\n'.format(rel_path)
+    offset = self.rng.randint(0, len(self._corpus) - 1)
+    data = (self._corpus[offset:] + self._corpus)[:max(0, size - len(header))]
+    with self._open(rel_path) as fp:
+      fp.write(header + data)
+    self._add(len(header) + len(data))
+
+  def binary(self, rel_path, size):
+    with self._open(rel_path) as fp:
+      for offset in xrange(0, size, len(self._block)):
+        rotate = (self.file_count * 7919 + offset / 4096) % len(self._block)
+        block = struct.pack('>QQ', self.file_count, offset) + \
+            self._block[rotate:] + self._block[:rotate]
+        fp.write(block[:min(len(self._block), size - offset)])
+    self._add(size)
+
+  def _open(self, rel_path):
+    path = os.path.join(self._root_dir, rel_path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    return open(path, 'wb')
+
+  def _add(self, file_bytes):
+    self.file_count += 1
+    self.total_bytes += file_bytes
+
+
+class DelayedPump(object):
+  '''Forwards bytes between two sockets [delay_secs] after receiving them.'''
+  def __init__(self, src, dst, delay_secs):
+    self._src = src
+    self._dst = dst
+    self._delay_secs = delay_secs
+    self._fragments = Queue.Queue()
+
+  def start(self):
+    for target in (self._receive, self._send):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+
+  def _receive(self):
+    while True:
+      try:
+        data = self._src.recv(BUFFER_SIZE_BYTES)
+      except socket.error:
+        data = ''
+      self._fragments.put((time.time() + self._delay_secs, data))
+      if not data:
+        return
+
+  def _send(self):
+    while True:
+      due, data = self._fragments.get()
+      time.sleep(max(0, due - time.time()))
+      if not data:
+        self._dst.shutdown(socket.SHUT_WR)
+        return
+      self._dst.sendall(data)
+
+
+class LegacyDirCrawler(DirCrawler):
+  '''The original crawl, os.walk plus a relpath and a stat per file.'''
+  def crawl_and_hash(self, previous_results):
+    data = {}
+    all_files = []
+    for root, dirs, files in os.walk(self.get_dir()):
+      for f in files:
+        rel_path = os.path.relpath(os.path.join(root, f), self.get_dir())
+        if not self._is_excluded(rel_path):
+          all_files.append(rel_path)
+    for rel_path in all_files:
+      try:
+        stat = os.stat(os.path.join(self.get_dir(), rel_path))
+      except OSError:
+        continue
+      previous = previous_results.get(rel_path)
+      if previous and DirCrawler._is_unchanged(previous, stat):
+        data[rel_path] = previous
+      else:
+        data[rel_path] = DirCrawler._entry(stat, md5(''))
+    return data
+
+
+class LegacyFileWriter(object):
+  '''The original writer, one file at a time and a makedirs check each.'''
+  def __init__(self, dirs):
+    self._dirs = dirs
+
+  def write(self, files):
+    for i in range(len(files)):
+      for rel_path, chunk in files[i].items():
+        path = os.path.join(self._dirs[i], rel_path)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+          os.makedirs(dirname)
+        with open(path + TMP_SUFFIX, 'wb') as out_fp:
+          out_fp.write(chunk['data'].data)
+        os.rename(path + TMP_SUFFIX, path)
+
+
+class BinaryStreamHandler(StreamHandler):
+  def __init__(self, token, socket):
+    StreamHandler.__init__(self, token, socket)
+    self.set_wire_format(WIRE_FORMAT_BINARY)
+
+
+class LegacyStreamHandler(BinaryStreamHandler):
+  '''The original receive loop that re-parses a growing buffer.'''
+  def recvMessage(self):
+    buffer = ''
+    while True:
+      data = self._socket.recv(BUFFER_SIZE_BYTES)
+      if len(data) == 0:
+        raise socket.error('Remote client disconnected.')
+      buffer += data
+      message, unused = self._serde.deserialise(buffer)
+      buffer = unused
+      if message != None:
+        return message
+
+
+
+#########################################################
+# Constants
+#########################################################
+BENCHMARKS = {
+    'crawl': bench_crawl,
+    'frames': bench_frames,
+    'index_cache': bench_index_cache,
+    'index_memory': bench_index_memory,
+    'pipeline': bench_pipeline,
+    'recv': bench_recv,
+    'serde': bench_serde,
+    'suite': bench_suite,
+    'writer': bench_writer,
+}
+
+SUITE_TREES = {
+    'deep': deep_tree,
+    'huge': huge_tree,
+    'repo': repo_tree,
+    'tiny': tiny_tree,
+}
+
+SUITE_STEPS = ['diff', 'serde', 'sync']
+
+SUITE_TOKEN = 'benchmark-token'
+
+# Everything reported by this run keyed off its name and then value name.
+RESULTS = {}
+
+
+
+#########################################################
+# Main
+#########################################################
+def main():
+  Logger.LEVEL = 1
+  args = parse_args()
+  BENCHMARKS[args.benchmark](args)
+  regressions = []
+  if args.baseline:
+    regressions = compare_results(args.baseline, args.tolerance)
+  if args.json:
+    save_results(args.json, args, regressions)
+  if regressions:
+    print('Regressed: [{}]'.format(', '.join(regressions)))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
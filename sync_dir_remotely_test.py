@@ -13,11 +13,20 @@
 #########################################################
 import argparse
 import datetime
+import hashlib
+import io
 import json
+import marshal
+import os
+import random
+import shutil
 import socket
 import struct
+import tempfile
+import threading
 import time
 import unittest
+import zlib
 
 from sync_dir_remotely import *
 
@@ -34,7 +43,7 @@ from sync_dir_remotely import *
 #########################################################
 class MessageSerdeTest(unittest.TestCase):
   def test_symmetry(self):
-    serde = MessageSerde()
+    serde = MessageSerde('token')
     message = Message(42)
     key = 'rui'
     value = ['will', 'it', 'work', '?']
@@ -44,6 +53,121 @@ class MessageSerdeTest(unittest.TestCase):
     self.assertEqual(0, len(unused))
     self.assertEqual(value, actual_msg.body[key])
 
+  def test_request_id_is_preserved(self):
+    serde = MessageSerde('token')
+    message = Message(MessageType.UPLOAD_RESPONSE)
+    message.request_id = 1234
+    actual_msg, unused = serde.deserialise(serde.serialise(message))
+    self.assertEqual(1234, actual_msg.request_id)
+
+  def test_blob_symmetry_in_all_wire_formats(self):
+    for wire_format in WIRE_FORMATS:
+      serde = MessageSerde('token')
+      serde.set_wire_format(wire_format)
+      message = Message(MessageType.UPLOAD_REQUEST)
+      message.body['uploaded_files'] = [{'a/b.bin': Blob('\x00\xff rui')}]
+      actual_msg, unused = serde.deserialise(serde.serialise(message))
+      self.assertEqual(0, len(unused))
+      self.assertEqual(message.body['uploaded_files'],
+          actual_msg.body['uploaded_files'])
+
+  def test_binary_format_is_smaller_than_json_for_an_index(self):
+    message = Message(MessageType.DIFF_REQUEST)
+    message.body['files'] = [dict(
+        ('dir/file_{}.txt'.format(i), (1500000000.5 + i, md5(str(i)))) \
+            for i in range(100))]
+    sizes = {}
+    for wire_format in WIRE_FORMATS:
+      serde = MessageSerde('token')
+      serde.set_wire_format(wire_format)
+      data = serde.serialise(message)
+      actual_msg, unused = serde.deserialise(data)
+      self.assertEqual(
+          [dict((k, list(v)) for k, v in message.body['files'][0].items())],
+          actual_msg.body['files'])
+      sizes[wire_format] = len(data)
+    self.assertTrue(sizes[WIRE_FORMAT_BINARY] < sizes[WIRE_FORMAT_JSON])
+
+  def test_headers_of_bodies_over_the_limit_are_refused(self):
+    serde = MessageSerde('token', 100)
+    for body_bytes in (-1, 101, 2 ** 31 - 1):
+      header = struct.pack(MessageSerde.HEADER_FORMAT,
+          MessageType.UPLOAD_REQUEST, 1, '0' * 32, body_bytes)
+      self.assertRaises(HumaReadbleException, serde.parse_header, header)
+    header = struct.pack(MessageSerde.HEADER_FORMAT,
+        MessageType.UPLOAD_REQUEST, 1, '0' * 32, 100)
+    self.assertEqual(100, serde.parse_header(header)[3])
+
+
+class StreamHandlerTest(unittest.TestCase):
+  def test_receives_back_to_back_messages_sent_in_fragments(self):
+    local, remote = socket.socketpair()
+    serde = MessageSerde('token')
+    data = ''
+    for i in range(2):
+      message = Message(MessageType.UPLOAD_REQUEST)
+      message.body['index'] = i
+      message.body['payload'] = Blob('x' * (3 * BUFFER_SIZE_BYTES + i))
+      data += serde.serialise(message)
+    sender = threading.Thread(target=lambda: [local.sendall(data[i:i + 1000])
+        for i in range(0, len(data), 1000)])
+    sender.start()
+    with StreamHandler('token', remote) as handler:
+      for i in range(2):
+        message = handler.recvMessage()
+        self.assertEqual(i, message.body['index'])
+        self.assertEqual(
+            3 * BUFFER_SIZE_BYTES + i, len(message.body['payload']))
+    sender.join()
+    local.close()
+
+  def test_file_ranges_are_sent_as_raw_frames(self):
+    local, remote = socket.socketpair()
+    data = ''.join([chr(i % 251) for i in range(3 * BUFFER_SIZE_BYTES)])
+    with tempfile.NamedTemporaryFile() as fp:
+      fp.write(data)
+      fp.flush()
+      message = Message(MessageType.UPLOAD_REQUEST)
+      message.body['ranges'] = [FileRange(fp, 10, len(data) - 20),
+          FileRange(fp, 0, 0)]
+      message.body['blob'] = Blob('inline')
+      sender = StreamHandler('token', local)
+      sender.set_wire_format(WIRE_FORMAT_BINARY)
+      thread = threading.Thread(target=sender.sendMessage, args=(message,))
+      thread.start()
+      with StreamHandler('token', remote) as handler:
+        handler.set_wire_format(WIRE_FORMAT_BINARY)
+        received = handler.recvMessage()
+      thread.join()
+    local.close()
+    self.assertEqual([Blob(bytearray(data[10:-10])), Blob(bytearray())],
+        received.body['ranges'])
+    self.assertEqual(Blob('inline'), received.body['blob'])
+
+  def test_file_ranges_that_shrink_are_padded_and_discarded(self):
+    local, remote = socket.socketpair()
+    with tempfile.NamedTemporaryFile() as fp:
+      fp.write('x' * 1000)
+      fp.flush()
+      message = Message(MessageType.UPLOAD_REQUEST)
+      message.body['data'] = FileRange(fp, 0, 1000)
+      sender = StreamHandler('token', local)
+      sender.set_wire_format(WIRE_FORMAT_BINARY)
+      frames = []
+      data = sender._serde.serialise(message, frames)
+      fp.truncate(10)
+      fp.flush()
+      thread = threading.Thread(target=lambda: [sender._send(data),
+          frames[0].send(local), frames[0].close(),
+          sender.sendMessage(Message(MessageType.PING_REQUEST))])
+      thread.start()
+      with StreamHandler('token', remote) as handler:
+        handler.set_wire_format(WIRE_FORMAT_BINARY)
+        self.assertEqual(Blob(None), handler.recvMessage().body['data'])
+        self.assertEqual(MessageType.PING_REQUEST, handler.recvMessage().type)
+      thread.join()
+    local.close()
+
 
 class DirCrawlerTest(unittest.TestCase):
   def test_crawl_test_folder(self):
@@ -59,6 +183,334 @@ class DirCrawlerTest(unittest.TestCase):
       self.assertEqual('0af9f1702bc23d5a33268e2755457773',
           files[file_path][1])
 
+  def test_crawl_and_hash_in_hash_pools(self):
+    for use_processes in (False, True):
+      hash_pool = HashPool(3, use_processes)
+      try:
+        crawler = DirCrawler(
+            'test_data/DirCrawlerTest', [r'.*/\..*'], hash_pool)
+        files = crawler.crawl_and_hash()
+      finally:
+        hash_pool.close()
+      self.assertEqual(2, len(files))
+      for file_path in files:
+        self.assertEqual('0af9f1702bc23d5a33268e2755457773',
+            files[file_path][1])
+
+
+class IgnorePatternsTest(unittest.TestCase):
+  def test_gitignore_semantics(self):
+    patterns = IgnorePatterns(['# comment', '', '*.o', '!keep.o', 'build/',
+        '/top.txt', 'docs/**/*.md', 'a?c', '[!x].txt'])
+    for rel_path, is_dir, expected in (
+        ('x/y/z.o', False, True),
+        ('x/keep.o', False, False),
+        ('build', True, True),
+        ('build', False, None),
+        ('top.txt', False, True),
+        ('sub/top.txt', False, None),
+        ('docs/c.md', False, True),
+        ('docs/a/b/c.md', False, True),
+        ('abc', False, True),
+        ('a/c', False, None),
+        ('y.txt', False, True),
+        ('x.txt', False, None),
+        ('# comment', False, None)):
+      self.assertEqual(expected, patterns.match(rel_path, is_dir),
+          (rel_path, is_dir))
+
+
+class ExcludeRulesTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    for rel_path, contents in (
+        ('a.txt', 'a'),
+        ('a.o', 'o'),
+        (os.path.join('build', 'keep.txt'), 'k'),
+        (os.path.join('node_modules', 'x', 'y.js'), 'y'),
+        (os.path.join('sub', '.syncignore'), '!*.o\nlocal/\n'),
+        (os.path.join('sub', 'b.o'), 'b'),
+        (os.path.join('sub', 'local', 'c.txt'), 'c')):
+      path = os.path.join(self._dir, rel_path)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'wb') as fp:
+        fp.write(contents)
+    self._crawler = DirCrawler(self._dir,
+        ['*.o', 'build/', '!build/keep.txt', 'node_modules'],
+        ignore_files=IGNORE_FILES)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_excluded_dirs_are_pruned_and_ignore_files_apply_below(self):
+    expected = ['a.txt', os.path.join('sub', '.syncignore'),
+        os.path.join('sub', 'b.o')]
+    self.assertEqual(expected, sorted(self._crawler.crawl()))
+    self.assertTrue(self._crawler._is_excluded(
+        os.path.join('build', 'keep.txt')))
+    self.assertTrue(self._crawler._is_excluded(
+        os.path.join('sub', 'local', 'new.txt')))
+    self.assertEqual([], self._crawler.crawl('node_modules'))
+
+  def test_changed_ignore_files_apply_at_once(self):
+    files = self._crawler.crawl_and_hash()
+    with open(os.path.join(self._dir, 'sub', '.syncignore'), 'wb') as fp:
+      fp.write('b.o\n')
+    files = self._crawler.update(files, [os.path.join('sub', '.syncignore')])
+    self.assertEqual(['a.txt', os.path.join('sub', '.syncignore'),
+        os.path.join('sub', 'local', 'c.txt')], sorted(files))
+
+
+class DirCrawlerUpdateTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._write('a.txt', 'rui')
+    self._write(os.path.join('sub', 'b.txt'), 'bm')
+    self._crawler = DirCrawler(self._dir)
+    self._files = self._crawler.crawl_and_hash()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _write(self, rel_path, contents):
+    path = os.path.join(self._dir, rel_path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fp:
+      fp.write(contents)
+
+  def test_new_dir_is_crawled(self):
+    self._write(os.path.join('new', 'inner', 'c.txt'), 'c')
+    files = self._crawler.update(self._files, ['new'])
+    self.assertEqual(md5('c'), files[os.path.join('new', 'inner', 'c.txt')][1])
+    self.assertEqual(3, len(files))
+    self.assertEqual(2, len(self._files))
+
+  def test_deleted_dir_is_forgotten(self):
+    shutil.rmtree(os.path.join(self._dir, 'sub'))
+    files = self._crawler.update(self._files, ['sub'])
+    self.assertEqual(['a.txt'], files.keys())
+
+  def test_parallel_walk_skips_special_files_and_dir_links(self):
+    os.symlink('a.txt', os.path.join(self._dir, 'link.txt'))
+    os.symlink('sub', os.path.join(self._dir, 'link_dir'))
+    os.mkfifo(os.path.join(self._dir, 'fifo'))
+    crawler = DirCrawler(self._dir, walk_workers=4)
+    self.assertEqual(['a.txt', 'link.txt', os.path.join('sub', 'b.txt')],
+        sorted(crawler.crawl()))
+    self.assertEqual(self._crawler.crawl_and_hash(), crawler.crawl_and_hash())
+
+  def test_parallel_walk_lists_few_dirs_ahead(self):
+    for i in range(50):
+      self._write(os.path.join('d{}'.format(i), 'c.txt'), 'c')
+    listed = []
+    crawler = DirCrawler(self._dir, walk_workers=2)
+    list_dir = crawler._list_dir
+    crawler._list_dir = lambda rel_dir: listed.append(rel_dir) or \
+        list_dir(rel_dir)
+    walk = crawler._walk()
+    next(walk)
+    time.sleep(0.1)
+    self.assertTrue(len(listed) <= 1 + 2 * WALK_LISTINGS_PER_WORKER, listed)
+    self.assertEqual(52, len([item for item in walk]) + 1)
+
+  def test_crawl_forgets_deleted_files(self):
+    shutil.rmtree(os.path.join(self._dir, 'sub'))
+    files = self._crawler.crawl_and_hash(self._files)
+    self.assertEqual(['a.txt'], files.keys())
+
+  def test_modified_file_is_rehashed(self):
+    self._write('a.txt', 'rui bm')
+    os.utime(os.path.join(self._dir, 'a.txt'), (0, time.time() + 10))
+    files = self._crawler.update(self._files, ['a.txt'])
+    self.assertEqual(md5('rui bm'), files['a.txt'][1])
+
+  def test_recorded_files_are_not_hashed_again(self):
+    self._write('c.txt', 'written')
+    hash_pool = CountingHashPool()
+    crawler = DirCrawler(self._dir, hash_pool=hash_pool)
+    files = crawler.record(self._files, {'c.txt': 'claimed'})
+    self.assertEqual('claimed', files['c.txt'][1])
+    self.assertEqual(files, crawler.crawl_and_hash(files))
+    self.assertEqual(0, hash_pool.hashed_files)
+
+  def test_sampled_recorded_files_are_verified(self):
+    self._write('c.txt', 'written')
+    fingerprints = {}
+    for i in range(WRITE_THROUGH_VERIFY_EVERY):
+      fingerprints['c.txt'] = 'wrong'
+      files = self._crawler.record(self._files, fingerprints)
+    self.assertEqual(md5('written'), files['c.txt'][1])
+
+
+class DirMonitorTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._monitor = DirMonitor([self._dir])
+    self._monitor.wait_for_change(0)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_changes_wake_up_waiters(self):
+    self._monitor._crawl_all()
+    self.assertFalse(self._monitor.wait_for_change(0))
+    with open(os.path.join(self._dir, 'a.txt'), 'wb') as fp:
+      fp.write('rui')
+    self._monitor._crawl_all()
+    self.assertTrue(self._monitor.wait_for_change(0))
+    self.assertFalse(self._monitor.wait_for_change(0))
+
+  def test_trees_follow_the_index(self):
+    with self._monitor.locked_trees() as trees:
+      self.assertEqual(MerkleTree().hash(), trees[0].hash())
+    os.mkdir(os.path.join(self._dir, 'sub'))
+    for rel_path in ('a.txt', os.path.join('sub', 'b.txt')):
+      with open(os.path.join(self._dir, rel_path), 'wb') as fp:
+        fp.write(rel_path)
+    self._monitor._crawl_all()
+    self._monitor.record([{os.path.join('sub', 'b.txt'): 'claimed'}])
+    with self._monitor.locked_trees() as trees:
+      self.assertEqual(MerkleTree(self._monitor.get_files()[0]).hash(),
+          trees[0].hash())
+      self.assertEqual('claimed', trees[0].get(os.path.join('sub', 'b.txt'))[1])
+
+  def test_trees_follow_changed_ignore_files(self):
+    os.mkdir(os.path.join(self._dir, 'sub'))
+    with open(os.path.join(self._dir, 'sub', 'b.txt'), 'wb') as fp:
+      fp.write('rui')
+    self._monitor = DirMonitor([self._dir], ignore_files=IGNORE_FILES)
+    with self._monitor.locked_trees() as trees:
+      trees[0].hash('sub')
+    with open(os.path.join(self._dir, '.syncignore'), 'wb') as fp:
+      fp.write('sub/\n')
+    self._monitor._update({0: ['.syncignore']})
+    self.assertEqual(['.syncignore'], self._monitor.get_files()[0].keys())
+    with self._monitor.locked_trees() as trees:
+      self.assertEqual([], trees[0].subdirs(''))
+      self.assertEqual(MerkleTree(self._monitor.get_files()[0]).hash(),
+          trees[0].hash())
+
+
+class IndexCacheTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._cache = IndexCache(os.path.join(self._dir, 'cache'), 'test_data')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_saved_index_is_reused_without_hashing(self):
+    crawler = DirCrawler('test_data/DirCrawlerTest')
+    self._cache.save(crawler.crawl_and_hash())
+    hash_pool = CountingHashPool()
+    crawler = DirCrawler('test_data/DirCrawlerTest', hash_pool=hash_pool)
+    index = self._cache.load()
+    self.assertEqual(2, len(index))
+    self.assertEqual(index, crawler.crawl_and_hash(index))
+    self.assertEqual(0, hash_pool.hashed_files)
+
+  @staticmethod
+  def marshal_round_trip(index):
+    return CompactIndex.from_marshal(marshal.loads(marshal.dumps(
+        index.to_marshal())))
+
+  def test_corrupt_cache_is_ignored(self):
+    self._cache.save({'a.txt': (1.0, md5('a'), 1, 1000000000, 42)})
+    with open(self._cache.get_path(), 'r+b') as fp:
+      fp.seek(-1, os.SEEK_END)
+      fp.write('X')
+    self.assertEqual({}, self._cache.load())
+    self.assertEqual([], [name for name in os.listdir(
+        os.path.dirname(self._cache.get_path())) if name.endswith(TMP_SUFFIX)])
+
+
+class FingerprintTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'a.txt')
+    with open(self._path, 'wb') as fp:
+      fp.write('hello world')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_content_fingerprints_fit_the_index(self):
+    self.assertEqual(md5('hello world'),
+        Fingerprint.hash_file(self._path, Fingerprint.MD5))
+    for name in Fingerprint.available():
+      if name != Fingerprint.STAT:
+        fingerprint = Fingerprint.hash_file(self._path, name)
+        self.assertEqual(32, len(fingerprint))
+        int(fingerprint, 16)
+
+  def test_hash_fp_hashes_ranges(self):
+    with open(self._path, 'rb') as fp:
+      fp.seek(6)
+      content_hash = hashlib.md5()
+      self.assertEqual(3, hash_fp(content_hash, fp, 3))
+      self.assertEqual(md5('wor'), content_hash.hexdigest())
+      self.assertEqual(2, hash_fp(content_hash, fp, 10))
+      self.assertEqual(md5('world'), content_hash.hexdigest())
+
+  def test_stat_fingerprint_survives_copying_the_mtime(self):
+    os.utime(self._path, (0, 1500000000.123456789))
+    stat = os.stat(self._path)
+    copy_path = os.path.join(self._dir, 'b.txt')
+    shutil.copyfile(self._path, copy_path)
+    self.assertNotEqual(Fingerprint.from_stat(stat),
+        Fingerprint.from_stat(os.stat(copy_path)))
+    Fingerprint.set_mtime(copy_path, stat.st_mtime)
+    self.assertEqual(Fingerprint.from_stat(stat),
+        Fingerprint.from_stat(os.stat(copy_path)))
+
+  def test_stat_crawl_reads_no_contents(self):
+    hash_pool = CountingHashPool()
+    crawler = DirCrawler('test_data/DirCrawlerTest', hash_pool=hash_pool,
+        fingerprint=Fingerprint.STAT)
+    self.assertEqual(2, len(crawler.crawl_and_hash()))
+    self.assertEqual(0, hash_pool.hashed_files)
+
+
+@unittest.skipUnless(InotifyWatcher.is_supported(), 'Needs Linux inotify.')
+class InotifyWatcherTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self._dir, 'sub'))
+    self._watcher = InotifyWatcher()
+    self._watcher.add_tree(0, self._dir)
+
+  def tearDown(self):
+    self._watcher.close()
+    shutil.rmtree(self._dir)
+
+  def _changes(self):
+    return self._watcher.read_changes(1.0, 0.05, 1.0).get(0, set())
+
+  def test_reports_files_and_watches_new_dirs(self):
+    with open(os.path.join(self._dir, 'sub', 'a.txt'), 'wb') as fp:
+      fp.write('rui')
+    os.makedirs(os.path.join(self._dir, 'new'))
+    self.assertEqual(set([os.path.join('sub', 'a.txt'), 'new']),
+        self._changes())
+    with open(os.path.join(self._dir, 'new', 'b.txt'), 'wb') as fp:
+      fp.write('bm')
+    self.assertEqual(set([os.path.join('new', 'b.txt')]), self._changes())
+
+  def test_reports_deleted_dirs(self):
+    shutil.rmtree(os.path.join(self._dir, 'sub'))
+    self.assertTrue('sub' in self._changes())
+    self.assertEqual(1, self._watcher.watch_count())
+
+  def test_excluded_dirs_are_not_watched(self):
+    watcher = InotifyWatcher(lambda root_index, rel_dir: rel_dir == 'sub')
+    try:
+      watcher.add_tree(0, self._dir)
+      self.assertEqual(1, watcher.watch_count())
+    finally:
+      watcher.close()
+
 
 class StateDifferTest(unittest.TestCase):
   def test_one_dir_one_file_no_diff(self):
@@ -112,6 +564,699 @@ class StateDifferTest(unittest.TestCase):
     self.assertEqual(0, len(result[0]))
 
 
+class ClientIndexTest(unittest.TestCase):
+  def test_deltas_apply_on_top_of_the_acknowledged_generation(self):
+    index = ClientIndex()
+    dst = [MerkleTree({'a.txt': (0, 'md5 a'), 'b.txt': (0, 'md5 b')})]
+    self.assertTrue(index.apply({
+        'generation': 1,
+        'base_generation': None,
+        'files': [{'a.txt': (0, 'md5 a'), 'b.txt': (0, 'new md5 b')}],
+    }, dst))
+    self.assertEqual([['b.txt']], index.diff(dst))
+    self.assertTrue(index.apply({
+        'generation': 2,
+        'base_generation': 1,
+        'changed_files': [{'c.txt': (0, 'md5 c')}],
+        'removed_files': [['a.txt']],
+    }, dst))
+    self.assertEqual([['b.txt', 'c.txt']], [sorted(index.diff(dst)[0])])
+    self.assertFalse(index.apply({
+        'generation': 3,
+        'base_generation': 1,
+        'changed_files': [{}],
+        'removed_files': [[]],
+    }, dst))
+
+  def test_matched_dirs_are_taken_from_the_remote(self):
+    index = ClientIndex()
+    dst = [MerkleTree({'a/b.txt': (1, 'md5 b'), 'c.txt': (1, 'md5 c')})]
+    self.assertTrue(index.apply({
+        'generation': 1,
+        'base_generation': None,
+        'files': [{'c.txt': (0, 'new md5 c')}],
+        'matched_dirs': [{'a': dst[0].hash('a')}],
+    }, dst))
+    self.assertEqual([['c.txt']], index.diff(dst))
+    self.assertEqual((1, 'md5 b'), index.get(0, 'a/b.txt'))
+    dst[0].update({'a/b.txt': (2, 'remote edit')}, [])
+    self.assertEqual([['a/b.txt', 'c.txt']], [sorted(index.diff(dst)[0])])
+    old_hash = MerkleTree({'a/b.txt': (1, 'md5 b')}).hash('a')
+    self.assertFalse(index.apply({
+        'generation': 2,
+        'base_generation': None,
+        'files': [{}],
+        'matched_dirs': [{'a': old_hash}],
+    }, dst))
+
+
+class MerkleTreeTest(unittest.TestCase):
+  def test_equal_files_have_equal_hashes_whatever_the_history(self):
+    tree = MerkleTree({'a/b/c.txt': (0, 'md5 c'), 'd.txt': (0, 'md5 d')})
+    other = MerkleTree({'d.txt': (5, 'md5 d')})
+    root_hash = other.hash()
+    other.update({'a/b/c.txt': (0, 'md5 c'), 'e/f.txt': (0, 'md5 f')}, [])
+    self.assertNotEqual(root_hash, other.hash())
+    other.update({}, ['e/f.txt'])
+    self.assertEqual(tree.hash(), other.hash())
+    self.assertEqual(None, other.hash('e'))
+    self.assertEqual(['a/b'], other.subdirs('a'))
+
+  def test_diff_only_descends_into_dirs_that_differ(self):
+    index = dict(('dir_{}/file_{}'.format(i % 10, i), (0, md5(str(i)))) \
+        for i in range(100))
+    tree = MerkleTree(index)
+    other = MerkleTree(index)
+    self.assertEqual([], tree.diff(other))
+    other.update({'dir_3/file_3': (0, 'edit')}, ['dir_7/file_7'])
+    other._index = other._index.copy()
+    other._index['dir_5/file_5'] = (0, 'unseen edit')
+    self.assertEqual(['dir_3/file_3', 'dir_7/file_7'], sorted(tree.diff(other)))
+
+
+
+class CompactIndexTest(unittest.TestCase):
+  def setUp(self):
+    self._index = dict(('dir_{}/file_{}'.format(i % 7, i),
+        (1.5 + i, md5(str(i)), i, None if i % 2 else i * 10, i)) \
+            for i in range(50))
+    self._index['odd.txt'] = (0, 'not a digest', 1, 2, 3)
+
+  def test_entries_read_back_as_they_were_set(self):
+    index = CompactIndex(self._index)
+    self.assertEqual(51, len(index))
+    self.assertEqual(index, self._index)
+    self.assertEqual(self._index['dir_3/file_10'], index['dir_3/file_10'])
+    self.assertEqual(None, index.get('dir_3/file_11'))
+    self.assertEqual(sorted(['file_{}'.format(i) for i in range(3, 50, 7)]),
+        [name for name, entry in index.dir_items('dir_3')])
+    self.assertEqual('dir_4/file_25', index.find(md5('25')))
+    self.assertEqual('odd.txt', index.find('not a digest'))
+    self.assertEqual(index, IndexCacheTest.marshal_round_trip(index))
+
+  def test_copies_share_the_base_and_only_compare_changes(self):
+    index = CompactIndex(self._index)
+    copy = index.copy()
+    copy['dir_0/file_0'] = (2.0, md5('edit'), 1, 2, 3)
+    del copy['dir_1/file_1']
+    copy['new/file'] = (3.0, md5('new'), 1, 2, 3)
+    self.assertEqual(index, self._index)
+    self.assertEqual(51, len(copy))
+    self.assertEqual(set(['dir_0/file_0', 'dir_1/file_1', 'new/file']),
+        CompactIndex.changed_keys(index, copy))
+    copy.compact()
+    self.assertEqual(set(['dir_0/file_0', 'dir_1/file_1', 'new/file']),
+        CompactIndex.changed_keys(index, copy))
+    self.assertEqual('new/file', copy.find(md5('new')))
+    self.assertEqual(None, copy.find(md5('1')))
+
+  def test_lookups_after_listing_a_dir_see_later_changes(self):
+    index = CompactIndex(self._index)
+    self.assertEqual(8, len(index.dir_items('dir_0')))
+    index['dir_0/file_0'] = (2.0, md5('edit'), 1, 2, 3)
+    del index['dir_0/file_7']
+    self.assertEqual((2.0, md5('edit'), 1, 2, 3), index.get('dir_0/file_0'))
+    self.assertEqual(None, index.get('dir_0/file_7'))
+    self.assertEqual(self._index['dir_1/file_1'], index.get('dir_1/file_1'))
+
+  def test_changed_keys_of_dirs_include_files_underneath(self):
+    old = CompactIndex({'a/b.txt': (0, 'md5 b'), 'a/c/d.txt': (0, 'md5 d'),
+        'e': (0, 'e')})
+    new = old.copy()
+    new['e'] = (1, 'e')
+    del new['a/c/d.txt']
+    self.assertEqual(set(['a/b.txt', 'a/c/d.txt']),
+        CompactIndex.changed_keys(old, new, ['a']))
+
+
+class RequestWindowTest(unittest.TestCase):
+  def test_out_of_order_responses_are_matched_by_request_id(self):
+    handler = ReorderingStreamHandler()
+    window = RequestWindow(handler, 2)
+    first = window.send(Message(MessageType.UPLOAD_REQUEST))
+    second = window.send(Message(MessageType.UPLOAD_REQUEST))
+    self.assertEqual(2, len(handler.unanswered))
+    self.assertEqual(second, window.recv(second).request_id)
+    self.assertEqual(first, window.recv(first).request_id)
+
+  def test_window_bounds_requests_in_flight(self):
+    handler = ReorderingStreamHandler()
+    window = RequestWindow(handler, 2)
+    for i in range(5):
+      window.send(Message(MessageType.UPLOAD_REQUEST))
+      self.assertTrue(len(handler.unanswered) <= 2)
+    self.assertEqual(5, len(window.drain()))
+    self.assertEqual(5, handler.answered)
+
+  def test_callbacks_get_their_responses(self):
+    window = RequestWindow(ReorderingStreamHandler(), 2)
+    responses = []
+    for i in range(3):
+      window.send(Message(MessageType.UPLOAD_REQUEST), responses.append)
+    window.drain()
+    self.assertEqual(set([1, 2, 3]),
+        set([response.request_id for response in responses]))
+
+
+class LatencyHistogramTest(unittest.TestCase):
+  def test_percentiles(self):
+    histogram = LatencyHistogram('test')
+    for secs in [0.005] * 5 + [0.2] * 4 + [3600]:
+      histogram.record(secs)
+    self.assertEqual(10, histogram.count())
+    self.assertEqual(10, histogram.percentile(0.5))
+    self.assertEqual(250, histogram.percentile(0.9))
+    self.assertEqual(None, histogram.percentile(0.99))
+
+
+class MetricsTest(unittest.TestCase):
+  def test_snapshot(self):
+    metrics = Metrics()
+    metrics.increment('crawl.files_hashed')
+    metrics.increment('crawl.files_hashed', 2)
+    metrics.set_gauge('index.files', 7)
+    metrics.set_gauge('index.files', 5)
+    with metrics.timed('diff.secs'):
+      pass
+    metrics.record('diff.secs', 0.2)
+    snapshot = metrics.snapshot()
+    self.assertEqual({'crawl.files_hashed': 3}, snapshot['counters'])
+    self.assertEqual({'index.files': 5}, snapshot['gauges'])
+    histogram = snapshot['histograms']['diff.secs']
+    self.assertEqual(2, histogram['count'])
+    self.assertEqual(250, histogram['p90_ms'])
+    self.assertEqual(1, histogram['buckets']['<=250ms'])
+    self.assertEqual(snapshot, json.loads(json.dumps(snapshot)))
+
+  def test_dumper_appends_a_line_per_dump(self):
+    metrics = Metrics()
+    with tempfile.NamedTemporaryFile() as fp:
+      with MetricsDumper(metrics, fp.name, 3600) as dumper:
+        metrics.increment('writer.files')
+        dumper.dump()
+        metrics.increment('writer.files')
+      lines = [json.loads(line) for line in fp.readlines()]
+    self.assertEqual([1, 2],
+        [line['counters']['writer.files'] for line in lines])
+
+
+class TokenBucketTest(unittest.TestCase):
+  def test_bursts_pass_and_debt_is_waited_out(self):
+    bucket = TokenBucket('test', 100000, 10000)
+    self.assertEqual(0, bucket.take(10000))
+    secs = bucket.take(5000)
+    self.assertTrue(0.04 < secs <= 0.05, secs)
+    self.assertTrue(0.03 < bucket.delay() <= 0.05)
+    self.assertEqual(None, TokenBucket.create('unlimited', 0))
+    self.assertEqual(2048, TokenBucket.create('capped', 2).rate)
+
+  def test_consume_waits_for_the_slowest_bucket(self):
+    fast = TokenBucket('fast', 10 ** 9, 1000)
+    slow = TokenBucket('slow', 100000, 1000)
+    start = time.time()
+    TokenBucket.consume([fast, slow], 3000)
+    self.assertTrue(time.time() - start >= 0.019)
+    self.assertEqual(0, fast.delay())
+
+
+class UploadSchedulerTest(unittest.TestCase):
+  def test_small_recent_files_go_first(self):
+    index = {'old.txt': (1, 'a', 10, 1, 1), 'new.txt': (5, 'b', 20, 5, 2),
+        'big.iso': (9, 'c', 5000, 9, 3), 'bigger.iso': (2, 'd', 9000, 2, 4)}
+    scheduler = UploadScheduler(['/'], 1000, 100)
+    self.assertEqual([(0, 'new.txt', False), (0, 'old.txt', False),
+        (0, 'big.iso', True), (0, 'bigger.iso', True)],
+        scheduler.order([['old.txt', 'bigger.iso', 'big.iso', 'new.txt']],
+            [index]))
+
+  def test_small_files_changed_meanwhile_are_expressed_once(self):
+    index = {'a.txt': (1, 'a', 10, 1, 1), 'big.iso': (1, 'b', 5000, 1, 2)}
+    scheduler = UploadScheduler(['/'], 1000, 100)
+    scheduler.start([['a.txt', 'big.iso']], [index])
+    self.assertEqual([], scheduler.express([index]))
+    changed = dict(index)
+    changed['a.txt'] = (2, 'a2', 10, 2, 1)
+    changed['b.txt'] = (2, 'b', 10, 2, 3)
+    changed['c.bin'] = (2, 'c', 500, 2, 4)
+    self.assertEqual([(0, 'b.txt')], scheduler.express([changed]))
+    self.assertEqual([], scheduler.express([changed]))
+
+
+class FileUploaderTest(unittest.TestCase):
+  def test_index_delta(self):
+    entry = (0, 'md5 a', 1, 0, 1)
+    old = {'a.txt': entry, 'b.txt': (0, 'md5 b', 1, 0, 2)}
+    new = {'a.txt': entry, 'b.txt': (1, 'md5 b2', 1, 0, 2),
+        'c.txt': (0, 'md5 c', 1, 0, 3)}
+    changed, removed = FileUploader._index_delta(old, new)
+    self.assertEqual({'b.txt': (1, 'md5 b2'), 'c.txt': (0, 'md5 c')}, changed)
+    self.assertEqual([], removed)
+    changed, removed = FileUploader._index_delta(new, old)
+    self.assertEqual({'b.txt': (0, 'md5 b')}, changed)
+    self.assertEqual(['c.txt'], removed)
+    self.assertEqual(({}, []), FileUploader._index_delta(new, new))
+
+  def test_stripes_are_balanced_by_bytes(self):
+    root = tempfile.mkdtemp()
+    try:
+      for name, size in (('a', 60), ('b', 50), ('c', 40), ('d', 30)):
+        with open(os.path.join(root, name), 'wb') as fp:
+          fp.write('x' * size)
+      uploader = FileUploader(DirMonitor([root]), None, 0, MAX_UPLOAD_BYTES)
+      self.assertEqual([[['a', 'd']], [['b', 'c']]],
+          uploader._stripe([['a', 'b', 'c', 'd']], 2))
+    finally:
+      shutil.rmtree(root)
+
+  def test_files_gone_since_the_diff_are_skipped(self):
+    root = tempfile.mkdtemp()
+    try:
+      with open(os.path.join(root, 'kept'), 'wb') as fp:
+        fp.write('rui bm')
+      monitor = DirMonitor([root])
+      uploader = FileUploader(monitor, None, 0, MAX_UPLOAD_BYTES)
+      files = [['gone', 'kept']]
+      signatures = uploader._request_signatures([['gone']])
+      uploader._scheduler.start(files, monitor.get_files())
+      batches = list(uploader._upload_batches(
+          files, signatures, TransferStats('control')))
+      self.assertEqual([['kept']], [batch[0].keys() for batch in batches])
+    finally:
+      shutil.rmtree(root)
+
+  def test_idle_connections_get_keep_alives_during_striped_uploads(self):
+    root = tempfile.mkdtemp()
+    try:
+      handlers = [ReorderingStreamHandler() for i in range(3)]
+      windows = [RequestWindow(handler, 2) for handler in handlers]
+      uploader = FileUploader(DirMonitor([root]), windows[0], 0,
+          MAX_UPLOAD_BYTES, data_windows=windows[1:])
+      def busy_stripe():
+        deadline = time.time() + 10
+        while not handlers[0].unanswered and time.time() < deadline:
+          time.sleep(0.01)
+      threads = [threading.Thread(target=lambda: None),
+          threading.Thread(target=busy_stripe)]
+      for thread in threads:
+        thread.start()
+      uploader._keep_alive_until_done(threads, [])
+      self.assertTrue(handlers[0].answered >= 1)
+      self.assertTrue(handlers[1].answered >= 1)
+      self.assertEqual(0, handlers[2].answered)
+    finally:
+      shutil.rmtree(root)
+
+
+class DeltaCodecTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    rand = random.Random(42)
+    self._old = ''.join([chr(rand.randint(0, 255)) for i in range(50000)])
+    self._path = os.path.join(self._dir, 'old.bin')
+    with open(self._path, 'wb') as fp:
+      fp.write(self._old)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _delta(self, data, signature, max_literal_bytes=1024 * 1024):
+    return list(DeltaCodec.delta(
+        io.BytesIO(data), signature, max_literal_bytes))
+
+  def _patch(self, ops, block_size):
+    out_path = os.path.join(self._dir, 'new.bin')
+    with open(self._path, 'rb') as old_fp:
+      with open(out_path, 'wb') as out_fp:
+        DeltaCodec.patch(old_fp, ops, block_size, out_fp)
+    with open(out_path, 'rb') as fp:
+      return fp.read()
+
+  def test_roll_matches_adler32(self):
+    block_size = 16
+    weak = DeltaCodec.weak_checksum(self._old[0:block_size])
+    for pos in range(100):
+      weak = DeltaCodec.roll(weak, ord(self._old[pos]),
+          ord(self._old[pos + block_size]), block_size)
+      self.assertEqual(
+          DeltaCodec.weak_checksum(self._old[pos + 1:pos + 1 + block_size]),
+          weak)
+
+  def test_unchanged_file_is_all_block_references(self):
+    signature = DeltaCodec.signature(self._path)
+    ops = self._delta(self._old, signature)
+    self.assertEqual([[0, len(signature['blocks'])]], ops)
+    self.assertEqual(self._old, self._patch(ops, signature['block_size']))
+
+  def test_insertion_sends_only_a_small_literal(self):
+    new = self._old[:20000] + 'one new line\n' + self._old[20000:]
+    signature = DeltaCodec.signature(self._path)
+    ops = self._delta(new, signature)
+    literal_bytes = sum([len(op) for op in ops if type(op) != list])
+    self.assertTrue(literal_bytes < 2 * signature['block_size'])
+    self.assertEqual(new, self._patch(ops, signature['block_size']))
+
+  def test_literals_are_capped(self):
+    new = self._old[::-1]
+    signature = DeltaCodec.signature(self._path)
+    ops = self._delta(new, signature, 1000)
+    self.assertTrue(all([len(op) <= 1000 for op in ops]))
+    self.assertEqual(len(new),
+        sum([DeltaCodec.op_bytes(op, signature) for op in ops]))
+    self.assertEqual(new, self._patch(ops, signature['block_size']))
+
+
+class SessionLoopTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._monitor = DirMonitor([self._dir])
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_stalled_client_does_not_block_others(self):
+    session_loop = SessionLoop('token', self._monitor, 1, 4)
+    stalled, stalled_remote = socket.socketpair()
+    client, client_remote = socket.socketpair()
+    session_loop.add_connection(stalled_remote, 'stalled')
+    session_loop.add_connection(client_remote, 'client')
+    thread = threading.Thread(target=session_loop.run)
+    thread.start()
+    try:
+      stalled.sendall('\x00' * (MessageSerde.HEADER_BYTES / 2))
+      with StreamHandler('token', client) as handler:
+        request = Message(MessageType.PING_REQUEST)
+        request.request_id = 7
+        handler.sendMessage(request)
+        response = handler.recvMessage()
+      self.assertEqual(MessageType.PING_RESPONSE, response.type)
+      self.assertEqual(7, response.request_id)
+    finally:
+      session_loop.stop()
+      thread.join()
+      stalled.close()
+
+  def test_sessions_announcing_huge_bodies_are_closed(self):
+    session_loop = SessionLoop('token', self._monitor, 1, 4,
+        max_body_bytes=1000)
+    local, remote = socket.socketpair()
+    session_loop.add_connection(remote, 'client')
+    thread = threading.Thread(target=session_loop.run)
+    thread.start()
+    try:
+      local.sendall(struct.pack(MessageSerde.HEADER_FORMAT,
+          MessageType.UPLOAD_REQUEST, 1, '0' * 32, 2 ** 31 - 1))
+      local.settimeout(SOCKET_TIMEOUT_SECS)
+      self.assertEqual('', local.recv(1))
+    finally:
+      session_loop.stop()
+      thread.join()
+      local.close()
+
+  def test_least_served_client_goes_first(self):
+    session_loop = SessionLoop('token', self._monitor, 1, 4)
+    sessions = []
+    for address in (('10.0.0.1', 1), ('10.0.0.2', 2)):
+      local, remote = socket.socketpair()
+      session = session_loop.add_connection(remote, address)
+      session.requests.append((Message(MessageType.PING_REQUEST), 10))
+      sessions.append(session)
+    session_loop._served_bytes['10.0.0.1'] = 1000
+    session_loop._dispatch_requests()
+    self.assertEqual([False, True], [session.busy for session in sessions])
+    session_loop.stop()
+    session_loop.run()
+
+  def test_raw_frames_are_read_into_the_request_and_checked(self):
+    serde = MessageSerde('token')
+    serde.set_wire_format(WIRE_FORMAT_BINARY)
+    with tempfile.NamedTemporaryFile() as fp:
+      fp.write('0123456789')
+      fp.flush()
+      for tail, valid in (('23456789', True), ('2345678X', False)):
+        message = Message(MessageType.UPLOAD_REQUEST)
+        message.body['data'] = FileRange(fp, 2, 8)
+        frames = []
+        data = serde.serialise(message, frames)
+        local, remote = socket.socketpair()
+        remote.setblocking(0)
+        session = RemoteSession('token', self._monitor, remote, 'client')
+        session._serde.set_wire_format(WIRE_FORMAT_BINARY)
+        local.sendall(data + tail[:3])
+        session.read()
+        self.assertEqual([], session.requests)
+        local.sendall(
+            tail[3:] + serde.serialise(Message(MessageType.PING_REQUEST)))
+        session.read()
+        request, body_bytes = session.requests[0]
+        self.assertEqual(Blob(bytearray(tail) if valid else None),
+            request.body['data'])
+        self.assertEqual(len(data) - MessageSerde.HEADER_BYTES + 8, body_bytes)
+        # The stream stays in step even if the frame was discarded.
+        self.assertEqual(MessageType.PING_REQUEST, session.requests[1][0].type)
+        frames[0].close()
+        local.close()
+        session.close()
+
+
+class FileWriterTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._writer = FileWriter([self._dir])
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _read(self, rel_path):
+    with open(os.path.join(self._dir, rel_path), 'rb') as fp:
+      return fp.read()
+
+  def test_chunks_are_renamed_into_place_on_the_last_one(self):
+    path = os.path.join('a', 'b.txt')
+    self._writer.write(
+        [{path: {'offset': 0, 'data': Blob('rui '), 'last': False}}])
+    self.assertFalse(os.path.exists(os.path.join(self._dir, path)))
+    self._writer.write(
+        [{path: {'offset': 4, 'data': Blob('bm'), 'last': True}}])
+    self.assertEqual('rui bm', self._read(path))
+    self.assertEqual(['b.txt'], os.listdir(os.path.join(self._dir, 'a')))
+
+  def test_out_of_sequence_chunk_is_dropped(self):
+    self._writer.write(
+        [{'c.txt': {'offset': 0, 'data': Blob('rui'), 'last': False}}])
+    self._writer.write(
+        [{'c.txt': {'offset': 9, 'data': Blob('bm'), 'last': True}}])
+    self.assertEqual([], os.listdir(self._dir))
+
+  def test_compressed_chunks_are_decompressed(self):
+    data = 'rui bm ' * 1000
+    self._writer.write([{'d.txt': {
+        'offset': 0,
+        'data': Blob(zlib.compress(data)),
+        'compression': 'zlib/6',
+        'last': True,
+    }}])
+    self.assertEqual(data, self._read('d.txt'))
+
+  def test_finished_files_return_their_fingerprints(self):
+    fingerprints = self._writer.write([{
+        'e.txt': {'offset': 0, 'data': Blob('1'), 'last': True,
+            'fingerprint': md5('1')},
+        'f.txt': {'offset': 0, 'data': Blob('2'), 'last': True},
+        'g.txt': {'offset': 0, 'data': Blob('3'), 'last': False,
+            'fingerprint': md5('3')},
+    }])
+    self.assertEqual([{'e.txt': md5('1')}], fingerprints)
+
+  def test_pooled_durable_batch_writes_every_file(self):
+    writer = FileWriter([self._dir], 4, DURABILITY_BATCH)
+    try:
+      files = {}
+      for i in range(20):
+        files[os.path.join('d{}'.format(i % 3), 'f{}'.format(i))] = \
+            {'offset': 0, 'data': Blob(str(i)), 'last': True}
+      writer.write([files])
+    finally:
+      writer.close()
+    for rel_path, chunk in files.iteritems():
+      self.assertEqual(chunk['data'].data, self._read(rel_path))
+    self.assertEqual(['d0', 'd1', 'd2'], sorted(os.listdir(self._dir)))
+
+  def test_dirs_removed_after_being_cached_are_recreated(self):
+    path = os.path.join('a', 'e.txt')
+    self._writer.write([{path: {'offset': 0, 'data': Blob('1'), 'last': True}}])
+    shutil.rmtree(os.path.join(self._dir, 'a'))
+    self._writer.write([{path: {'offset': 0, 'data': Blob('2'), 'last': True}}])
+    self.assertEqual('2', self._read(path))
+
+  def test_sessions_writing_the_same_file_do_not_mix(self):
+    chunk = lambda offset, data, last: \
+        [{'h.txt': {'offset': offset, 'data': Blob(data), 'last': last}}]
+    self._writer.write(chunk(0, 'rui ', False), 'a')
+    self._writer.write(chunk(0, 'bm ', False), 'b')
+    self._writer.write(chunk(4, 'bm', True), 'a')
+    self.assertEqual('rui bm', self._read('h.txt'))
+    self._writer.write(chunk(3, 'rui', True), 'b')
+    self.assertEqual('bm rui', self._read('h.txt'))
+    self.assertEqual(['h.txt'], os.listdir(self._dir))
+
+  def test_discarded_frames_discard_the_file(self):
+    self._writer.write(
+        [{'j.txt': {'offset': 0, 'data': Blob('rui'), 'last': False}}])
+    self._writer.write(
+        [{'j.txt': {'offset': 3, 'data': Blob(None), 'last': True}}])
+    self.assertEqual([], os.listdir(self._dir))
+
+  def test_abandoned_sessions_leave_no_files_behind(self):
+    self._writer.write(
+        [{'i.txt': {'offset': 0, 'data': Blob('rui'), 'last': False}}], 'a')
+    self._writer.abandon('a')
+    self.assertEqual([], os.listdir(self._dir))
+
+
+class RemoteMessageHandlerTest(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self._dir, 'vendor'))
+    with open(os.path.join(self._dir, 'vendor', 'a.txt'), 'wb') as fp:
+      fp.write('rui bm')
+    self._handler = RemoteMessageHandler(DirMonitor([self._dir]))
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _diff(self, files):
+    request = Message(MessageType.DIFF_REQUEST)
+    request.body['files'] = [files]
+    request.body['generation'] = 1
+    return self._handler.handle_message(request).body
+
+  def test_known_contents_are_copied_instead_of_uploaded(self):
+    body = self._diff({
+        os.path.join('moved', 'a.txt'): (1500000000.5, md5('rui bm')),
+        'new.txt': (1500000000.5, md5('new')),
+    })
+    self.assertEqual([['new.txt']], body['diff'])
+    self.assertEqual(1, body['copied'])
+    path = os.path.join(self._dir, 'moved', 'a.txt')
+    with open(path, 'rb') as fp:
+      self.assertEqual('rui bm', fp.read())
+    self.assertEqual(1500000000.5, os.path.getmtime(path))
+    self.assertEqual([[]], self._diff({
+        os.path.join('moved', 'a.txt'): (1500000000.5, md5('rui bm')),
+    })['diff'])
+
+  def test_excluded_files_written_are_not_asked_for_again(self):
+    self._handler = RemoteMessageHandler(
+        DirMonitor([self._dir], exclude_list=['*.o']))
+    files = {'a.o': (1500000000.5, md5('rui'))}
+    self.assertEqual([['a.o']], self._diff(files)['diff'])
+    upload = Message(MessageType.UPLOAD_REQUEST)
+    upload.body['uploaded_files'] = [{'a.o': {'offset': 0,
+        'data': Blob('rui'), 'last': True, 'fingerprint': md5('rui')}}]
+    self._handler.handle_message(upload)
+    self.assertEqual([[]], self._diff(files)['diff'])
+
+  def test_stats_survive_the_wire(self):
+    self._diff({'new.txt': (1500000000.5, md5('new'))})
+    response = self._handler.handle_message(
+        Message(MessageType.STATS_REQUEST))
+    self.assertEqual(MessageType.STATS_RESPONSE, response.type)
+    serde = MessageSerde('token')
+    for wire_format in WIRE_FORMATS:
+      serde.set_wire_format(wire_format)
+      metrics, unused = serde.deserialise(serde.serialise(response))
+      counters = metrics.body['metrics']['counters']
+      self.assertTrue(counters['diff.files'] >= 1)
+      self.assertTrue(counters['remote.requests.stats_request'] >= 1)
+      self.assertTrue(
+          metrics.body['metrics']['histograms']['diff.secs']['count'] >= 1)
+
+
+class FileCopierTest(unittest.TestCase):
+  def test_appends_the_whole_file(self):
+    data = os.urandom(3 * BUFFER_SIZE_BYTES + 1)
+    with tempfile.TemporaryFile() as src_fp, \
+        tempfile.TemporaryFile() as dst_fp:
+      src_fp.write(data)
+      src_fp.seek(1)
+      dst_fp.write('x')
+      dst_fp.flush()
+      self.assertEqual(len(data), FileCopier.copy(src_fp, dst_fp))
+      dst_fp.seek(0)
+      self.assertEqual('x' + data, dst_fp.read())
+
+
+class CompressorTest(unittest.TestCase):
+  def setUp(self):
+    self._compressor = Compressor('zlib/6')
+
+  def _for_data(self, data, file_path='a.txt'):
+    fp = io.BytesIO(data)
+    compression = self._compressor.for_file(fp, file_path)
+    self.assertEqual(0, fp.tell())
+    return compression
+
+  def test_text_is_compressed(self):
+    self.assertEqual('zlib/6', self._for_data('hello world\n' * 1000))
+    data = self._compressor.compress('hello world\n' * 1000)
+    self.assertEqual('hello world\n' * 1000,
+        Compressor.decompress('zlib/6', data))
+    self.assertTrue(self._compressor.ratio() < 0.1)
+
+  def test_incompressible_files_are_skipped(self):
+    self.assertEqual(Compressor.NONE, self._for_data(os.urandom(4096)))
+    self.assertEqual(Compressor.NONE,
+        self._for_data('hello world\n' * 1000, 'a.tar.GZ'))
+    self.assertEqual(2, self._compressor.skipped_files)
+
+  def test_all_available_compressions_round_trip(self):
+    for name in Compressor.available():
+      if name != Compressor.NONE:
+        data = Compressor(name).compress('rui bm ' * 100)
+        self.assertEqual('rui bm ' * 100, Compressor.decompress(name, data))
+
+  def test_cpu_secs_only_count_the_calling_thread(self):
+    spun = []
+    def spin():
+      start = Compressor.thread_cpu_secs()
+      deadline = time.time() + 0.3
+      while time.time() < deadline:
+        pass
+      spun.append(Compressor.thread_cpu_secs() - start)
+    start = Compressor.thread_cpu_secs()
+    thread = threading.Thread(target=spin)
+    thread.start()
+    thread.join()
+    self.assertTrue(Compressor.thread_cpu_secs() - start < 0.1)
+    self.assertTrue(spun[0] > 0.2)
+
+
+class ReorderingStreamHandler(object):
+  '''Answers the requests sent to it most recent first.'''
+  def __init__(self):
+    self.unanswered = []
+    self.answered = 0
+
+  def sendMessage(self, message):
+    self.unanswered.append(message.request_id)
+
+  def recvMessage(self):
+    response = Message(MessageType.UPLOAD_RESPONSE)
+    response.request_id = self.unanswered.pop()
+    self.answered += 1
+    return response
+
+
+class CountingHashPool(HashPool):
+  def __init__(self):
+    HashPool.__init__(self)
+    self.hashed_files = 0
+
+  def hash_files(self, file_paths, fingerprint_name=Fingerprint.MD5):
+    self.hashed_files += len(file_paths)
+    return HashPool.hash_files(self, file_paths, fingerprint_name)
+
+
 
 #########################################################
 # Constants